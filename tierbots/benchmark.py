@@ -0,0 +1,243 @@
+'''
+Benchmarks of hot paths with fixed seeds and sizes.
+
+Reports ops/sec (best of several runs) and memory peak of every case,
+compares against stored baseline and fails on regressions.
+
+    python -m tierbots.benchmark                 # compare with baseline
+    python -m tierbots.benchmark --save          # store new baseline
+'''
+from contextlib import redirect_stdout
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from os.path import join, isfile
+from os import mkdir
+import argparse
+import io
+import json
+import random
+import tracemalloc
+import numpy
+
+from .const import NaturalMap, DTypes, EntityTypes, Direction
+from .decay import param_by_zerotime, zerotime_by_param_change, params_by_zerotime
+from .worldgen import generate_world, make_cell, genmaze_eller
+from .server.state import ServerState
+from .server.players import PlayerRegistry
+from .server.chunks import SparseTimes
+from .server.gamelogic import resolve_moves
+from .server.rays import visible_cells, line_of_fire
+
+
+DEFAULT_BASELINE = 'bench_baseline.json'
+
+CASES = []
+
+
+def case(ops):
+    '''
+    Registers benchmark. Decorated function does setup and returns callable doing ops operations.
+    '''
+    def deco(fn):
+        CASES.append((fn.__name__, ops, fn))
+        return fn
+    return deco
+
+
+def _quiet(fn, *args):
+    with redirect_stdout(io.StringIO()):
+        return fn(*args)
+
+
+def _open_state(foldername, size=256):
+    random.seed(7)
+    rng = numpy.random.default_rng(7)
+    s = ServerState(foldername)
+    s.naturalmap = numpy.where(rng.random((size, size)) < 0.2, NaturalMap.natural_wall, NaturalMap.ground).astype(
+        DTypes.naturalmap
+    )
+    s.wall_road_ext_times = SparseTimes()
+    s.drop_ext_times = SparseTimes()
+    s.players = PlayerRegistry()
+    s.time = 0
+    s.entities = {}
+    s.columns = ServerState._make_columns()
+    s._build_caches()
+    return s
+
+
+def _bot():
+    return {'type': int(EntityTypes.bot), 'config': b'\x02\x03\x06', 'hp': 20, 'stamina': 1000, 'energy': 0}
+
+
+@case(1)
+def generate_world_4x4(tmp):
+    def run():
+        random.seed(1)
+        _quiet(generate_world, 4, 4)
+    return run
+
+
+@case(5)
+def make_cell_x5(tmp):
+    def run():
+        random.seed(2)
+        for i in range(5):
+            make_cell()
+    return run
+
+
+@case(1)
+def genmaze_eller_200(tmp):
+    def run():
+        random.seed(3)
+        genmaze_eller(200, 200)
+    return run
+
+
+@case(1)
+def build_ground_index_512(tmp):
+    mp = numpy.where(numpy.random.default_rng(4).random((512, 512)) < 0.3, 2, 1).astype(DTypes.naturalmap)
+    return lambda: ServerState._build_ground_index(mp)
+
+
+@case(1)
+def state_save_load(tmp):
+    s = _open_state(join(tmp, 'saveload'), 512)
+    mkdir(s.foldername)
+    for i in range(2000):
+        s.place_new_entity(_bot(), i % 512, i // 512)
+
+    def run():
+        s.save()
+        ServerState.load(s.foldername)
+    return run
+
+
+@case(10000)
+def place_new_entity(tmp):
+    coords = [(x, y) for x in range(100) for y in range(100)]
+    s = _open_state(tmp)
+
+    def run():
+        s.entities = {}
+        s._build_caches()
+        for x, y in coords:
+            s.place_new_entity(_bot(), x, y)
+    return run
+
+
+@case(10000)
+def move_entity(tmp):
+    s = _open_state(tmp)
+    eids = [s.place_new_entity(_bot(), x * 2, y * 2) for x in range(100) for y in range(100)]
+
+    def run():
+        for d in (Direction.east, Direction.west):
+            for eid in eids[:5000]:
+                s.move_entity(eid, d)
+    return run
+
+
+@case(10000)
+def resolve_moves_batch(tmp):
+    s = _open_state(tmp)
+    eids = [s.place_new_entity(_bot(), x * 2, y * 2) for x in range(100) for y in range(100)]
+
+    def run():
+        resolve_moves(s, [(eid, Direction.east) for eid in eids[:5000]])
+        resolve_moves(s, [(eid, Direction.west) for eid in eids[:5000]])
+    return run
+
+
+@case(1000)
+def visible_cells_sight(tmp):
+    s = _open_state(tmp)
+    rng = numpy.random.default_rng(8)
+    points = list(zip(rng.integers(0, 256, 1000).tolist(), rng.integers(0, 256, 1000).tolist()))
+
+    def run():
+        for x, y in points:
+            visible_cells(s, x, y)
+    return run
+
+
+@case(100000)
+def line_of_fire_batch(tmp):
+    s = _open_state(tmp)
+    rng = numpy.random.default_rng(9)
+    xs, ys = rng.integers(0, 256, 100000), rng.integers(0, 256, 100000)
+    dxs, dys = rng.integers(-3, 4, 100000), rng.integers(-3, 4, 100000)
+    return lambda: line_of_fire(s, xs, ys, dxs, dys)
+
+
+@case(100000)
+def decay_scalar(tmp):
+    def run():
+        for t in range(50000):
+            param_by_zerotime(t, 60000, 0.1)
+            zerotime_by_param_change(t, 60000, 0.1, 5)
+    return run
+
+
+@case(1000000)
+def decay_vectorized(tmp):
+    times = numpy.random.default_rng(5).integers(0, 100000, 1000000)
+    return lambda: params_by_zerotime(50000, times, 0.1)
+
+
+def run_case(fn, ops, repeat):
+    with TemporaryDirectory() as tmp:
+        bench = fn(tmp)
+        best = None
+        for i in range(repeat):
+            t = perf_counter()
+            bench()
+            d = perf_counter() - t
+            best = d if best is None else min(best, d)
+        tracemalloc.start()
+        bench()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {'ops_per_sec': ops / best, 'peak_bytes': peak}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark hot paths')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save', action='store_true', help='store results as new baseline')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--tolerance', type=float, default=0.3, help='allowed relative slowdown')
+    parser.add_argument('-k', help='run only cases containing this substring')
+    args = parser.parse_args()
+
+    baseline = {}
+    if isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results, regressions = {}, []
+    print('{:<24} {:>14} {:>12} {:>10}'.format('case', 'ops/sec', 'peak KiB', 'vs base'))
+    for name, ops, fn in CASES:
+        if args.k and args.k not in name:
+            continue
+        r = results[name] = run_case(fn, ops, args.repeat)
+        base = baseline.get(name)
+        rel = '' if base is None else '{:+.0%}'.format(r['ops_per_sec'] / base['ops_per_sec'] - 1)
+        if base is not None and r['ops_per_sec'] < base['ops_per_sec'] * (1 - args.tolerance):
+            regressions.append(name)
+            rel += ' !'
+        print('{:<24} {:>14.1f} {:>12.0f} {:>10}'.format(name, r['ops_per_sec'], r['peak_bytes'] / 1024, rel))
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print('Baseline saved to', args.baseline)
+    elif regressions:
+        print('Regressions:', ', '.join(regressions))
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+'''
+Compiled bot part configurations.
+
+Bot loses parts from the end of its config as HP decreases, so every stat at given HP
+is a prefix sum over parts. Compiled config keeps cumulative stat arrays, and single
+query becomes one binary search on cumulative HP.
+
+Config bytes are part idents, one byte per part.
+'''
+from functools import lru_cache
+from bisect import bisect_left
+import numpy
+
+from .const import BotParts
+
+
+STATS = ('hp', 'energy', 'stamina', 'melee', 'ranged', 'heal', 'armor')
+
+_parts_by_ident = {part.ident: part for part in BotParts}
+
+
+def config_to_bytes(config):
+    if isinstance(config, bytes):
+        return config
+    return bytes(part.ident for part in config)
+
+
+def config_from_bytes(data):
+    return [_parts_by_ident[i] for i in data]
+
+
+class CompiledBotConfig:
+    __slots__ = ('config', 'max_hp', 'cum_hp', 'cum', '_hp_list', '_stat_lists')
+
+    def __init__(self, config):
+        self.config = config_to_bytes(config)
+        parts = config_from_bytes(self.config)
+        # rows follow STATS order
+        self.cum = numpy.cumsum(
+            numpy.array([[getattr(p, s) for s in STATS] for p in parts], dtype=numpy.int64).reshape(-1, len(STATS)),
+            axis=0,
+        ).T.copy()
+        self.cum_hp = self.cum[0]
+        self.max_hp = int(self.cum_hp[-1]) if len(parts) else 0
+        # scalar queries are faster on plain lists
+        self._hp_list = self.cum_hp.tolist()
+        self._stat_lists = {s: self.cum[i].tolist() for i, s in enumerate(STATS)}
+
+    def stat(self, name, hp):
+        n = len(self._hp_list)
+        if not n:
+            return 0
+        k = bisect_left(self._hp_list, hp)
+        return self._stat_lists[name][k if k < n else n - 1]
+
+
+@lru_cache(maxsize=None)
+def _compile(config_bytes):
+    return CompiledBotConfig(config_bytes)
+
+
+def compile_config(config):
+    '''
+    Returns interned compiled config, so each distinct config is compiled once.
+    '''
+    return _compile(config_to_bytes(config))
+
+
+class ConfigTable:
+    '''
+    Interns configs into integer ids and keeps padded cumulative tables for batch queries.
+    '''
+    def __init__(self):
+        self._ids = {}
+        self._compiled = []
+        self._tables = None
+        self.hits = 0
+        self.misses = 0
+
+    def intern(self, config):
+        config = config_to_bytes(config)
+        cid = self._ids.get(config)
+        if cid is None:
+            self.misses += 1
+            cid = self._ids[config] = len(self._compiled)
+            self._compiled.append(compile_config(config))
+            self._tables = None
+        else:
+            self.hits += 1
+        return cid
+
+    def __getitem__(self, cid):
+        return self._compiled[cid]
+
+    def _build_tables(self):
+        width = max([len(c.cum_hp) for c in self._compiled] + [1])
+        cum = numpy.zeros((len(STATS), len(self._compiled), width), dtype=numpy.int64)
+        lengths = numpy.zeros((len(self._compiled), ), dtype=numpy.intp)
+        for i, c in enumerate(self._compiled):
+            n = len(c.cum_hp)
+            lengths[i] = n
+            if n:
+                cum[:, i, :n] = c.cum
+                cum[:, i, n:] = c.cum[:, -1:]
+        # padding of hp never stops the search
+        hp = cum[0].copy()
+        hp[numpy.arange(width)[None, :] >= lengths[:, None]] = numpy.iinfo(numpy.int64).max
+        self._tables = (cum, hp, lengths)
+
+    def stats(self, ids, hps):
+        '''
+        Evaluates all stats of many bots at once.
+        Returns dict of arrays, including max_hp.
+        '''
+        if self._tables is None:
+            self._build_tables()
+        cum, hp, lengths = self._tables
+        ids = numpy.asarray(ids, dtype=numpy.intp)
+        hps = numpy.asarray(hps, dtype=numpy.int64)
+        k = (hp[ids] < hps[:, None]).sum(axis=1)
+        empty = lengths[ids] == 0
+        k = numpy.minimum(k, numpy.maximum(lengths[ids] - 1, 0))
+        out = {}
+        for si, name in enumerate(STATS):
+            v = cum[si, ids, k]
+            v[empty] = 0
+            out[name] = v
+        out['max_hp'] = numpy.where(empty, 0, cum[0, ids, numpy.maximum(lengths[ids] - 1, 0)])
+        return out
+
+
+configs = ConfigTable()
+
+
+def batch_stats(config_list, hps):
+    '''
+    Evaluates stats of bots given by their configs (bytes or part lists) and current HPs.
+    '''
+    return configs.stats([configs.intern(c) for c in config_list], hps)
@@ -1,24 +1,24 @@
 import asyncio
 
+from ..protocol import PORT, encode, decode
 
-async def tcp_echo_client(message, *, loop):
-    reader, writer = await asyncio.open_connection('127.0.0.1', 8888, loop=loop)
 
-    print('Send: %r' % message)
-    writer.write(message.encode())
+async def tcp_client(nickname, updates=3):
+    reader, writer = await asyncio.open_connection('127.0.0.1', PORT)
 
-    data = await reader.read(100)
-    print('Received: %r' % data.decode())
+    print('Register as %r' % nickname)
+    writer.write(encode({'register': nickname}))
+
+    print('Received: %r' % decode(await reader.readline()))
+    for i in range(updates):
+        print('Received: %r' % decode(await reader.readline()))
 
     print('Close the socket')
     writer.close()
 
 
 def run_client():
-    message = 'Hello World!'
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(tcp_echo_client(message, loop=loop))
-    loop.close()
+    asyncio.run(tcp_client('Hello World!'))
 
 
 if __name__ == '__main__':
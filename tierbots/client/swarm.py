@@ -0,0 +1,195 @@
+'''
+Load generator: many concurrent connections to local server, each registers a player
+and drives its bots with scripted behaviour at given command rate.
+
+Prints command-to-ack latency distribution, update receive rate and throughput.
+
+    python -m tierbots.client.swarm --clients 2000 --rate 2 --duration 30
+'''
+from time import perf_counter
+import argparse
+import asyncio
+import random
+import secrets
+
+from ..const import Actions, Entities
+from ..protocol import PORT, MAX_LINE, encode, decode
+from ..server.profiler import Histogram
+
+
+def random_walk(bots, step, rnd):
+    return [rnd.choice(list(bots)), Actions.move, rnd.randint(1, 8)]
+
+
+def gather_loop(bots, step, rnd):
+    # looks around for energy, then moves on
+    action = Actions.gather if step % 3 else Actions.move
+    return [rnd.choice(list(bots)), action, rnd.randint(1, 8)]
+
+
+def combat(bots, step, rnd):
+    eid = rnd.choice(list(bots))
+    if step % 2:
+        r = Entities.ranged_range
+        return [eid, Actions.shoot, rnd.randint(-r, r), rnd.randint(-r, r)]
+    return [eid, Actions.slay, rnd.randint(1, 8)]
+
+
+BEHAVIOURS = {
+    'walk': random_walk,
+    'gather': gather_loop,
+    'combat': combat,
+}
+
+
+class Stats:
+    def __init__(self):
+        self.latency = Histogram()
+        self.connected = 0
+        self.failed = 0
+        self.sent = 0
+        self.acked = 0
+        self.rejected = 0
+        self.updates = 0
+        self.frames = 0
+        self.bytes_received = 0
+
+
+class SwarmClient:
+    def __init__(self, name, behaviour, rate, stats, rnd):
+        self.name = name
+        self.behaviour = behaviour
+        self.rate = rate
+        self.stats = stats
+        self.rnd = rnd
+        self.bots = {}
+        # seq -> send time
+        self.inflight = {}
+        self.seq = 0
+
+    async def run(self, host, port):
+        try:
+            reader, writer = await asyncio.open_connection(host, port, limit=MAX_LINE)
+            writer.write(encode({'register': self.name}))
+            if 'token' not in decode(await reader.readline()):
+                raise ConnectionError('registration refused')
+        except (OSError, ValueError):
+            self.stats.failed += 1
+            return
+        self.stats.connected += 1
+        sender = asyncio.ensure_future(self._send(writer))
+        try:
+            await self._receive(reader)
+        except (OSError, ValueError):
+            pass
+        finally:
+            sender.cancel()
+            writer.close()
+
+    async def _receive(self, reader):
+        stats = self.stats
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            now = perf_counter()
+            stats.bytes_received += len(line)
+            msg = decode(line)
+            if 'acks' not in msg:
+                stats.frames += 1
+                continue
+            stats.updates += 1
+            for seq in msg.get('acks', ()):
+                t = self.inflight.pop(seq, None)
+                if t is not None:
+                    stats.latency.add(now - t)
+                    stats.acked += 1
+            for seq in msg.get('rejected', ()):
+                if self.inflight.pop(seq, None) is not None:
+                    stats.rejected += 1
+            self.bots = {int(k): v for k, v in msg.get('bots', {}).items()}
+
+    async def _send(self, writer):
+        interval = 1 / self.rate
+        await asyncio.sleep(self.rnd.random() * interval)
+        step = 0
+        while True:
+            if self.bots:
+                cmd = self.behaviour(self.bots, step, self.rnd)
+                self.seq += 1
+                self.inflight[self.seq] = perf_counter()
+                writer.write(encode({'seq': self.seq, 'cmd': cmd}))
+                self.stats.sent += 1
+                step += 1
+            await asyncio.sleep(interval)
+
+
+async def run_swarm(clients, rate, duration, behaviours, host='127.0.0.1', port=PORT, ramp=5.0, seed=0,
+                    prefix=None):
+    '''
+    Players are named prefix + client number, random prefix of every run keeps nicknames
+    free of players of previous runs which are still alive.
+    '''
+    if prefix is None:
+        prefix = 'swarm{}-'.format(secrets.token_hex(3))
+    stats = Stats()
+    rnd = random.Random(seed)
+    tasks = []
+    start = perf_counter()
+    for i in range(clients):
+        name = behaviours[i % len(behaviours)]
+        c = SwarmClient('{}{}'.format(prefix, i), BEHAVIOURS[name], rate, stats, random.Random(rnd.getrandbits(64)))
+        tasks.append(asyncio.ensure_future(c.run(host, port)))
+        # spread connections over ramp time
+        await asyncio.sleep(ramp / clients)
+    await asyncio.sleep(max(duration - (perf_counter() - start), 0))
+    elapsed = perf_counter() - start
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    lost = stats.sent - stats.acked - stats.rejected
+    return stats, elapsed, lost
+
+
+def format_summary(stats, elapsed, lost):
+    lat = stats.latency
+    return '\n'.join([
+        'clients     {} connected, {} failed'.format(stats.connected, stats.failed),
+        'commands    {} sent, {} acked, {} rejected, {} unacked'.format(stats.sent, stats.acked, stats.rejected, lost),
+        'latency ms  p50 {:.1f}, p90 {:.1f}, p99 {:.1f}, max {:.1f}'.format(
+            lat.percentile(0.5) * 1e3, lat.percentile(0.9) * 1e3, lat.percentile(0.99) * 1e3, lat.max * 1e3
+        ),
+        'updates     {} total, {:.1f}/s, {:.2f}/s per client, {} chunk frames'.format(
+            stats.updates, stats.updates / elapsed, stats.updates / elapsed / max(stats.connected, 1), stats.frames
+        ),
+        'throughput  {:.1f} acked cmd/s, {:.1f} KiB/s received'.format(
+            stats.acked / elapsed, stats.bytes_received / elapsed / 1024
+        ),
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Swarm load generator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--rate', type=float, default=1.0, help='commands per second per client')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds, including ramp')
+    parser.add_argument('--ramp', type=float, default=5.0, help='seconds to open all connections')
+    parser.add_argument('--behaviours', default='walk,gather,combat', help='assigned to clients in turn')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--prefix', help='nickname prefix, random by default')
+    args = parser.parse_args()
+
+    behaviours = args.behaviours.split(',')
+    for b in behaviours:
+        if b not in BEHAVIOURS:
+            parser.error('unknown behaviour {!r}'.format(b))
+    summary = asyncio.run(run_swarm(
+        args.clients, args.rate, args.duration, behaviours, args.host, args.port, args.ramp, args.seed, args.prefix
+    ))
+    print(format_summary(*summary))
+
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,8 @@ class EntityTypes(IntEnum):
     spawner = 4
     extension = 5
     radar = 6
+    # joins world layers, see server.layers
+    portal = 7
 
 
 class ConstructionTypes(IntEnum):
@@ -36,35 +38,33 @@ class BotParts(Enum):
     # allows healing, each part of this type increases healing rate
     heal = (5, {'heal': 2})
 
-    # increases protection
-    tough = (6, {'hp': 10})
+    # increases protection, each part of this type reduces damage of every hit
+    tough = (6, {'hp': 10, 'armor': 1})
 
     # allows transporting extra energy
     storage = (7, {'energy': 20})
 
     def __init__(self, ident, params):
+        self.ident = ident
         self.hp = params.get('hp', 5)
         self.energy = params.get('energy', 0)
         self.stamina = params.get('stamina', 0)
         self.melee = params.get('melee', 0)
         self.ranged = params.get('ranged', 0)
         self.heal = params.get('heal', 0)
+        self.armor = params.get('armor', 0)
+
+    # config is list of parts or config bytes (see botconfig module)
 
     @staticmethod
     def max_hp(config):
-        return sum(part.hp for part in config)
+        from .botconfig import compile_config
+        return compile_config(config).max_hp
 
     @staticmethod
     def _iter_hp(config, hp, attr):
-        # TODO: may be simpler logic here? with equal HP of each part?
-        # TODO: support config bytes instead list
-        p, r = 0, 0
-        for part in config:
-            r += getattr(part, attr)
-            p += part.hp
-            if p >= hp:
-                break
-        return r
+        from .botconfig import compile_config
+        return compile_config(config).stat(attr, hp)
 
     @classmethod
     def max_energy(cls, config, hp):
@@ -87,6 +87,20 @@ class BotParts(Enum):
         return cls._iter_hp(config, hp, 'heal')
 
 
+class Actions(IntEnum):
+    # command is (entity id, action, *args)
+    move = 1  # direction
+    suicide = 2
+    gather = 3  # direction
+    put = 4  # direction
+    place_building = 5  # direction, building type
+    build = 6  # direction
+    slay = 7  # direction
+    shoot = 8  # dx, dy
+    heal = 9  # direction
+    build_bot = 10  # config bytes
+
+
 class Direction(IntEnum):
     north = 1
     north_east = 2
@@ -108,22 +122,20 @@ class Direction(IntEnum):
 
     @classmethod
     def offset(cls, value):
-        if value == cls.up:
-            return (0, -1)
-        elif value == cls.up_right:
-            return (1, -1)
-        elif value == cls.right:
-            return (1, 0)
-        elif value == cls.down_right:
-            return (1, 1)
-        elif value == cls.down:
-            return (0, 1)
-        elif value == cls.down_left:
-            return (-1, 1)
-        elif value == cls.left:
-            return (-1, 0)
-        elif value == cls.up_left:
-            return (-1, -1)
+        '''
+        (dx, dy) of direction, None if value is not a direction.
+
+        >>> Direction.offset(Direction.east), Direction.offset(9), Direction.offset(-1)
+        ((1, 0), None, None)
+        '''
+        if 1 <= value <= 8:
+            return _direction_offsets[value]
+        return None
+
+
+# indexed by Direction value, zero index is "no move"
+_direction_offsets = ((0, 0), (0, -1), (1, -1), (1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1))
+DIRECTION_OFFSETS = numpy.array(_direction_offsets, dtype=numpy.int64)
 
 
 class NaturalMap(IntEnum):
@@ -138,6 +150,8 @@ class NaturalMap(IntEnum):
 class WorldSize:
     cell = 64
     corner_wall = 3
+    # exits of library cells are aligned to this step
+    exit_quantum = 8
 
     sources_per_cell = (2, 5)
     source_min_border_offset = 1
@@ -145,10 +159,18 @@ class WorldSize:
 
 class Filenames:
     naturalmap = 'naturalmap.npy'
+    # 4-bit packed and zlib compressed, see server.chunks
+    packed_naturalmap = 'naturalmap.z'
     ground_index = 'gindex.npy'
     wall_road_ext_times = 'wallroad.npy'
     drop_ext_times = 'drops.npy'
     pickled = 'data.pickle'
+    players_db = 'players.sqlite'
+
+    # streaming worlds
+    chunked_naturalmap = 'naturalmap.chunks'
+    chunked_wall_road_ext_times = 'wallroad.chunks'
+    chunked_drop_ext_times = 'drops.chunks'
 
 
 class DTypes:
@@ -163,7 +185,17 @@ class Entities:
 
     bot_lifetime = 3000
     offline_building_lifetime = 3000
+    buildpoints_decay = 0.1
 
     road_decay = 0.1
     wall_decay = 0.1
     drop_decay = 0.1
+
+    # moving onto road is free
+    move_stamina_cost = 1
+
+    # in blocks along each axis
+    ranged_range = 3
+    # radius in blocks
+    sight_range = 10
+    radar_range = 40
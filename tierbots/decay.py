@@ -1,4 +1,5 @@
-from math import ceil
+from math import ceil, floor
+import numpy
 
 
 def param_by_zerotime(time, zero_time, decay):
@@ -56,3 +57,40 @@ def param_by_filltime(time, fill_time, growth, max_value):
     if time >= fill_time:
         return max_value
     return max_value - ceil((fill_time - time) * growth)
+
+
+def filltime_by_param(time, value, growth, max_value):
+    '''
+    Inverse of param_by_filltime, exact for growth <= 1.
+    >>> filltime_by_param(50, 99, 0.3, 100)
+    53
+    >>> param_by_filltime(53, 53, 0.3, 100), param_by_filltime(50, 53, 0.3, 100)
+    (100, 99)
+    >>> filltime_by_param(50, 100, 0.1, 100)
+    50
+    >>> filltime_by_param(50, 200, 0.1, 100)
+    50
+    '''
+    if value >= max_value:
+        return time
+    return time + floor((max_value - value) / growth)
+
+
+def params_by_zerotime(time, zero_times, decay):
+    '''
+    Vectorized param_by_zerotime, decay can be array too.
+    >>> params_by_zerotime(50, numpy.array([49, 50, 59, 60, 62]), 0.1)
+    array([0, 0, 1, 1, 2])
+    '''
+    left = numpy.asarray(zero_times, dtype=numpy.int64) - time
+    return numpy.where(left > 0, numpy.ceil(numpy.maximum(left, 0) * decay), 0).astype(numpy.int64)
+
+
+def params_by_filltime(time, fill_times, growth, max_value):
+    '''
+    Vectorized param_by_filltime, growth and max_value can be arrays too.
+    >>> params_by_filltime(50, numpy.array([40, 50, 51, 60]), 0.1, 100)
+    array([100, 100,  99,  99])
+    '''
+    left = numpy.maximum(numpy.asarray(fill_times, dtype=numpy.int64) - time, 0)
+    return (max_value - numpy.ceil(left * growth)).astype(numpy.int64)
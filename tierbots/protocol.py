@@ -0,0 +1,107 @@
+'''
+Client-server protocol: one JSON object per line.
+
+Client to server:
+
+    {"register": nickname}                      first connection, creates player base
+    {"login": token}                            later connections
+    {"seq": n, "cmd": [eid, action, *args]}     command using Actions codes
+
+Server to client:
+
+    {"token": token, "player": index}           answer to register/login
+    {"error": message}                          answer to wrong register/login,
+                                                last message when player's last entity is gone
+    {"tick": time, "acks": [n, ...], "bots": {eid: [x, y, hp]}, "view": {...}, "radar": [...]}
+    {"tick": time, "chunk": [cx, cy], "changes": [event, ...]}
+    {"tick": time, "resync": [event, ...]}
+
+Chunk changes are state events around player's entities, see server.interest.
+Slow clients miss chunk changes and get resync with current content of their chunks instead.
+Every few ticks update of radar owner has "radar": [[x, y, block, [[bx, by, bots, buildings,
+walls, roads, drops], ...]], ...], counts of enemy bots and buildings, walls, roads and drops
+in blocks around every radar (block is size in cells), see server.radar.
+
+Servers running shared-memory workers add "view" to every update: {"radius": r,
+"watchers": [[x, y], ...], "cells": base64}, cells hold for every watcher (own bot)
+(2r + 1) ** 2 natural map values around it (NaturalMap.unknown out of sight) followed by
+the same window of entity types (zero if free), see server.sharedmem.task_frame.
+
+Commands are acknowledged in the update of the tick they were executed at,
+rejected commands are acknowledged in the next update too, with "rejected" list.
+'''
+import json
+
+from .const import Actions
+
+
+PORT = 8888
+
+# protects server from clients which never read
+MAX_LINE = 64 * 1024
+
+
+def encode(msg):
+    return json.dumps(msg, separators=(',', ':')).encode() + b'\n'
+
+
+def decode(line):
+    '''
+    >>> decode(encode({'seq': 1, 'cmd': [5, 1, 3]}))
+    {'seq': 1, 'cmd': [5, 1, 3]}
+    '''
+    return json.loads(line)
+
+
+def _direction(v):
+    return isinstance(v, int) and 1 <= v <= 8
+
+
+def _int(v):
+    return isinstance(v, int)
+
+
+def _config(v):
+    return isinstance(v, str) and len(v) <= 64
+
+
+# argument checks by action
+_ARGS = {
+    Actions.move: (_direction, ),
+    Actions.suicide: (),
+    Actions.gather: (_direction, ),
+    Actions.put: (_direction, ),
+    Actions.place_building: (_direction, _int),
+    Actions.build: (_direction, ),
+    Actions.slay: (_direction, ),
+    Actions.shoot: (_int, _int),
+    Actions.heal: (_direction, ),
+    # hex string of config bytes
+    Actions.build_bot: (_config, ),
+}
+
+
+def parse_command(cmd):
+    '''
+    Returns command tuple, None if command is malformed.
+
+    >>> parse_command([5, 1, 3])
+    (5, 1, 3)
+    >>> parse_command([5, 1, 9]) is None
+    True
+    >>> parse_command([5, 10, '0203'])
+    (5, 10, b'\\x02\\x03')
+    '''
+    if not isinstance(cmd, list) or len(cmd) < 2 or not _int(cmd[0]) or not _int(cmd[1]):
+        return None
+    checks = _ARGS.get(cmd[1])
+    if checks is None or len(cmd) != len(checks) + 2:
+        return None
+    if not all(check(v) for check, v in zip(checks, cmd[2:])):
+        return None
+    if cmd[1] == Actions.build_bot:
+        try:
+            return (cmd[0], cmd[1], bytes.fromhex(cmd[2]))
+        except ValueError:
+            return None
+    return tuple(cmd)
@@ -0,0 +1,342 @@
+'''
+Chunked drop-in replacements for ServerState arrays, used by streaming worlds,
+and sparse store of wall, road and drop death times used by all worlds.
+
+Chunks have size of world cell, naturalmap chunk is generated on first touch.
+Only scalar (x, y) indexing is supported, use window() and take() for bulk reads.
+
+NaturalMap codes fit into 4 bits, so naturalmap chunks are kept packed, two cells per byte,
+and compressed by zlib on disk. Dense worlds use the same packed zlib format on disk only,
+in memory they stay plain arrays.
+
+    python -m tierbots.server.chunks WORLD    # memory and disk usage of naturalmap
+'''
+from os.path import getsize, isfile
+import argparse
+import heapq
+import pickle
+import zlib
+import numpy
+
+from ..const import WorldSize, DTypes
+
+
+def pack4(a):
+    '''
+    Packs array of values < 16 into flat uint8 array, two values per byte (first one in low bits).
+
+    >>> pack4(numpy.array([[1, 2], [3, 4]], dtype=numpy.uint8)).tolist()
+    [33, 67]
+    '''
+    flat = a.ravel()
+    if len(flat) % 2:
+        flat = numpy.append(flat, 0)
+    return (flat[0::2] | (flat[1::2] << 4)).astype(numpy.uint8)
+
+
+def unpack4(packed, shape):
+    '''
+    >>> unpack4(numpy.array([33, 67], dtype=numpy.uint8), (2, 2)).tolist()
+    [[1, 2], [3, 4]]
+    '''
+    out = numpy.empty((len(packed) * 2, ), dtype=DTypes.naturalmap)
+    out[0::2] = packed & 15
+    out[1::2] = packed >> 4
+    return out[:int(numpy.prod(shape))].reshape(shape)
+
+
+def save_packed(filename, a):
+    '''
+    Dense naturalmap on disk: 4-bit packed and zlib compressed.
+    '''
+    with open(filename, 'wb') as f:
+        pickle.dump({'shape': a.shape, 'data': zlib.compress(pack4(a).tobytes(), 1)}, f)
+
+
+def load_packed(filename):
+    with open(filename, 'rb') as f:
+        data = pickle.load(f)
+    return unpack4(numpy.frombuffer(zlib.decompress(data['data']), dtype=numpy.uint8), data['shape'])
+
+
+class LazyNaturalMap:
+    def __init__(self, world, on_new_chunk=None):
+        self.world = world
+        # (cx, cy) -> packed chunk, see pack4
+        self.chunks = {}
+        # called with list of sources of every freshly generated chunk
+        self.on_new_chunk = on_new_chunk
+
+    @property
+    def shape(self):
+        return (self.world.width * WorldSize.cell, self.world.height * WorldSize.cell)
+
+    def _packed(self, cx, cy):
+        k = (cx, cy)
+        p = self.chunks.get(k)
+        if p is None:
+            c, sources = self.world.make_cell(cx, cy)
+            p = self.chunks[k] = pack4(c)
+            if self.on_new_chunk is not None:
+                self.on_new_chunk(sources)
+        return p
+
+    def chunk(self, cx, cy):
+        '''
+        Unpacked copy of chunk, write through item assignment.
+        '''
+        return unpack4(self._packed(cx, cy), (WorldSize.cell, WorldSize.cell))
+
+    def __getitem__(self, xy):
+        x, y = xy
+        c = WorldSize.cell
+        i = (x % c) * c + y % c
+        b = self._packed(x // c, y // c)[i >> 1]
+        return DTypes.naturalmap((b >> ((i & 1) << 2)) & 15)
+
+    def __setitem__(self, xy, value):
+        x, y = xy
+        c = WorldSize.cell
+        i = (x % c) * c + y % c
+        p = self._packed(x // c, y // c)
+        shift = (i & 1) << 2
+        p[i >> 1] = (int(p[i >> 1]) & (0xF0 >> shift)) | (int(value) << shift)
+
+    def window(self, x0, y0, x1, y1):
+        out = numpy.empty((x1 - x0, y1 - y0), dtype=DTypes.naturalmap)
+        c = WorldSize.cell
+        for cx in range(x0 // c, (x1 - 1) // c + 1):
+            for cy in range(y0 // c, (y1 - 1) // c + 1):
+                ax, ay = max(x0, cx * c), max(y0, cy * c)
+                bx, by = min(x1, (cx + 1) * c), min(y1, (cy + 1) * c)
+                out[ax - x0:bx - x0, ay - y0:by - y0] = self.chunk(cx, cy)[ax - cx * c:bx - cx * c, ay - cy * c:by - cy * c]
+        return out
+
+    def take(self, xs, ys):
+        '''
+        Values at arrays of valid coordinates, unpacked straight from packed chunks.
+        '''
+        xs, ys = numpy.asarray(xs, dtype=numpy.int64), numpy.asarray(ys, dtype=numpy.int64)
+        c = WorldSize.cell
+        out = numpy.empty(xs.shape, dtype=DTypes.naturalmap)
+        i = (xs % c) * c + ys % c
+        keys = (xs // c) * self.world.height + ys // c
+        for k in numpy.unique(keys):
+            sel = keys == k
+            p = self._packed(*divmod(int(k), self.world.height))
+            out[sel] = (p[i[sel] >> 1] >> ((i[sel] & 1) << 2)) & 15
+        return out
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            pickle.dump({
+                'world': self.world,
+                'format': 'packed4-zlib',
+                'chunks': {k: zlib.compress(p.tobytes(), 1) for k, p in self.chunks.items()},
+            }, f)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            data = pickle.load(f)
+        o = cls(data['world'])
+        if data.get('format') == 'packed4-zlib':
+            o.chunks = {k: numpy.frombuffer(zlib.decompress(z), dtype=numpy.uint8).copy() for k, z in data['chunks'].items()}
+        else:
+            # older worlds kept plain uint8 chunks
+            o.chunks = {k: pack4(c) for k, c in data['chunks'].items()}
+        return o
+
+
+class SparseTimes:
+    '''
+    Death times (of walls, roads or drops) by (x, y), for dense and streaming worlds.
+    Zero or any time not after current one means nothing is there.
+
+    Square chunks are allocated only when they get live value and freed once everything
+    in them has expired, so memory and files follow the number of live objects, not map size.
+    Call expire() with current time every tick.
+
+    >>> t = SparseTimes(chunk=4)
+    >>> t[5, 6] = 10
+    >>> int(t[5, 6]), int(t[0, 0]), list(t.chunks)
+    (10, 0, [(1, 1)])
+    >>> [(x, y, int(v)) for x, y, v in t.live(0, 0, 8, 8)]
+    [(5, 6, 10)]
+    >>> t.expire(10)
+    >>> t.chunks
+    {}
+    '''
+    def __init__(self, chunk=WorldSize.cell):
+        self.chunk = chunk
+        self.chunks = {}
+        # chunk key -> no value in chunk is later than this
+        self.ends = {}
+        self._heap = []
+        self.time = 0
+
+    def __getitem__(self, xy):
+        x, y = xy
+        c = self.chunk
+        if isinstance(x, numpy.ndarray):
+            out = numpy.zeros(x.shape, dtype=DTypes.time)
+            kx, ky = x // c, y // c
+            for k in set(zip(kx.tolist(), ky.tolist())) & self.chunks.keys():
+                sel = (kx == k[0]) & (ky == k[1])
+                out[sel] = self.chunks[k][x[sel] % c, y[sel] % c]
+            return out
+        a = self.chunks.get((x // c, y // c))
+        return DTypes.time(0) if a is None else a[x % c, y % c]
+
+    def __setitem__(self, xy, value):
+        x, y = xy
+        c = self.chunk
+        k = (x // c, y // c)
+        a = self.chunks.get(k)
+        if a is None:
+            if value <= self.time:
+                return
+            a = self.chunks[k] = numpy.zeros((c, c), dtype=DTypes.time)
+        a[x % c, y % c] = value
+        if value > self.ends.get(k, 0):
+            self.ends[k] = value
+            heapq.heappush(self._heap, (int(value), k))
+
+    def expire(self, time):
+        '''
+        Frees chunks which values are all at or before time.
+        '''
+        self.time = time
+        heap = self._heap
+        while heap and heap[0][0] <= time:
+            end, k = heapq.heappop(heap)
+            # stale entries are those overtaken by later value
+            if self.ends.get(k) == end:
+                del self.chunks[k], self.ends[k]
+
+    def live(self, x0, y0, x1, y1):
+        '''
+        Yields (x, y, time) of values after current time within rectangle, only allocated chunks are visited.
+        '''
+        c = self.chunk
+        kx0, ky0, kx1, ky1 = max(x0, 0) // c, max(y0, 0) // c, (x1 - 1) // c + 1, (y1 - 1) // c + 1
+        if (kx1 - kx0) * (ky1 - ky0) > len(self.chunks):
+            # big area, visit allocated chunks only
+            keys = sorted(k for k in self.chunks if kx0 <= k[0] < kx1 and ky0 <= k[1] < ky1)
+        else:
+            keys = [(cx, cy) for cx in range(kx0, kx1) for cy in range(ky0, ky1) if (cx, cy) in self.chunks]
+        for cx, cy in keys:
+            ax, ay = max(x0 - cx * c, 0), max(y0 - cy * c, 0)
+            part = self.chunks[cx, cy][ax:x1 - cx * c, ay:y1 - cy * c]
+            for lx, ly in zip(*numpy.nonzero(part > self.time)):
+                yield cx * c + ax + int(lx), cy * c + ay + int(ly), part[lx, ly]
+
+    def dense(self, shape):
+        out = numpy.zeros(shape, dtype=DTypes.time)
+        c = self.chunk
+        for (cx, cy), a in self.chunks.items():
+            part = out[cx * c:(cx + 1) * c, cy * c:(cy + 1) * c]
+            part[...] = a[:part.shape[0], :part.shape[1]]
+        return out
+
+    @classmethod
+    def from_cells(cls, xs, ys, times, time, chunk=WorldSize.cell):
+        o = cls(chunk)
+        o.time = time
+        for x, y, t in zip(xs.tolist(), ys.tolist(), times.tolist()):
+            o[x, y] = t
+        return o
+
+    @classmethod
+    def from_dense(cls, arr, time, chunk=WorldSize.cell):
+        xs, ys = numpy.nonzero(arr > time)
+        return cls.from_cells(xs, ys, arr[xs, ys], time, chunk)
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            pickle.dump({'format': 'sparse', 'chunk': self.chunk, 'chunks': self.chunks}, f)
+
+    @classmethod
+    def load(cls, filename, time, width=None):
+        '''
+        width is number of world cells in row, needed for files of streaming worlds
+        saved before sparse format (chunks by ground index).
+        '''
+        with open(filename, 'rb') as f:
+            data = pickle.load(f)
+        if data.get('format') == 'sparse':
+            o = cls(data['chunk'])
+            chunks = data['chunks']
+        else:
+            o = cls()
+            c = WorldSize.cell
+            chunks = {(k % width, k // width): a.reshape(c, c) for k, a in data.items()}
+        o.time = time
+        for k, a in chunks.items():
+            end = int(a.max())
+            if end > time:
+                o.chunks[k] = a
+                o.ends[k] = end
+                o._heap.append((end, k))
+        heapq.heapify(o._heap)
+        return o
+
+
+def live_times(times, time, x0, y0, x1, y1):
+    '''
+    Yields (x, y, death time) of live values within rectangle, for SparseTimes
+    or dense (x, y) array (times rebound to shared memory, see sharedmem).
+    '''
+    if isinstance(times, SparseTimes):
+        return times.live(max(x0, 0), max(y0, 0), x1, y1)
+    x0, y0 = max(x0, 0), max(y0, 0)
+    part = times[x0:x1, y0:y1]
+    return ((x0 + int(i), y0 + int(j), part[i, j]) for i, j in zip(*numpy.nonzero(part > time)))
+
+
+def naturalmap_usage(naturalmap):
+    '''
+    Bytes taken by naturalmap as plain uint8 array, 4-bit packed and packed with zlib.
+    Streaming worlds count generated chunks only.
+    '''
+    if isinstance(naturalmap, LazyNaturalMap):
+        packed = list(naturalmap.chunks.values())
+        cells = len(packed) * WorldSize.cell * WorldSize.cell
+    else:
+        packed = [pack4(naturalmap)]
+        cells = naturalmap.size
+    return {
+        'cells': cells,
+        'uint8': cells * numpy.dtype(DTypes.naturalmap).itemsize,
+        'packed': sum(p.nbytes for p in packed),
+        'zlib': sum(len(zlib.compress(p.tobytes(), 1)) for p in packed),
+    }
+
+
+def main():
+    from .state import ServerState
+    from ..const import Filenames
+
+    parser = argparse.ArgumentParser(description='Report naturalmap memory and disk usage')
+    parser.add_argument('foldername')
+    args = parser.parse_args()
+
+    state = ServerState.load(args.foldername)
+    u = naturalmap_usage(state.naturalmap)
+    lazy = isinstance(state.naturalmap, LazyNaturalMap)
+    mib = 1024 * 1024
+    print('cells      {}{}'.format(u['cells'], ' (generated chunks)' if lazy else ''))
+    print('memory     uint8 {:.2f} MiB, packed {:.2f} MiB, in use: {}'.format(
+        u['uint8'] / mib, u['packed'] / mib, 'packed' if lazy else 'uint8'
+    ))
+    print('disk       raw {:.2f} MiB, packed+zlib {:.2f} MiB ({:.1f}x smaller)'.format(
+        u['uint8'] / mib, u['zlib'] / mib, u['uint8'] / max(u['zlib'], 1)
+    ))
+    for name in (Filenames.naturalmap, Filenames.packed_naturalmap, Filenames.chunked_naturalmap):
+        filename = state._get_filename(name)
+        if isfile(filename):
+            print('file       {} {:.2f} MiB'.format(name, getsize(filename) / mib))
+
+
+if __name__ == '__main__':
+    main()
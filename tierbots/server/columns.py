@@ -0,0 +1,111 @@
+'''
+Lazy entity properties.
+
+Property which changes linearly with time is stored as time of reaching zero
+(decaying) or maximal value (growing), like walls and drops already are.
+Values are evaluated on read, so entities nobody touches cost nothing per tick.
+'''
+import numpy
+
+from ..const import DTypes
+from ..decay import (
+    param_by_zerotime, zerotime_by_param_change, param_by_filltime, filltime_by_param,
+    params_by_zerotime, params_by_filltime,
+)
+
+
+class LazyColumn:
+    '''
+    Growing column needs max_value. Rate may be overridden per key.
+    '''
+    def __init__(self, rate, max_value=None):
+        self.rate = rate
+        self.max_value = max_value
+        self._slots = {}
+        self._free = []
+        self._keys = numpy.zeros((16, ), dtype=numpy.int64)
+        self._times = numpy.zeros((16, ), dtype=DTypes.time)
+        self._rates = numpy.zeros((16, ), dtype=numpy.float64)
+        self._used = numpy.zeros((16, ), dtype=numpy.bool_)
+
+    @property
+    def growing(self):
+        return self.max_value is not None
+
+    def __contains__(self, key):
+        return key in self._slots
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _allocate(self, key):
+        if self._free:
+            slot = self._free.pop()
+        else:
+            slot = len(self._slots)
+            if slot >= len(self._used):
+                n = len(self._used) * 2
+                for a in ('_keys', '_times', '_rates', '_used'):
+                    arr = getattr(self, a)
+                    new = numpy.zeros((n, ), dtype=arr.dtype)
+                    new[:len(arr)] = arr
+                    setattr(self, a, new)
+        self._slots[key] = slot
+        self._keys[slot] = key
+        self._used[slot] = True
+        self._rates[slot] = self.rate
+        return slot
+
+    def get(self, key, time):
+        slot = self._slots[key]
+        t, rate = int(self._times[slot]), float(self._rates[slot])
+        if self.growing:
+            return param_by_filltime(time, t, rate, self.max_value)
+        return param_by_zerotime(time, t, rate)
+
+    def set(self, key, time, value, rate=None):
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._allocate(key)
+        if rate is not None:
+            self._rates[slot] = rate
+        rate = float(self._rates[slot])
+        if self.growing:
+            self._times[slot] = filltime_by_param(time, max(value, 0), rate, self.max_value)
+        else:
+            self._times[slot] = zerotime_by_param_change(time, time, rate, value)
+
+    def change(self, key, time, delta):
+        '''
+        Returns new value, clamped to [0, max_value].
+        '''
+        v = max(self.get(key, time) + delta, 0)
+        if self.growing:
+            v = min(v, self.max_value)
+        self.set(key, time, v)
+        return v
+
+    def remove(self, key):
+        slot = self._slots.pop(key)
+        self._used[slot] = False
+        self._free.append(slot)
+
+    def get_many(self, keys, time):
+        slots = numpy.fromiter((self._slots[k] for k in keys), dtype=numpy.intp, count=len(keys))
+        if self.growing:
+            return params_by_filltime(time, self._times[slots], self._rates[slots], self.max_value)
+        return params_by_zerotime(time, self._times[slots], self._rates[slots])
+
+    def expired(self, time):
+        '''
+        Keys of decaying column which values have reached zero.
+        '''
+        assert not self.growing
+        return self._keys[self._used & (self._times <= time)].tolist()
+
+    def next_change(self, time):
+        '''
+        Nearest future time when some value reaches zero (or maximum). None if nothing changes.
+        '''
+        t = self._times[self._used & (self._times > time)]
+        return int(t.min()) if len(t) else None
@@ -0,0 +1,160 @@
+'''
+Tick engine over ServerState.
+
+Commands are (entity id, action, *args) tuples using Actions codes, queued for the tick
+they must be executed at. All decay and growth is closed-form over state time, so in
+headless mode engine can jump straight to the next tick where something happens.
+'''
+from time import perf_counter
+import argparse
+import numpy
+
+from ..const import Actions, EntityTypes
+from .gamelogic import resolve_moves, resolve_combat, kill_entities
+
+
+def _min_after(times, time):
+    if isinstance(times, numpy.ndarray):
+        t = times[times > time]
+        return int(t.min()) if len(t) else None
+    # chunked storage
+    r = None
+    for c in times.chunks.values():
+        t = _min_after(c, time)
+        if t is not None and (r is None or t < r):
+            r = t
+    return r
+
+
+class Engine:
+    def __init__(self, state):
+        self.state = state
+        self.queue = {}
+        # called with (time, commands) after every tick
+        self.listeners = []
+        self.profiler = None
+        self.phases = [
+            ('move', self._phase_move),
+            ('combat', self._phase_combat),
+            ('suicide', self._phase_suicide),
+            ('expire', self._phase_expire),
+        ]
+
+    def queue_command(self, command, time=None):
+        '''
+        Queues command for given tick (current one by default).
+        '''
+        time = self.state.time if time is None else time
+        assert time >= self.state.time, 'Trying to queue command into the past'
+        self.queue.setdefault(time, []).append(tuple(command))
+
+    def tick(self):
+        '''
+        Runs all phases over commands of current tick and advances time.
+        Returns executed commands.
+        '''
+        commands = self.queue.pop(self.state.time, [])
+        by_action = {}
+        for c in commands:
+            if c[0] in self.state.entities:
+                by_action.setdefault(c[1], []).append(c)
+        time = self.state.time
+        prof = self.profiler
+        if prof is None:
+            for name, phase in self.phases:
+                phase(by_action)
+        else:
+            prof.tick_start()
+            for name, phase in self.phases:
+                with prof.phase(name):
+                    phase(by_action)
+            prof.tick_end(time)
+            prof.gauge('entities', len(self.state.entities))
+            prof.gauge('queue_depth', sum(len(v) for v in self.queue.values()))
+            prof.count('commands', len(commands))
+        self.state.increment_time()
+        for listener in self.listeners:
+            listener(time, commands)
+        return commands
+
+    def _phase_move(self, by_action):
+        # only the last move of each entity counts
+        moves = {c[0]: c[2] for c in by_action.get(Actions.move, ())}
+        resolve_moves(self.state, moves.items())
+
+    def _phase_combat(self, by_action):
+        resolve_combat(
+            self.state,
+            slays=[(c[0], c[2]) for c in by_action.get(Actions.slay, ())],
+            shots=[(c[0], c[2], c[3]) for c in by_action.get(Actions.shoot, ())],
+            heals=[(c[0], c[2]) for c in by_action.get(Actions.heal, ())],
+        )
+
+    def _phase_suicide(self, by_action):
+        eids = {c[0] for c in by_action.get(Actions.suicide, ()) if c[0] in self.state.entities}
+        kill_entities(self.state, [eid for eid in eids if self.state.entities[eid]['type'] == EntityTypes.bot])
+
+    def _phase_expire(self, by_action):
+        expired = set()
+        for key in ('lifetime', 'buildpoints', 'hp'):
+            expired.update(self.state.expired_entities(key))
+        if expired:
+            kill_entities(self.state, list(expired))
+
+    def next_event_time(self):
+        '''
+        Nearest tick (not before current one) where something observable happens:
+        queued command, map object expiry, lazy property reaching zero or maximum, spawner getting free.
+        None if nothing will ever happen.
+        '''
+        st = self.state
+        candidates = [t for t in self.queue if t >= st.time]
+        for times in (st.wall_road_ext_times, st.drop_ext_times):
+            candidates.append(_min_after(times, st.time - 1))
+        for col in st.columns.values():
+            candidates.append(col.next_change(st.time - 1))
+        candidates.extend(
+            e['busy_until'] for e in st.entities.values()
+            if e['type'] == EntityTypes.spawner and e.get('busy_until') is not None and e['busy_until'] >= st.time
+        )
+        candidates = [t for t in candidates if t is not None]
+        return min(candidates) if candidates else None
+
+    def fast_forward(self, until):
+        '''
+        Headless mode: runs ticks with events, skips all others.
+        Returns number of ticks actually executed.
+        '''
+        executed = 0
+        while self.state.time < until:
+            t = self.next_event_time()
+            if t is None or t >= until:
+                self.state.time = until
+                break
+            self.state.time = t
+            self.tick()
+            executed += 1
+        return executed
+
+
+def main():
+    from .state import ServerState
+
+    parser = argparse.ArgumentParser(description='Headless fast-forward simulation')
+    parser.add_argument('foldername')
+    parser.add_argument('ticks', type=int)
+    parser.add_argument('--save', action='store_true', help='save state afterwards')
+    args = parser.parse_args()
+
+    state = ServerState.load(args.foldername)
+    engine = Engine(state)
+    start = state.time
+    t = perf_counter()
+    executed = engine.fast_forward(start + args.ticks)
+    print('Simulated {} ticks ({} executed) in {:.3f}s'.format(args.ticks, executed, perf_counter() - t))
+    if args.save:
+        state.save()
+
+
+if __name__ == '__main__':
+    main()
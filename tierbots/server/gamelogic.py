@@ -0,0 +1,183 @@
+'''
+Tick phases. Each phase gathers all intents of the tick and resolves them at once,
+so result never depends on order in which commands arrived.
+'''
+import numpy
+
+from ..const import EntityTypes, Direction, DIRECTION_OFFSETS
+from ..botconfig import configs
+from .rays import line_of_fire
+from .passability import WALL, ENTITY
+
+
+def _priority(eids, time):
+    # tick-salted hash, so the same bot doesn't win every contest
+    h = eids.astype(numpy.uint64) * numpy.uint64(0x9E3779B1) + numpy.uint64((time * 0x85EBCA6B) & 0xffffffff)
+    return (h ^ (h >> numpy.uint64(16))) & numpy.uint64(0xffffffff)
+
+
+def resolve_moves(state, moves):
+    '''
+    Moves are (entity id, direction) pairs, one per entity, only bots can move.
+    All moves are resolved simultaneously:
+    - contested cell goes to one mover, chosen by tick-salted hash of entity ids
+    - mover blocked by staying entity stays too, so chains resolve from their heads
+    - rotations, including swaps, succeed as a whole
+    Moving onto road is free, otherwise it costs stamina.
+    Moves with unknown direction are dropped.
+    Returns list of moved entity IDs.
+    '''
+    moves = [
+        (eid, d) for eid, d in moves
+        if Direction.offset(d) is not None and eid in state.entities and 'stamina' in state.entities[eid]
+    ]
+    if not moves:
+        return []
+    eids = numpy.array([m[0] for m in moves], dtype=numpy.int64)
+    ents = [state.entities[eid] for eid, d in moves]
+    xs = numpy.array([e['x'] for e in ents], dtype=numpy.int64)
+    ys = numpy.array([e['y'] for e in ents], dtype=numpy.int64)
+    stamina = numpy.array([e['stamina'] for e in ents], dtype=numpy.int64)
+    offsets = DIRECTION_OFFSETS[numpy.array([m[1] for m in moves], dtype=numpy.intp)]
+    tx, ty = xs + offsets[:, 0], ys + offsets[:, 1]
+
+    w, h = state.naturalmap.shape
+    moving = (tx >= 0) & (ty >= 0) & (tx < w) & (ty < h) & ((offsets[:, 0] != 0) | (offsets[:, 1] != 0))
+    cost = numpy.zeros(len(moves), dtype=numpy.int64)
+    occupied = numpy.zeros(len(moves), dtype=bool)
+    vi = numpy.nonzero(moving)[0]
+    bits, cost[vi] = state.passability.take(tx[vi], ty[vi])
+    moving[vi[(bits & WALL) != 0]] = False
+    occupied[vi] = (bits & ENTITY) != 0
+    moving &= stamina >= cost
+
+    # one winner per contested cell
+    keys = tx * h + ty
+    vi = numpy.nonzero(moving)[0]
+    order = vi[numpy.lexsort((-_priority(eids[vi], state.time).astype(numpy.int64), keys[vi]))]
+    losers = order[1:][keys[order[1:]] == keys[order[:-1]]]
+    moving[losers] = False
+
+    # occupant of target: -2 free, -1 entity which doesn't move, mover index otherwise
+    index = {int(eid): i for i, eid in enumerate(eids)}
+    occupant = numpy.full(len(moves), -2, dtype=numpy.intp)
+    for i in numpy.nonzero(occupied & moving)[0]:
+        occupant[i] = index.get(state._ent_map[int(tx[i]), int(ty[i])], -1)
+    while True:
+        blocked = moving & ((occupant == -1) | ((occupant >= 0) & ~moving[numpy.maximum(occupant, 0)]))
+        if not blocked.any():
+            break
+        moving &= ~blocked
+
+    mi = numpy.nonzero(moving)[0]
+    for i in mi[cost[mi] > 0]:
+        ents[i]['stamina'] -= int(cost[i])
+    moved = eids[mi].tolist()
+    state.relocate_entities(moved, tx[mi].tolist(), ty[mi].tolist())
+    return moved
+
+
+def _directed(actions, stat):
+    # (actor, dx, dy, stat) of (entity id, direction) pairs, unknown directions are dropped
+    for eid, d in actions:
+        offset = Direction.offset(d)
+        if offset is not None:
+            yield (eid, ) + offset + (stat, )
+
+
+def _bot_stats(state, eids):
+    return configs.stats(
+        [configs.intern(state.entities[eid]['config']) for eid in eids],
+        state.get_entity_props(eids, 'hp'),
+    )
+
+
+def resolve_combat(state, slays=(), shots=(), heals=()):
+    '''
+    Slays and heals are (entity id, direction) pairs, shots are (entity id, dx, dy).
+    Shots need clear line of fire.
+    Power of every action is taken from attacker's parts alive at its current HP.
+    Damage and healing of the tick are summed per target and applied at once,
+    armor of target reduces each hit separately.
+    Killed entities are removed, their energy is dropped in place.
+    Returns list of killed entity IDs.
+    '''
+    shots = [s for s in shots if s[0] in state.entities]
+    if shots:
+        shooters = [state.entities[s[0]] for s in shots]
+        clear = line_of_fire(
+            state,
+            [e['x'] for e in shooters], [e['y'] for e in shooters],
+            [s[1] for s in shots], [s[2] for s in shots],
+        )
+        shots = [s for s, c in zip(shots, clear) if c]
+
+    intents = []  # (actor, dx, dy, stat)
+    intents.extend(_directed(slays, 'melee'))
+    intents.extend((eid, dx, dy, 'ranged') for eid, dx, dy in shots)
+    intents.extend(_directed(heals, 'heal'))
+
+    actors, targets, stats = [], [], []
+    for eid, dx, dy, stat in intents:
+        e = state.entities.get(eid)
+        if e is None or e['type'] != EntityTypes.bot or (dx == 0 and dy == 0):
+            continue
+        tid = state.get_entity(e['x'] + dx, e['y'] + dy)
+        if tid is None or state.get_entity_prop(tid, 'hp') is None:
+            continue
+        if stat == 'heal' and state.entities[tid]['type'] != EntityTypes.bot:
+            continue
+        actors.append(eid)
+        targets.append(tid)
+        stats.append(stat)
+    if not actors:
+        return []
+
+    power = _bot_stats(state, actors)
+    power = numpy.choose(
+        numpy.array([('melee', 'ranged', 'heal').index(s) for s in stats]),
+        (power['melee'], power['ranged'], power['heal']),
+    )
+    target_ids = list(dict.fromkeys(targets))
+    tindex = {tid: i for i, tid in enumerate(target_ids)}
+    ti = numpy.array([tindex[t] for t in targets], dtype=numpy.intp)
+    tents = [state.entities[t] for t in target_ids]
+
+    hp = state.get_entity_props(target_ids, 'hp')
+    is_bot = numpy.array([e['type'] == EntityTypes.bot for e in tents])
+    armor = numpy.zeros(len(tents), dtype=numpy.int64)
+    # only bots are healed, other targets are clipped at their current HP
+    max_hp = numpy.array(hp, dtype=numpy.int64)
+    if is_bot.any():
+        bi = numpy.nonzero(is_bot)[0]
+        bstats = _bot_stats(state, [target_ids[i] for i in bi])
+        armor[bi] = bstats['armor']
+        max_hp[bi] = bstats['max_hp']
+
+    heal = numpy.array([s == 'heal' for s in stats])
+    damage = numpy.zeros(len(tents), dtype=numpy.int64)
+    healing = numpy.zeros(len(tents), dtype=numpy.int64)
+    numpy.add.at(damage, ti[~heal], numpy.maximum(power[~heal] - armor[ti[~heal]], 0))
+    numpy.add.at(healing, ti[heal], power[heal])
+
+    hp = numpy.clip(hp - damage + healing, 0, max_hp)
+    for tid, v in zip(target_ids, hp.tolist()):
+        state.change_entity_prop(tid, 'hp', v)
+
+    killed = [target_ids[i] for i in numpy.nonzero(hp <= 0)[0]]
+    kill_entities(state, killed)
+    return killed
+
+
+def kill_entities(state, eids):
+    '''
+    IDs must be valid. Energy of killed entities is dropped in place.
+    '''
+    drops = [
+        (state.entities[eid]['x'], state.entities[eid]['y'], state.get_entity_prop(eid, 'energy', 0))
+        for eid in eids
+    ]
+    state.remove_entities(eids)
+    for x, y, energy in drops:
+        if energy > 0:
+            state.change_energy_drop(x, y, energy)
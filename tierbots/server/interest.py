@@ -0,0 +1,171 @@
+'''
+Interest management: which client needs which change.
+
+World is split into square chunks. Every client subscribes to chunks seen by its entities
+(sight range, radar range for radars), subscriptions follow entities as they move.
+State mutations are published into chunk they happened in, so flushing a tick only
+touches dirty chunks and their subscribers, not every client against every change.
+'''
+from ..const import Entities, EntityTypes, NaturalMap
+
+
+def _chunks_around(x, y, radius, chunk):
+    return frozenset(
+        (cx, cy)
+        for cx in range(max(x - radius, 0) // chunk, (x + radius) // chunk + 1)
+        for cy in range(max(y - radius, 0) // chunk, (y + radius) // chunk + 1)
+    )
+
+
+def watch_radius(entity):
+    '''
+    Entities which see around, None for others.
+    '''
+    t = entity['type']
+    if t == EntityTypes.radar:
+        return Entities.radar_range
+    if t in (EntityTypes.bot, EntityTypes.spawner, EntityTypes.extension):
+        return Entities.sight_range
+    return None
+
+
+class InterestManager:
+    '''
+    Clients are any hashable handles. Attach client to player index, then call flush() once per tick.
+    '''
+    def __init__(self, state, chunk=16):
+        self.state = state
+        self.chunk = chunk
+        # chunk -> {client: number of client's watchers seeing chunk}
+        self.subscribers = {}
+        # eid -> (client, radius, chunks)
+        self.watchers = {}
+        # player index -> set of clients
+        self.clients = {}
+        # chunk -> list of events of current tick
+        self.dirty = {}
+        state.observers.append(self._on_event)
+
+    def close(self):
+        self.state.observers.remove(self._on_event)
+
+    def attach(self, client, owner):
+        self.clients.setdefault(owner, set()).add(client)
+        for eid, e in self.state.entities.items():
+            if e.get('owner') == owner:
+                self._watch(client, eid, e)
+
+    def detach(self, client):
+        for owner, clients in list(self.clients.items()):
+            clients.discard(client)
+            if not clients:
+                del self.clients[owner]
+        for eid in [eid for eid, w in self.watchers.items() if w[0] == client]:
+            self._unwatch(eid)
+
+    def chunks_of(self, client):
+        return [k for k, subs in self.subscribers.items() if client in subs]
+
+    def _watch(self, client, eid, e):
+        radius = watch_radius(e)
+        if radius is None:
+            return
+        chunks = _chunks_around(e['x'], e['y'], radius, self.chunk)
+        self.watchers[eid] = (client, radius, chunks)
+        self._subscribe(client, chunks)
+
+    def _unwatch(self, eid):
+        client, radius, chunks = self.watchers.pop(eid)
+        self._unsubscribe(client, chunks)
+
+    def _subscribe(self, client, chunks):
+        for k in chunks:
+            subs = self.subscribers.setdefault(k, {})
+            subs[client] = subs.get(client, 0) + 1
+
+    def _unsubscribe(self, client, chunks):
+        for k in chunks:
+            subs = self.subscribers[k]
+            subs[client] -= 1
+            if not subs[client]:
+                del subs[client]
+                if not subs:
+                    del self.subscribers[k]
+
+    def _publish(self, x, y, event):
+        k = (x // self.chunk, y // self.chunk)
+        if k in self.subscribers:
+            self.dirty.setdefault(k, []).append(event)
+
+    def _on_event(self, kind, *args):
+        st = self.state
+        if kind == 'entity_added':
+            eid, x, y = args
+            e = st.entities[eid]
+            for client in self.clients.get(e.get('owner'), ()):
+                self._watch(client, eid, e)
+            self._publish(x, y, [kind, eid, x, y, e['type'], e.get('owner')])
+        elif kind == 'entity_moved':
+            eid, ox, oy, x, y = args
+            w = self.watchers.get(eid)
+            if w is not None:
+                client, radius, chunks = w
+                new = _chunks_around(x, y, radius, self.chunk)
+                if new != chunks:
+                    self._subscribe(client, new - chunks)
+                    self._unsubscribe(client, chunks - new)
+                    self.watchers[eid] = (client, radius, new)
+            if (ox // self.chunk, oy // self.chunk) != (x // self.chunk, y // self.chunk):
+                # for subscribers of the old place entity disappears
+                self._publish(ox, oy, [kind, eid, x, y])
+            self._publish(x, y, [kind, eid, x, y])
+        elif kind == 'entity_removed':
+            eid, x, y, e = args
+            self._publish(x, y, [kind, eid])
+            if eid in self.watchers:
+                self._unwatch(eid)
+        elif kind == 'entity_changed':
+            eid, x, y, key = args
+            self._publish(x, y, [kind, eid, key, st.get_entity_prop(eid, key)])
+        elif kind == 'natural_changed':
+            x, y = args
+            self._publish(x, y, [kind, x, y, int(st.naturalmap[x, y])])
+        elif kind == 'drop_changed':
+            x, y = args
+            self._publish(x, y, [kind, x, y, st.get_energy_drop(x, y)])
+
+    def flush(self):
+        '''
+        Returns (events by chunk, dirty chunks by client) of current tick and starts new one.
+        '''
+        events, self.dirty = self.dirty, {}
+        fanout = {}
+        for k in events:
+            for client in self.subscribers.get(k, ()):
+                fanout.setdefault(client, []).append(k)
+        return events, fanout
+
+    def snapshot(self, chunks):
+        '''
+        Events recreating current content of chunks: entities, walls, roads and drops.
+        Used to resync clients which missed changes.
+        '''
+        st = self.state
+        c = self.chunk
+        w, h = st.naturalmap.shape
+        out = []
+        for cx, cy in chunks:
+            for x in range(cx * c, min((cx + 1) * c, w)):
+                for y in range(cy * c, min((cy + 1) * c, h)):
+                    eid = st.get_entity(x, y)
+                    if eid is not None:
+                        e = st.entities[eid]
+                        out.append(['entity_added', eid, x, y, e['type'], e.get('owner')])
+                    v = st.get_natural(x, y)[0]
+                    if v == NaturalMap.artifical_wall or v == NaturalMap.road:
+                        out.append(['natural_changed', x, y, int(v)])
+                    if v != NaturalMap.natural_wall:
+                        drop = st.get_energy_drop(x, y)
+                        if drop is not None:
+                            out.append(['drop_changed', x, y, drop])
+        return out
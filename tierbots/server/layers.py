@@ -0,0 +1,466 @@
+'''
+World layers joined by portals, every layer ticks in its own process.
+
+Each layer is separate ServerState folder (root/layer0, root/layer1, ...).
+Layer manager holds client connections in asyncio loop and talks to layer processes
+with tuple messages over queues:
+
+    manager -> layer
+        ('attach', conn, token)                 updates of player's entities go to conn
+        ('detach', conn)
+        ('register', conn, nickname, token)     answered by ('registered', layer, conn, error),
+                                                error is None, 'taken' or 'full'
+        ('cmd', conn, seq, command)
+        ('open_portal', other layer)            answered by ('portal_opened', layer, x, y, other layer)
+        ('link_portal', x, y, other layer, other x, other y)
+        ('arrive', token, nickname, entity, x, y)
+        ('stop', )
+
+    layer -> manager
+        ('ready', layer, players)               players is list of (nickname, token)
+        ('player_added', layer, nickname, token)    guest came through portal
+        ('player_removed', layer, nickname)     last entity of player in layer is gone
+        ('update', conn, message)               per-tick protocol message, see protocol module
+        ('handover', other layer, x, y, token, nickname, entity)
+        ('population', layer, bots)
+
+Bot stepping onto linked portal leaves its layer and arrives next to the other end,
+under new entity ID. New layer is spun up when every layer holds enough bots.
+Manager indexes nicknames and tokens of players of all layers, so nickname is unique
+across layers and only known tokens can log in.
+'''
+from multiprocessing import get_context
+from os import listdir, makedirs
+from os.path import join
+from time import perf_counter
+import argparse
+import asyncio
+import queue
+import secrets
+
+from ..const import Actions, EntityTypes, NaturalMap, Entities, Direction
+from ..protocol import PORT, MAX_LINE, encode, decode, parse_command
+from .state import ServerState
+from .engine import Engine
+from .main import make_update
+
+
+def layer_folder(root, layer):
+    return join(root, 'layer{}'.format(layer))
+
+
+def _free_cell_near(state, x, y, radius=3):
+    for r in range(1, radius + 1):
+        for dx in range(-r, r + 1):
+            for dy in range(-r, r + 1):
+                if max(abs(dx), abs(dy)) != r:
+                    continue
+                k = (x + dx, y + dy)
+                if state.passability.free(*k):
+                    return k
+    return None
+
+
+def _free_cell(state, tries=100):
+    w, h = state.naturalmap.shape
+    for i in range(tries):
+        k = secrets.randbelow(w), secrets.randbelow(h)
+        if k not in state._ent_map and state.get_natural(*k)[0] == NaturalMap.ground:
+            return k
+    return None
+
+
+class Layer:
+    '''
+    Runs inside layer process.
+    '''
+    population_interval = 10
+
+    def __init__(self, layer, state, outbox):
+        self.layer = layer
+        self.state = state
+        self.outbox = outbox
+        self.engine = Engine(state)
+        self.engine.phases.insert(0, ('portal', self._phase_portal))
+        self.engine.listeners.append(self._on_tick)
+        state.observers.append(self._on_event)
+        # conn -> token, pending acks, rejected
+        self.conns = {}
+
+    def _player(self, token, nickname=None):
+        players = self.state.players
+        p = players.by_token(token)
+        if p is not None or nickname is None:
+            return p
+        # guest coming through portal, layer capacity doesn't apply
+        idx = players.add(nickname, token, grow=True)
+        if idx is None:
+            return None
+        self.outbox.put(('player_added', self.layer, nickname, token))
+        return players.get(idx)
+
+    def handle(self, msg):
+        kind, args = msg[0], msg[1:]
+        getattr(self, '_on_' + kind)(*args)
+
+    def _on_attach(self, conn, token):
+        self.conns[conn] = [token, [], []]
+
+    def _on_detach(self, conn):
+        self.conns.pop(conn, None)
+
+    def _on_register(self, conn, nickname, token):
+        st = self.state
+        if st.players.by_nickname(nickname) is not None:
+            error = 'taken'
+        elif st.place_new_player_base(nickname, token) is None:
+            error = 'full'
+        else:
+            error = None
+        self.outbox.put(('registered', self.layer, conn, error))
+
+    def _on_cmd(self, conn, seq, cmd):
+        c = self.conns.get(conn)
+        if c is None:
+            return
+        p = self._player(c[0])
+        if p is None or cmd[0] not in p['entities']:
+            c[2].append(seq)
+            return
+        self.engine.queue_command(cmd)
+        c[1].append(seq)
+
+    def _on_open_portal(self, other):
+        k = _free_cell(self.state)
+        if k is not None:
+            self.state.place_new_entity({'type': int(EntityTypes.portal), 'link': None}, *k)
+            self.outbox.put(('portal_opened', self.layer, k[0], k[1], other))
+
+    def _on_link_portal(self, x, y, other, ox, oy):
+        eid = self.state.get_entity(x, y)
+        self.state.entities[eid]['link'] = (other, ox, oy)
+
+    def _on_arrive(self, token, nickname, entity, x, y):
+        st = self.state
+        k = _free_cell_near(st, x, y) or _free_cell(st)
+        if k is None:
+            # nowhere to stand, bot is lost
+            return
+        p = self._player(token, nickname)
+        if p is None:
+            # nickname is taken by somebody else here
+            return
+        lifetime = entity.pop('lifetime', Entities.bot_lifetime)
+        entity['owner'] = p['index']
+        eid = st.place_new_entity(entity, *k)
+        st.set_lazy_prop(eid, 'lifetime', lifetime)
+
+    def _phase_portal(self, by_action):
+        st = self.state
+        moves = by_action.get(Actions.move)
+        if not moves:
+            return
+        staying = []
+        for c in moves:
+            e = st.entities.get(c[0])
+            offset = Direction.offset(c[2])
+            if e is None or offset is None:
+                continue
+            tid = st.get_entity(e['x'] + offset[0], e['y'] + offset[1])
+            target = None if tid is None else st.entities[tid]
+            if target is None or target['type'] != EntityTypes.portal or target.get('link') is None:
+                staying.append(c)
+                continue
+            p = st.players.get(e.get('owner', -1))
+            if p is None:
+                # owner without registered player has nobody to hand bot over to
+                staying.append(c)
+                continue
+            entity = st.get_entity_by_id(c[0])
+            del entity['owner'], entity['x'], entity['y']
+            st.remove_entity(c[0])
+            other, ox, oy = target['link']
+            self.outbox.put(('handover', other, ox, oy, p['token'], p['nickname'], entity))
+        by_action[Actions.move] = staying
+
+    def _on_event(self, kind, *args):
+        if kind == 'player_removed':
+            self.outbox.put(('player_removed', self.layer, args[1]['nickname']))
+
+    def _on_tick(self, time, commands):
+        st = self.state
+        for conn, c in self.conns.items():
+            p = self._player(c[0])
+            if p is None or not (p['entities'] or c[1] or c[2]):
+                continue
+            msg = make_update(st, p, time, c[1], c[2])
+            msg['layer'] = self.layer
+            self.outbox.put(('update', conn, msg))
+            c[1], c[2] = [], []
+        if time % self.population_interval == 0:
+            bots = sum(1 for e in st.entities.values() if e['type'] == EntityTypes.bot)
+            self.outbox.put(('population', self.layer, bots))
+
+
+def run_layer(layer, foldername, inbox, outbox, tick_interval=0.1, new_size=None):
+    '''
+    Entry point of layer process.
+    '''
+    if new_size is not None:
+        state = ServerState.create_new(foldername, *new_size)
+    else:
+        state = ServerState.load(foldername)
+    lr = Layer(layer, state, outbox)
+    outbox.put(('ready', layer, [(p['nickname'], p['token']) for p in state.players]))
+    deadline = perf_counter()
+    while True:
+        deadline += tick_interval
+        while True:
+            timeout = deadline - perf_counter()
+            try:
+                msg = inbox.get(timeout=timeout) if timeout > 0 else inbox.get_nowait()
+            except queue.Empty:
+                break
+            if msg[0] == 'stop':
+                state.save()
+                return
+            lr.handle(msg)
+        if perf_counter() > deadline + tick_interval:
+            # overloaded, don't try to catch up
+            deadline = perf_counter()
+        lr.engine.tick()
+
+
+class LayerManager:
+    def __init__(self, root, tick_interval=0.1, layer_size=(8, 8), capacity=200):
+        self.root = root
+        self.tick_interval = tick_interval
+        self.layer_size = layer_size
+        # bots per layer before new one is needed
+        self.capacity = capacity
+        # layers must not inherit asyncio loop and its threads
+        self.mp = get_context('spawn')
+        self.outbox = self.mp.Queue()
+        # layer -> (process, inbox)
+        self.layers = {}
+        self.population = {}
+        self._ready = {}
+        self._portals = {}
+        self._spawning = None
+        # conn -> [writer, token, {eid: layer}, rejected]
+        self.conns = {}
+        self._registered = {}
+        self._conn_ids = 0
+        # nickname -> [token, layers holding the player], taken by registration in progress too
+        self.nicknames = {}
+        # token -> nickname
+        self.tokens = {}
+
+    def _send(self, layer, msg):
+        self.layers[layer][1].put(msg)
+
+    def _broadcast(self, msg):
+        for layer in self.layers:
+            self._send(layer, msg)
+
+    def start_layer(self, layer, new=False):
+        inbox = self.mp.Queue()
+        p = self.mp.Process(target=run_layer, args=(
+            layer, layer_folder(self.root, layer), inbox, self.outbox, self.tick_interval,
+            self.layer_size if new else None,
+        ), daemon=True)
+        p.start()
+        self.layers[layer] = (p, inbox)
+        self.population[layer] = 0
+        self._ready[layer] = asyncio.get_running_loop().create_future()
+        for conn, c in self.conns.items():
+            self._send(layer, ('attach', conn, c[1]))
+        return self._ready[layer]
+
+    async def start(self):
+        makedirs(self.root, exist_ok=True)
+        existing = sorted(
+            int(n[len('layer'):]) for n in listdir(self.root) if n.startswith('layer')
+        )
+        for layer in existing:
+            self.start_layer(layer)
+        if not existing:
+            self.start_layer(0, new=True)
+        asyncio.ensure_future(self._pump())
+        await asyncio.gather(*self._ready.values())
+
+    async def spawn_layer(self):
+        '''
+        Creates new layer linked by portal to the most populated one.
+        '''
+        if self._spawning is None:
+            layer = max(self.layers) + 1
+            partner = max(self.population, key=self.population.get)
+            self._spawning = asyncio.ensure_future(self._spawn(layer, partner))
+        await asyncio.shield(self._spawning)
+
+    async def _spawn(self, layer, partner):
+        await self.start_layer(layer, new=True)
+        self._send(layer, ('open_portal', partner))
+        self._send(partner, ('open_portal', layer))
+        self._spawning = None
+
+    async def _pump(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            msg = await loop.run_in_executor(None, self.outbox.get)
+            getattr(self, '_on_' + msg[0])(*msg[1:])
+
+    def _on_ready(self, layer, players):
+        for nickname, token in players:
+            self._add_player(layer, nickname, token)
+        self._ready[layer].set_result(True)
+
+    def _add_player(self, layer, nickname, token):
+        self.nicknames.setdefault(nickname, [token, set()])[1].add(layer)
+        self.tokens[token] = nickname
+
+    def _on_player_added(self, layer, nickname, token):
+        self._add_player(layer, nickname, token)
+
+    def _on_player_removed(self, layer, nickname):
+        p = self.nicknames.get(nickname)
+        if p is None:
+            return
+        p[1].discard(layer)
+        if not p[1]:
+            del self.nicknames[nickname]
+            del self.tokens[p[0]]
+
+    def _on_update(self, conn, msg):
+        c = self.conns.get(conn)
+        if c is None:
+            return
+        routes = c[2]
+        for eid in [eid for eid, layer in routes.items() if layer == msg['layer']]:
+            del routes[eid]
+        for eid in msg['bots']:
+            routes[eid] = msg['layer']
+        if c[3]:
+            msg.setdefault('rejected', []).extend(c[3])
+            c[3] = []
+        c[0].write(encode(msg))
+
+    def _on_registered(self, layer, conn, error):
+        f = self._registered.pop(conn, None)
+        if f is not None:
+            f.set_result(error)
+
+    def _on_handover(self, layer, x, y, token, nickname, entity):
+        self._send(layer, ('arrive', token, nickname, entity, x, y))
+
+    def _on_portal_opened(self, layer, x, y, other):
+        k = frozenset((layer, other))
+        ends = self._portals.setdefault(k, {})
+        ends[layer] = (x, y)
+        if len(ends) == 2:
+            del self._portals[k]
+            self._send(layer, ('link_portal', x, y, other) + ends[other])
+            self._send(other, ('link_portal', ) + ends[other] + (layer, x, y))
+
+    def _on_population(self, layer, bots):
+        self.population[layer] = bots
+        if self._spawning is None and min(self.population.values()) >= self.capacity:
+            asyncio.ensure_future(self.spawn_layer())
+
+    async def _register(self, conn, nickname, token):
+        if nickname in self.nicknames:
+            return False
+        # reserved while layers are asked
+        self._add_player(None, nickname, token)
+        try:
+            return await self._place(conn, nickname, token)
+        finally:
+            self._on_player_removed(None, nickname)
+
+    async def _place(self, conn, nickname, token):
+        loop = asyncio.get_running_loop()
+        for attempt in range(2):
+            for layer in sorted(self.layers, key=self.population.get):
+                f = self._registered[conn] = loop.create_future()
+                self._send(layer, ('register', conn, nickname, token))
+                error = await f
+                if error is None:
+                    self._add_player(layer, nickname, token)
+                    return True
+                if error == 'taken':
+                    return False
+            # every layer is full
+            await self.spawn_layer()
+        return False
+
+    async def client_session(self, reader, writer):
+        self._conn_ids += 1
+        conn = self._conn_ids
+        try:
+            hello = decode(await reader.readline())
+            if 'register' in hello:
+                token = secrets.token_hex(16)
+                if not await self._register(conn, str(hello['register'])[:32], token):
+                    raise ValueError('nickname taken or no room')
+            else:
+                token = hello.get('login')
+                if not isinstance(token, str) or token not in self.tokens:
+                    raise ValueError('unknown token')
+        except (ValueError, AttributeError):
+            writer.write(encode({'error': 'login failed'}))
+            writer.close()
+            return
+        writer.write(encode({'token': token}))
+        c = self.conns[conn] = [writer, token, {}, []]
+        self._broadcast(('attach', conn, token))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                msg = decode(line)
+                cmd = parse_command(msg.get('cmd'))
+                layer = None if cmd is None else c[2].get(cmd[0])
+                if layer is None:
+                    c[3].append(msg.get('seq'))
+                    continue
+                self._send(layer, ('cmd', conn, msg.get('seq'), cmd))
+        except (ValueError, AttributeError, ConnectionError):
+            pass
+        finally:
+            del self.conns[conn]
+            self._broadcast(('detach', conn))
+            writer.close()
+
+    def stop(self):
+        self._broadcast(('stop', ))
+        for p, inbox in self.layers.values():
+            p.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve world layers, one process each')
+    parser.add_argument('root', help='folder with layer0, layer1, ...')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--tick', type=float, default=0.1, help='tick interval in seconds')
+    parser.add_argument('--layer-size', type=int, nargs=2, default=(8, 8), metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--capacity', type=int, default=200, help='bots per layer before spinning up new one')
+    args = parser.parse_args()
+
+    manager = LayerManager(args.root, args.tick, tuple(args.layer_size), args.capacity)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(manager.start())
+    server = loop.run_until_complete(asyncio.start_server(manager.client_session, '0.0.0.0', args.port, limit=MAX_LINE))
+    print('Serving {} layers on {}'.format(len(manager.layers), server.sockets[0].getsockname()))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    server.close()
+    manager.stop()
+
+
+if __name__ == '__main__':
+    main()
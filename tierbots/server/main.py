@@ -1,24 +1,240 @@
+import argparse
 import asyncio
+import base64
+import secrets
 
+from ..const import EntityTypes, Entities, Filenames
+from ..protocol import PORT, MAX_LINE, encode, decode, parse_command
+from ..botconfig import configs
+from .state import ServerState
+from .chunks import LazyNaturalMap
+from .engine import Engine
+from .interest import InterestManager
+from .output import OutputStage
+from .players import PlayerStore
+from .radar import SummaryPyramid
+from .replay import Recorder
+from .sharedmem import SharedState, WorkerPool
+from .profiler import Profiler, start_stats_server
 
-async def client_session(reader, writer):
-    data = await reader.read(100)
-    message = data.decode()
-    addr = writer.get_extra_info('peername')
-    print("Received %r from %r" % (message, addr))
 
-    print("Send: %r" % message)
-    writer.write(data)
-    await writer.drain()
+profiler = Profiler(enabled=False)
 
-    print("Close the client socket")
-    writer.close()
+# radar summaries are sent every this many ticks
+RADAR_INTERVAL = 10
 
 
-def run_server():
-    loop = asyncio.get_event_loop()
-    coro = asyncio.start_server(client_session, '0.0.0.0', 8888, loop=loop)
+def make_update(state, player, time, acks, rejected):
+    '''
+    Per-tick message for player's connection.
+    '''
+    bots = {
+        eid: [state.entities[eid]['x'], state.entities[eid]['y'], state.get_entity_prop(eid, 'hp')]
+        for eid in player['entities'] if state.entities[eid]['type'] == EntityTypes.bot
+    }
+    msg = {'tick': time, 'acks': acks, 'bots': bots}
+    if rejected:
+        msg['rejected'] = rejected
+    return msg
+
+
+class Session:
+    def __init__(self, writer, player, index):
+        self.writer = writer
+        self.player = player
+        self.index = index
+        # sequence numbers of commands queued for the next tick
+        self.pending = []
+        self.rejected = []
+
+
+class GameServer:
+    def __init__(self, state, tick_interval=0.1, workers=0):
+        '''
+        workers > 0 moves map to shared memory and computes sight views of clients
+        in that many processes during read-only phase after every tick, dense worlds only.
+        '''
+        self.state = state
+        self.engine = Engine(state)
+        self.tick_interval = tick_interval
+        self.sessions = set()
+        # (nickname, token, future) waiting for the next tick
+        self.registrations = []
+        self.interest = InterestManager(state)
+        self.radar = SummaryPyramid(state)
+        self.output = OutputStage(self._resync, profiler=profiler)
+        # replay.Recorder capturing traffic, if any
+        self.recorder = None
+        self.shared = self.pool = None
+        if workers:
+            self.shared = SharedState(state)
+            self.pool = WorkerPool(self.shared, workers)
+        self.engine.listeners.append(self._on_tick)
+        state.observers.append(self._on_event)
+        # evaluated only when stats are read
+        profiler.watch_hit_rate('config_cache_hit_rate', configs)
+        if isinstance(state.naturalmap, LazyNaturalMap):
+            profiler.watch('chunks_generated', lambda: len(state.naturalmap.chunks))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            # state gets private arrays back
+            self.shared.close()
+
+    async def _login(self, hello):
+        st = self.state
+        if 'register' in hello:
+            # bases are placed in batch at the start of next tick
+            future = asyncio.get_running_loop().create_future()
+            self.registrations.append((str(hello['register'])[:32], secrets.token_hex(16), future))
+            idx = await future
+            return None if idx is None else st.players.get(idx)
+        return st.players.by_token(hello.get('login'))
+
+    def _register_pending(self):
+        batch, self.registrations = self.registrations, []
+        if batch:
+            players = [(nickname, token) for nickname, token, f in batch]
+            if self.recorder is not None:
+                self.recorder.registered(players)
+            placed = self.state.place_new_player_bases(players)
+            for (nickname, token, future), idx in zip(batch, placed):
+                if not future.done():
+                    future.set_result(idx)
+
+    async def client_session(self, reader, writer):
+        try:
+            player = await self._login(decode(await reader.readline()))
+        except ValueError:
+            player = None
+        if player is None:
+            writer.write(encode({'error': 'login failed'}))
+            writer.close()
+            return
+        index = player['index']
+        writer.write(encode({'token': player['token'], 'player': index}))
+        session = Session(writer, player, index)
+        self.sessions.add(session)
+        self.interest.attach(session, index)
+        self.output.add(session, writer)
+        profiler.gauge('sessions', len(self.sessions))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                msg = decode(line)
+                cmd = parse_command(msg.get('cmd'))
+                if cmd is None or cmd[0] not in player['entities']:
+                    session.rejected.append(msg.get('seq'))
+                    continue
+                self.engine.queue_command(cmd)
+                session.pending.append(msg.get('seq'))
+                profiler.count('commands_received')
+        except (ValueError, AttributeError, ConnectionError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            self._close_session(session)
+
+    def _close_session(self, session):
+        self.sessions.discard(session)
+        self.interest.detach(session)
+        self.output.remove(session)
+        profiler.gauge('sessions', len(self.sessions))
+        session.writer.close()
+
+    def _on_event(self, kind, *args):
+        if kind == 'player_removed':
+            # slot goes to the next registration, sessions of removed player must not follow it
+            for session in [s for s in self.sessions if s.index == args[0]]:
+                session.writer.write(encode({'error': 'player removed'}))
+                self._close_session(session)
+
+    def _resync(self, session):
+        return {'tick': self.state.time, 'resync': self.interest.snapshot(self.interest.chunks_of(session))}
+
+    def _radar_scans(self, session):
+        st = self.state
+        scans = []
+        for eid in session.player['entities']:
+            e = st.entities[eid]
+            if e['type'] == EntityTypes.radar:
+                rows = self.radar.scan(session.index, e['x'], e['y'], Entities.radar_range)
+                scans.append([e['x'], e['y'], self.radar.levels[0], rows])
+        return scans
+
+    def _views(self, sessions):
+        # read-only phase, workers build sight views of all clients at once
+        st = self.state
+        watchers = [[
+            [st.entities[eid]['x'], st.entities[eid]['y']]
+            for eid in s.player['entities'] if st.entities[eid]['type'] == EntityTypes.bot
+        ] for s in sessions]
+        frames = self.pool.read_phase(frames=watchers)[2]
+        return {
+            s: {'radius': Entities.sight_range, 'watchers': w, 'cells': base64.b64encode(f).decode()}
+            for s, w, f in zip(sessions, watchers, frames)
+        }
+
+    def _on_tick(self, time, commands):
+        events, fanout = self.interest.flush()
+        # every chunk update is encoded once for all its subscribers
+        frames = {k: encode({'tick': time, 'chunk': k, 'changes': ev}) for k, ev in events.items()}
+        sessions = list(self.sessions)
+        views = self._views(sessions) if self.pool is not None and sessions else {}
+        for session in sessions:
+            msg = make_update(self.state, session.player, time, session.pending, session.rejected)
+            if session in views:
+                msg['view'] = views[session]
+            if time % RADAR_INTERVAL == 0:
+                # part of own update, so throttled client keeps latest scans
+                scans = self._radar_scans(session)
+                if scans:
+                    msg['radar'] = scans
+            self.output.send(session, msg, [frames[k] for k in fanout.get(session, ())])
+            session.pending, session.rejected = [], []
+        self.output.flush()
+
+    async def tick_loop(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        while True:
+            self._register_pending()
+            self.engine.tick()
+            deadline += self.tick_interval
+            delay = deadline - loop.time()
+            if delay < 0:
+                # overloaded, don't try to catch up
+                profiler.count('ticks_late')
+                deadline = loop.time()
+            await asyncio.sleep(max(delay, 0))
+
+
+def run_server(foldername, port=PORT, tick_interval=0.1, stats_port=None, new_size=None, streaming=False,
+               players_db=False, record=None, workers=0, slowest=0, profile_dir='profiles'):
+    if new_size is not None:
+        state = ServerState.create_new(foldername, *new_size, streaming=streaming)
+    else:
+        state = ServerState.load(foldername)
+    if players_db:
+        state.players.attach_store(PlayerStore(state._get_filename(Filenames.players_db)))
+    game = GameServer(state, tick_interval, workers)
+    if record is not None:
+        game.recorder = Recorder(game.engine, record)
+        print('Recording into {}'.format(record))
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    coro = asyncio.start_server(game.client_session, '0.0.0.0', port, limit=MAX_LINE)
     server = loop.run_until_complete(coro)
+    if stats_port is not None or slowest:
+        profiler.enabled = True
+        profiler.slowest = slowest
+        game.engine.profiler = profiler
+    if stats_port is not None:
+        loop.run_until_complete(start_stats_server(profiler, stats_port))
+        print('Stats on 127.0.0.1:{}'.format(stats_port))
+    ticker = loop.create_task(game.tick_loop())
 
     # Serve requests until Ctrl+C is pressed
     print('Serving on {}'.format(server.sockets[0].getsockname()))
@@ -28,10 +244,38 @@ def run_server():
         pass
 
     # Close the server
+    ticker.cancel()
+    loop.run_until_complete(asyncio.gather(ticker, return_exceptions=True))
     server.close()
     loop.run_until_complete(server.wait_closed())
     loop.close()
+    if game.recorder is not None:
+        game.recorder.close()
+    game.close()
+    if slowest:
+        for fn in profiler.dump_slowest(profile_dir):
+            print('Profile written to', fn)
+    state.save()
+    if state.players.store is not None:
+        state.players.store.close()
 
 
 if __name__ == '__main__':
-    run_server()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('foldername', help='world folder, see ServerState.create_new')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--tick', type=float, default=0.1, help='tick interval in seconds')
+    parser.add_argument('--stats-port', type=int, help='serve local stats endpoint on this port')
+    parser.add_argument('--new', type=int, nargs=2, metavar=('WIDTH', 'HEIGHT'), help='create new world of this many cells')
+    parser.add_argument('--streaming', action='store_true', help='new world is generated on first touch')
+    parser.add_argument('--players-db', action='store_true', help='mirror player registry into sqlite database')
+    parser.add_argument('--record', metavar='FOLDER', help='record traffic for replay, see replay module')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='compute sight views of clients in this many shared-memory workers, dense worlds only')
+    parser.add_argument('--profile-slowest', type=int, default=0, metavar='N',
+                        help='dump cProfile of N slowest ticks on exit')
+    parser.add_argument('--profile-dir', default='profiles')
+    args = parser.parse_args()
+    run_server(args.foldername, port=args.port, tick_interval=args.tick, stats_port=args.stats_port, new_size=args.new,
+               streaming=args.streaming, players_db=args.players_db, record=args.record, workers=args.workers,
+               slowest=args.profile_slowest, profile_dir=args.profile_dir)
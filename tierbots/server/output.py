@@ -0,0 +1,121 @@
+'''
+Output stage: per-tick writes to all clients.
+
+Chunk updates are encoded once into immutable bytes shared by every subscriber,
+each client only collects references and gets them in single writelines() call per tick.
+
+Client whose transport buffer grows over high water mark is throttled: its chunk frames
+are dropped and its own updates are merged (acks accumulate, bots are replaced by latest).
+When buffer drains under low water mark, client gets merged update and resync frame rebuilding
+everything it missed. Client which stays throttled too many ticks or piles up too many acks
+meanwhile is disconnected, so memory stays bounded.
+'''
+from ..protocol import encode
+
+
+class ClientBuffer:
+    def __init__(self, writer):
+        self.writer = writer
+        self.frames = []
+        # merged update held back while throttled
+        self.held = None
+        self.throttled = False
+        # ticks spent throttled in a row
+        self.throttled_ticks = 0
+        self.stale = False
+
+
+def merge_updates(old, new):
+    '''
+    Latest radar scans and view are kept, even if newer update doesn't have them.
+
+    >>> merge_updates({'tick': 1, 'acks': [1], 'bots': {}}, {'tick': 2, 'acks': [2], 'rejected': [3], 'bots': {5: 1}})
+    {'tick': 2, 'acks': [1, 2], 'rejected': [3], 'bots': {5: 1}}
+    >>> merge_updates({'tick': 1, 'radar': [[1, 2, 8, []]]}, {'tick': 2})
+    {'tick': 2, 'radar': [[1, 2, 8, []]]}
+    '''
+    out = dict(new)
+    for k in ('acks', 'rejected'):
+        if k in old or k in new:
+            out[k] = old.get(k, []) + new.get(k, [])
+    for k in ('radar', 'view'):
+        if k in old and k not in new:
+            out[k] = old[k]
+    return out
+
+
+class OutputStage:
+    '''
+    resync is called with client, returns message rebuilding its view.
+    Throttled client is disconnected after max_throttled ticks or max_held held acks.
+    '''
+    def __init__(self, resync, high_water=256 * 1024, low_water=32 * 1024, max_throttled=100, max_held=10000,
+                 profiler=None):
+        self.resync = resync
+        self.high_water = high_water
+        self.low_water = low_water
+        self.max_throttled = max_throttled
+        self.max_held = max_held
+        self.profiler = profiler
+        self.clients = {}
+
+    def add(self, client, writer):
+        self.clients[client] = ClientBuffer(writer)
+
+    def remove(self, client):
+        self.clients.pop(client, None)
+
+    def send(self, client, update, frames=()):
+        '''
+        Queues client's own update message and shared frames (bytes) for this tick.
+        '''
+        buf = self.clients.get(client)
+        if buf is None:
+            # disconnected, session isn't closed yet
+            return
+        size = buf.writer.transport.get_write_buffer_size()
+        if size > self.high_water:
+            buf.throttled = True
+        elif size <= self.low_water:
+            buf.throttled = False
+        if buf.held is not None:
+            update = merge_updates(buf.held, update)
+            buf.held = None
+        if buf.throttled:
+            buf.held = update
+            buf.throttled_ticks += 1
+            if frames:
+                buf.stale = True
+                self._count('frames_dropped', len(frames))
+            held = len(update.get('acks', ())) + len(update.get('rejected', ()))
+            if buf.throttled_ticks > self.max_throttled or held > self.max_held:
+                self._disconnect(client)
+            return
+        buf.throttled_ticks = 0
+        buf.frames.append(encode(update))
+        if buf.stale:
+            # everything in frames of this tick is part of resync
+            buf.frames.append(encode(self.resync(client)))
+            buf.stale = False
+            self._count('resyncs')
+        else:
+            buf.frames.extend(frames)
+
+    def _disconnect(self, client):
+        buf = self.clients.pop(client)
+        # reader of session sees connection lost and cleans up
+        buf.writer.transport.abort()
+        self._count('disconnects')
+
+    def flush(self):
+        sent = 0
+        for buf in self.clients.values():
+            if buf.frames:
+                buf.writer.writelines(buf.frames)
+                sent += sum(len(f) for f in buf.frames)
+                buf.frames = []
+        self._count('bytes_sent', sent)
+
+    def _count(self, name, value=1):
+        if self.profiler is not None:
+            self.profiler.count(name, value)
@@ -0,0 +1,206 @@
+'''
+Passability map: which cells a bot can step into and what stepping there costs.
+
+Every cell keeps blocked bits, WALL for natural and live artificial walls and ENTITY
+for any entity there, and move cost, zero on live roads and Entities.move_stamina_cost
+elsewhere. By game rules bots share cells only with roads and drops, so drops
+are not tracked and cell is passable when no bit is set. Buildings and construction
+sites may stand on roads, placing them needs the same check.
+
+ServerState updates bits and costs on every mutation, like it does player ownership,
+moves of whole tick are applied at once. Walls and roads turn into ground at their
+death time, so movement, placement and spawning read whole windows instead of checking
+naturalmap, death times and entity map cell by cell.
+
+Dense worlds are kept in single tile. Streaming worlds are kept in tiles of WorldSize.cell,
+built on first use, so they pay only for areas in play. Tile of cell with entity is always
+built, fresh tiles never have to look for entities.
+'''
+import heapq
+import numpy
+
+from ..const import NaturalMap, Entities, WorldSize
+from .chunks import LazyNaturalMap, live_times
+
+
+WALL = 1
+ENTITY = 2
+# masks clearing one bit of uint8
+_NO_WALL = 0xff ^ WALL
+_NO_ENTITY = 0xff ^ ENTITY
+
+
+class PassabilityMap:
+    '''
+    >>> from types import SimpleNamespace
+    >>> nm = numpy.ones((64, 64), dtype=numpy.uint8)
+    >>> nm[0, 1] = NaturalMap.natural_wall
+    >>> st = SimpleNamespace(naturalmap=nm, wall_road_ext_times=numpy.zeros((64, 64)), time=0, _ent_map={(0, 2): 7})
+    >>> pm = PassabilityMap(st)
+    >>> pm.window(0, 0, 1, 4)[0].tolist(), pm.free(0, 3)
+    ([[0, 1, 2, 0]], True)
+    >>> pm.set_entities([0], [2], False)
+    >>> pm.set_entities([0], [3], True)
+    >>> pm.window(0, 0, 1, 4)[0].tolist()
+    [[0, 1, 0, 2]]
+    '''
+    def __init__(self, state):
+        self.state = state
+        # (tx, ty) -> (blocked bits, move cost), arrays (tile, tile) cut at map edge
+        self.tiles = {}
+        # (x, y) -> death time of live artificial wall or road
+        self.deaths = {}
+        # (death time, x, y)
+        self.expiry = []
+        self._lazy = isinstance(state.naturalmap, LazyNaturalMap)
+        if self._lazy:
+            self.tile = t = WorldSize.cell
+            for x, y in list(state._ent_map):
+                self._tile(x // t, y // t)
+        else:
+            self.tile = max(state.naturalmap.shape)
+            self._tile(0, 0)
+        # read again, building tiles may generate chunks with sources
+        cells = list(state._ent_map)
+        self.set_entities([x for x, y in cells], [y for x, y in cells], True)
+
+    def _tile(self, tx, ty):
+        arrays = self.tiles.get((tx, ty))
+        if arrays is not None:
+            return arrays
+        t = self.tile
+        st = self.state
+        w, h = st.naturalmap.shape
+        x0, y0 = tx * t, ty * t
+        x1, y1 = min(x0 + t, w), min(y0 + t, h)
+        blocked = numpy.zeros((x1 - x0, y1 - y0), dtype=numpy.uint8)
+        cost = numpy.full((x1 - x0, y1 - y0), Entities.move_stamina_cost, dtype=numpy.uint8)
+        # registered before naturalmap is read, generating chunk adds its sources
+        arrays = self.tiles[tx, ty] = (blocked, cost)
+        if self._lazy:
+            nat = st.naturalmap.window(x0, y0, x1, y1)
+        else:
+            nat = st.naturalmap[x0:x1, y0:y1]
+        # dead artificial walls are ground until get_natural notices, live ones are set below
+        blocked |= (nat == NaturalMap.natural_wall).astype(numpy.uint8) * WALL
+        for x, y, death_time in live_times(st.wall_road_ext_times, st.time, x0, y0, x1, y1):
+            self._set_terrain(x, y, nat[x - x0, y - y0], death_time)
+        return arrays
+
+    def _set_terrain(self, x, y, v, death_time):
+        t = self.tile
+        blocked, cost = self._tile(x // t, y // t)
+        lx, ly = x % t, y % t
+        self.deaths.pop((x, y), None)
+        live = death_time > self.state.time
+        if v == NaturalMap.natural_wall or (v == NaturalMap.artifical_wall and live):
+            blocked[lx, ly] |= WALL
+        else:
+            blocked[lx, ly] &= _NO_WALL
+        cost[lx, ly] = 0 if v == NaturalMap.road and live else Entities.move_stamina_cost
+        if live and (v == NaturalMap.artifical_wall or v == NaturalMap.road):
+            self.deaths[x, y] = int(death_time)
+            heapq.heappush(self.expiry, (int(death_time), x, y))
+
+    def natural_changed(self, x, y):
+        st = self.state
+        self._set_terrain(x, y, st.naturalmap[x, y], st.wall_road_ext_times[x, y])
+
+    def set_entity(self, x, y, present):
+        t = self.tile
+        blocked = self._tile(x // t, y // t)[0]
+        if present:
+            blocked[x % t, y % t] |= ENTITY
+        else:
+            blocked[x % t, y % t] &= _NO_ENTITY
+
+    def _groups(self, xs, ys):
+        # yields (tile arrays, local xs, local ys) of cells grouped by tile
+        if not self._lazy:
+            yield self.tiles[0, 0], xs, ys
+            return
+        t = self.tile
+        kx, ky = xs // t, ys // t
+        for k in set(zip(kx.tolist(), ky.tolist())):
+            sel = (kx == k[0]) & (ky == k[1])
+            yield self._tile(*k), xs[sel] % t, ys[sel] % t
+
+    def set_entities(self, xs, ys, present):
+        '''
+        Sets or clears ENTITY bit of many cells at once.
+        '''
+        xs, ys = numpy.asarray(xs, dtype=numpy.int64), numpy.asarray(ys, dtype=numpy.int64)
+        for (blocked, cost), lx, ly in self._groups(xs, ys):
+            if present:
+                blocked[lx, ly] |= ENTITY
+            else:
+                blocked[lx, ly] &= _NO_ENTITY
+
+    def refresh(self):
+        '''
+        Turns walls and roads which have died by now into ground.
+        '''
+        time = self.state.time
+        t = self.tile
+        while self.expiry and self.expiry[0][0] <= time:
+            death_time, x, y = heapq.heappop(self.expiry)
+            # later changes leave stale entries
+            if self.deaths.get((x, y)) == death_time:
+                del self.deaths[x, y]
+                blocked, cost = self.tiles[x // t, y // t]
+                blocked[x % t, y % t] &= _NO_WALL
+                cost[x % t, y % t] = Entities.move_stamina_cost
+
+    def window(self, x0, y0, x1, y1):
+        '''
+        (blocked bits, move cost) arrays of rectangle, cells out of map are walls.
+        '''
+        self.refresh()
+        t = self.tile
+        w, h = self.state.naturalmap.shape
+        blocked = numpy.full((x1 - x0, y1 - y0), WALL, dtype=numpy.uint8)
+        cost = numpy.full((x1 - x0, y1 - y0), Entities.move_stamina_cost, dtype=numpy.uint8)
+        cx0, cy0, cx1, cy1 = max(x0, 0), max(y0, 0), min(x1, w), min(y1, h)
+        if cx0 >= cx1 or cy0 >= cy1:
+            return blocked, cost
+        for tx in range(cx0 // t, (cx1 - 1) // t + 1):
+            for ty in range(cy0 // t, (cy1 - 1) // t + 1):
+                b, c = self._tile(tx, ty)
+                ax, ay = max(cx0, tx * t), max(cy0, ty * t)
+                ex, ey = min(cx1, (tx + 1) * t), min(cy1, (ty + 1) * t)
+                src = slice(ax - tx * t, ex - tx * t), slice(ay - ty * t, ey - ty * t)
+                dst = slice(ax - x0, ex - x0), slice(ay - y0, ey - y0)
+                blocked[dst] = b[src]
+                cost[dst] = c[src]
+        return blocked, cost
+
+    def take(self, xs, ys):
+        '''
+        (blocked bits, move cost) at arrays of valid coordinates.
+        '''
+        self.refresh()
+        xs, ys = numpy.asarray(xs, dtype=numpy.int64), numpy.asarray(ys, dtype=numpy.int64)
+        if not self._lazy:
+            b, c = self.tiles[0, 0]
+            return b[xs, ys], c[xs, ys]
+        blocked = numpy.empty(xs.shape, dtype=numpy.uint8)
+        cost = numpy.empty(xs.shape, dtype=numpy.uint8)
+        t = self.tile
+        kx, ky = xs // t, ys // t
+        for k in set(zip(kx.tolist(), ky.tolist())):
+            sel = (kx == k[0]) & (ky == k[1])
+            b, c = self._tile(*k)
+            blocked[sel] = b[xs[sel] % t, ys[sel] % t]
+            cost[sel] = c[xs[sel] % t, ys[sel] % t]
+        return blocked, cost
+
+    def free(self, x, y):
+        '''
+        Bot can step into cell, building can be placed there.
+        '''
+        w, h = self.state.naturalmap.shape
+        if x < 0 or y < 0 or x >= w or y >= h:
+            return False
+        self.refresh()
+        t = self.tile
+        return not self._tile(x // t, y // t)[0][x % t, y % t]
@@ -0,0 +1,203 @@
+'''
+Player registry.
+
+Players live in numbered slots (slot number is 'owner' of entities), with hash indexes
+on token and nickname, free list of slots and set of owned entity IDs per player.
+ServerState keeps ownership up to date, player is deleted when its last entity is gone
+and observers of state get 'player_removed', slot is reused by the next registration.
+
+Registry is pickled along with the rest of state. Optionally it is mirrored
+into sqlite database (WAL mode), written in batches by background thread.
+'''
+from threading import Thread
+from queue import Queue, Empty
+import sqlite3
+
+
+class PlayerRegistry:
+    '''
+    capacity None means unlimited number of players.
+
+    >>> r = PlayerRegistry(capacity=2)
+    >>> r.add('alice', 't1'), r.add('bob', 't2'), r.add('carol', 't3')
+    (0, 1, None)
+    >>> r.own(1, 100)
+    >>> r.by_token('t2')['nickname'], r.owner_of(100)
+    ('bob', 1)
+    >>> r.disown(100)['nickname']
+    'bob'
+    >>> r.by_nickname('bob') is None, r.add('carol', 't3')
+    (True, 1)
+    '''
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self.slots = [None] * (capacity or 0)
+        self._build_indexes()
+
+    def _build_indexes(self):
+        self._free = [i for i in range(len(self.slots) - 1, -1, -1) if self.slots[i] is None]
+        self._by_token = {}
+        self._by_nickname = {}
+        self._owners = {}
+        for p in self:
+            self._by_token[p['token']] = p
+            self._by_nickname[p['nickname']] = p
+            for eid in p['entities']:
+                self._owners[eid] = p['index']
+        self.store = None
+
+    def __getstate__(self):
+        return {'capacity': self.capacity, 'slots': self.slots}
+
+    def __setstate__(self, data):
+        self.__dict__.update(data)
+        self._build_indexes()
+
+    @classmethod
+    def from_list(cls, players):
+        '''
+        Converts old list of player dicts (None for free slot).
+        '''
+        o = cls.__new__(cls)
+        o.capacity = len(players) or None
+        o.slots = [None if p is None else dict(p, index=i) for i, p in enumerate(players)]
+        o._build_indexes()
+        return o
+
+    def __iter__(self):
+        return (p for p in self.slots if p is not None)
+
+    def __len__(self):
+        return len(self.slots) - len(self._free)
+
+    def get(self, index):
+        return self.slots[index] if 0 <= index < len(self.slots) else None
+
+    def by_token(self, token):
+        return self._by_token.get(token)
+
+    def by_nickname(self, nickname):
+        return self._by_nickname.get(nickname)
+
+    def owner_of(self, eid):
+        return self._owners.get(eid)
+
+    def add(self, nickname, token, grow=False):
+        '''
+        Returns slot index, None if there is no free slot or nickname is taken.
+        grow ignores capacity.
+        '''
+        if nickname in self._by_nickname or token in self._by_token:
+            return None
+        if self._free:
+            index = self._free.pop()
+        elif self.capacity is None or grow:
+            index = len(self.slots)
+            self.slots.append(None)
+        else:
+            return None
+        p = self.slots[index] = {'index': index, 'nickname': nickname, 'token': token, 'entities': set()}
+        self._by_token[token] = p
+        self._by_nickname[nickname] = p
+        if self.store is not None:
+            self.store.put(index, nickname, token)
+        return index
+
+    def remove(self, index):
+        p = self.slots[index]
+        self.slots[index] = None
+        self._free.append(index)
+        del self._by_token[p['token']]
+        del self._by_nickname[p['nickname']]
+        for eid in p['entities']:
+            del self._owners[eid]
+        if self.store is not None:
+            self.store.delete(index)
+
+    def own(self, index, eid):
+        p = self.get(index)
+        if p is None:
+            # owner without registered player, e.g. scenario or test entities
+            return
+        p['entities'].add(eid)
+        self._owners[eid] = index
+
+    def disown(self, eid):
+        '''
+        Deletes player who doesn't own anything anymore, returns deleted player.
+        '''
+        index = self._owners.pop(eid, None)
+        if index is None:
+            return None
+        p = self.slots[index]
+        p['entities'].discard(eid)
+        if not p['entities']:
+            self.remove(index)
+            return p
+        return None
+
+    def attach_store(self, store):
+        '''
+        Mirrors registry into PlayerStore from now on.
+        '''
+        self.store = store
+        store.replace_all((p['index'], p['nickname'], p['token']) for p in self)
+
+
+class PlayerStore:
+    '''
+    sqlite mirror of registry. Writes never block tick, they are queued
+    and committed by background thread in batches.
+    '''
+    def __init__(self, filename, interval=0.5):
+        self.filename = filename
+        self.interval = interval
+        self._queue = Queue()
+        with self._connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS players (slot INTEGER PRIMARY KEY, nickname TEXT UNIQUE, token TEXT UNIQUE)')
+        self._thread = Thread(target=self._writer, daemon=True)
+        self._thread.start()
+
+    def _connect(self):
+        db = sqlite3.connect(self.filename)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def put(self, slot, nickname, token):
+        self._queue.put(('INSERT OR REPLACE INTO players VALUES (?, ?, ?)', (slot, nickname, token)))
+
+    def delete(self, slot):
+        self._queue.put(('DELETE FROM players WHERE slot = ?', (slot, )))
+
+    def replace_all(self, rows):
+        self._queue.put(('DELETE FROM players', ()))
+        for row in rows:
+            self.put(*row)
+
+    def close(self):
+        '''
+        Writes everything queued so far.
+        '''
+        self._queue.put(None)
+        self._thread.join()
+
+    def _writer(self):
+        db = self._connect()
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            try:
+                while True:
+                    batch.append(self._queue.get(timeout=self.interval))
+                    if len(batch) >= 1000:
+                        break
+            except Empty:
+                pass
+            if None in batch:
+                running = False
+                batch = batch[:batch.index(None)]
+            with db:
+                for sql, args in batch:
+                    db.execute(sql, args)
+        db.close()
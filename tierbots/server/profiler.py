@@ -0,0 +1,198 @@
+'''
+Tick instrumentation: phase timers, latency histograms, counters and gauges.
+
+Engine without profiler doesn't pay anything, disabled profiler costs one attribute check per phase.
+Stats are served as JSON (or plain text at /text) from the server's own asyncio loop.
+'''
+from contextlib import contextmanager, nullcontext
+from math import log
+from os import makedirs
+from os.path import join
+from time import perf_counter
+import asyncio
+import cProfile
+import heapq
+import json
+
+
+class Histogram:
+    '''
+    Log-scale buckets, about 4% relative error of percentiles.
+    '''
+    base = 1.04
+    min_value = 1e-6
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        b = 0 if value <= self.min_value else int(log(value / self.min_value) / log(self.base)) + 1
+        self.buckets[b] = self.buckets.get(b, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        if not self.count:
+            return 0.0
+        need, acc = p * self.count, 0
+        for b in sorted(self.buckets):
+            acc += self.buckets[b]
+            if acc >= need:
+                return min(self.min_value * self.base ** b, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+        }
+
+
+_null = nullcontext()
+
+
+def hit_rate(hits, misses):
+    '''
+    >>> hit_rate(3, 1), hit_rate(0, 0)
+    (0.75, None)
+    '''
+    total = hits + misses
+    return hits / total if total else None
+
+
+class Profiler:
+    def __init__(self, enabled=True, slowest=0):
+        self.enabled = enabled
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        # callables evaluated at snapshot time, e.g. cache hit rates
+        self.watches = {}
+        # keep cProfile of N slowest ticks, costly
+        self.slowest = slowest
+        self._slow = []
+        self._tick_prof = None
+        self._tick_start = None
+
+    def _hist(self, name):
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = Histogram()
+        return h
+
+    @contextmanager
+    def _timed(self, name):
+        t = perf_counter()
+        try:
+            yield
+        finally:
+            self._hist(name).add(perf_counter() - t)
+
+    def phase(self, name):
+        return self._timed(name) if self.enabled else _null
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        if self.enabled:
+            self.gauges[name] = value
+
+    def watch(self, name, fn):
+        self.watches[name] = fn
+
+    def watch_hit_rate(self, name, cache):
+        '''
+        Watches cache counting its hits and misses, e.g. CellLibrary or ConfigTable.
+        '''
+        self.watch(name, lambda: hit_rate(cache.hits, cache.misses))
+
+    def tick_start(self):
+        if not self.enabled:
+            return
+        if self.slowest:
+            self._tick_prof = cProfile.Profile()
+            self._tick_prof.enable()
+        self._tick_start = perf_counter()
+
+    def tick_end(self, time):
+        if not self.enabled:
+            return
+        d = perf_counter() - self._tick_start
+        self._hist('tick').add(d)
+        if self._tick_prof is not None:
+            self._tick_prof.disable()
+            item = (d, time, self._tick_prof)
+            if len(self._slow) < self.slowest:
+                heapq.heappush(self._slow, item)
+            elif d > self._slow[0][0]:
+                heapq.heapreplace(self._slow, item)
+            self._tick_prof = None
+
+    def dump_slowest(self, foldername):
+        '''
+        Writes pstats files of slowest ticks, returns their names.
+        '''
+        makedirs(foldername, exist_ok=True)
+        r = []
+        for d, time, prof in sorted(self._slow, key=lambda x: (-x[0], x[1])):
+            fn = join(foldername, 'tick{}_{:.0f}us.pstats'.format(time, d * 1e6))
+            prof.dump_stats(fn)
+            r.append(fn)
+        return r
+
+    def snapshot(self):
+        gauges = dict(self.gauges)
+        for name, fn in self.watches.items():
+            gauges[name] = fn()
+        return {
+            'phases': {k: h.summary() for k, h in self.histograms.items()},
+            'counters': dict(self.counters),
+            'gauges': gauges,
+        }
+
+    def format_text(self):
+        snap = self.snapshot()
+        lines = ['{:<12} {:>8} {:>10} {:>10} {:>10}'.format('phase', 'count', 'p50 us', 'p99 us', 'max us')]
+        for name, s in sorted(snap['phases'].items()):
+            lines.append('{:<12} {:>8} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+                name, s['count'], s['p50'] * 1e6, s['p99'] * 1e6, s['max'] * 1e6
+            ))
+        for kind in ('counters', 'gauges'):
+            for name, v in sorted(snap[kind].items()):
+                lines.append('{:<24} {}'.format(name, v))
+        return '\n'.join(lines) + '\n'
+
+
+async def _stats_session(profiler, reader, writer):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request.split()
+        if len(parts) > 1 and parts[1] == b'/text':
+            body, ctype = profiler.format_text().encode(), 'text/plain'
+        else:
+            body, ctype = json.dumps(profiler.snapshot()).encode(), 'application/json'
+        writer.write('HTTP/1.0 200 OK\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n'.format(
+            ctype, len(body)
+        ).encode() + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+def start_stats_server(profiler, port, host='127.0.0.1'):
+    '''
+    Returns coroutine starting HTTP stats endpoint, local-only by default.
+    '''
+    return asyncio.start_server(lambda r, w: _stats_session(profiler, r, w), host, port)
@@ -0,0 +1,234 @@
+'''
+Multi-resolution map summary for radars and admin overview.
+
+Map is covered by blocks of 8, 32 and 128 cells, every block counts bots, buildings,
+walls, roads and drops; bots and buildings are also counted per owner. Counts follow
+state mutations through observer events and walls, roads and drops are forgotten
+at their death time, so wide-range queries are aggregate reads instead of cell scans.
+
+Counts are kept in tiles of the coarsest block size, allocated on first use,
+so streaming worlds pay only for areas with something in them.
+
+    python -m tierbots.server.radar WORLD    # overview of saved world
+'''
+import argparse
+import heapq
+import numpy
+
+from ..const import EntityTypes, NaturalMap
+from .chunks import live_times
+
+
+FIELDS = ('bots', 'buildings', 'walls', 'roads', 'drops')
+BOTS, BUILDINGS, WALLS, ROADS, DROPS = range(len(FIELDS))
+BUILDING_TYPES = (EntityTypes.spawner, EntityTypes.extension, EntityTypes.radar, EntityTypes.construction_site)
+
+
+def _entity_field(e):
+    if e['type'] == EntityTypes.bot:
+        return BOTS
+    if e['type'] in BUILDING_TYPES:
+        return BUILDINGS
+    return None
+
+
+class _Grid:
+    '''
+    Counters of nfields values at every level, tile -> [array (nfields, blocks, blocks) per level].
+    '''
+    def __init__(self, levels, nfields):
+        self.levels = levels
+        self.tile = levels[-1]
+        self.nfields = nfields
+        self.tiles = {}
+
+    def add(self, x, y, field, delta):
+        t = self.tile
+        k = (x // t, y // t)
+        arrays = self.tiles.get(k)
+        if arrays is None:
+            arrays = self.tiles[k] = [
+                numpy.zeros((self.nfields, t // size, t // size), dtype=numpy.int32) for size in self.levels
+            ]
+        lx, ly = x % t, y % t
+        for a, size in zip(arrays, self.levels):
+            a[field, lx // size, ly // size] += delta
+
+    def gather(self, level, bx0, by0, bx1, by1):
+        '''
+        Array (nfields, bx1 - bx0, by1 - by0) of block counts at level (index into levels).
+        '''
+        out = numpy.zeros((self.nfields, bx1 - bx0, by1 - by0), dtype=numpy.int32)
+        n = self.tile // self.levels[level]
+        for tx in range(bx0 // n, (bx1 - 1) // n + 1):
+            for ty in range(by0 // n, (by1 - 1) // n + 1):
+                arrays = self.tiles.get((tx, ty))
+                if arrays is None:
+                    continue
+                ax, ay = max(bx0, tx * n), max(by0, ty * n)
+                ex, ey = min(bx1, (tx + 1) * n), min(by1, (ty + 1) * n)
+                out[:, ax - bx0:ex - bx0, ay - by0:ey - by0] = arrays[level][
+                    :, ax - tx * n:ex - tx * n, ay - ty * n:ey - ty * n
+                ]
+        return out
+
+
+class SummaryPyramid:
+    def __init__(self, state, levels=(8, 32, 128)):
+        self.state = state
+        self.levels = levels
+        self.totals = _Grid(levels, len(FIELDS))
+        # owner -> grid of (bots, buildings)
+        self.owners = {}
+        # (x, y, store) -> (field, death time) of counted walls and roads (store 0) and drops (store 1)
+        self.cells = {}
+        # (death time, x, y, store)
+        self.expiry = []
+        self._scan()
+        state.observers.append(self._on_event)
+
+    def close(self):
+        self.state.observers.remove(self._on_event)
+
+    def _scan(self):
+        st = self.state
+        for e in st.entities.values():
+            if e is not None:
+                self._count_entity(e, e['x'], e['y'], 1)
+        w, h = st.naturalmap.shape
+        for x, y, t in live_times(st.wall_road_ext_times, st.time, 0, 0, w, h):
+            self._natural_changed(x, y)
+        for x, y, t in live_times(st.drop_ext_times, st.time, 0, 0, w, h):
+            self._drop_changed(x, y)
+
+    def _count_entity(self, e, x, y, delta):
+        field = _entity_field(e)
+        if field is None:
+            return
+        self.totals.add(x, y, field, delta)
+        owner = e.get('owner')
+        if owner is not None:
+            grid = self.owners.get(owner)
+            if grid is None:
+                grid = self.owners[owner] = _Grid(self.levels, 2)
+            grid.add(x, y, field, delta)
+
+    def _recount(self, x, y, store, field, death_time):
+        old = self.cells.pop((x, y, store), None)
+        if old is not None:
+            self.totals.add(x, y, old[0], -1)
+        if field is not None and death_time > self.state.time:
+            self.totals.add(x, y, field, 1)
+            self.cells[x, y, store] = (field, death_time)
+            heapq.heappush(self.expiry, (int(death_time), x, y, store))
+
+    def _natural_changed(self, x, y):
+        st = self.state
+        v = st.naturalmap[x, y]
+        field = WALLS if v == NaturalMap.artifical_wall else ROADS if v == NaturalMap.road else None
+        self._recount(x, y, 0, field, st.wall_road_ext_times[x, y])
+
+    def _drop_changed(self, x, y):
+        self._recount(x, y, 1, DROPS, self.state.drop_ext_times[x, y])
+
+    def _on_event(self, kind, *args):
+        st = self.state
+        if kind == 'entity_added':
+            eid, x, y = args
+            self._count_entity(st.entities[eid], x, y, 1)
+        elif kind == 'entity_moved':
+            eid, ox, oy, x, y = args
+            e = st.entities[eid]
+            self._count_entity(e, ox, oy, -1)
+            self._count_entity(e, x, y, 1)
+        elif kind == 'entity_removed':
+            eid, x, y, e = args
+            self._count_entity(e, x, y, -1)
+        elif kind == 'natural_changed':
+            self._natural_changed(*args)
+        elif kind == 'drop_changed':
+            self._drop_changed(*args)
+
+    def refresh(self):
+        '''
+        Forgets walls, roads and drops which have died by now.
+        '''
+        time = self.state.time
+        while self.expiry and self.expiry[0][0] <= time:
+            death_time, x, y, store = heapq.heappop(self.expiry)
+            c = self.cells.get((x, y, store))
+            # later changes leave stale entries
+            if c is not None and c[1] == death_time:
+                del self.cells[x, y, store]
+                self.totals.add(x, y, c[0], -1)
+
+    def counts(self, x0, y0, x1, y1, level=0, owner=None):
+        '''
+        Returns (bx0, by0, array) where array[field] are counts of blocks covering rectangle.
+        Owner limits bots and buildings to the owner's, fields then are (bots, buildings).
+        '''
+        self.refresh()
+        size = self.levels[level]
+        bx0, by0 = max(x0, 0) // size, max(y0, 0) // size
+        bx1, by1 = (x1 - 1) // size + 1, (y1 - 1) // size + 1
+        if owner is None:
+            grid = self.totals
+        else:
+            grid = self.owners.get(owner) or _Grid(self.levels, 2)
+        return bx0, by0, grid.gather(level, bx0, by0, bx1, by1)
+
+    def scan(self, owner, x, y, radius, level=0):
+        '''
+        Radar view: [[bx, by, enemy bots, enemy buildings, walls, roads, drops]] of non-empty blocks
+        around point, block size is levels[level].
+        '''
+        bx0, by0, total = self.counts(x - radius, y - radius, x + radius + 1, y + radius + 1, level)
+        own = self.counts(x - radius, y - radius, x + radius + 1, y + radius + 1, level, owner)[2]
+        total[BOTS:BUILDINGS + 1] -= own
+        rows = []
+        for i, j in zip(*numpy.nonzero(total.any(axis=0))):
+            rows.append([bx0 + int(i), by0 + int(j)] + total[:, i, j].tolist())
+        return rows
+
+    def overview(self, level=-1):
+        '''
+        Admin map: ({(bx, by): counts by FIELDS} of non-empty blocks, {owner: [bots, buildings]}).
+        '''
+        self.refresh()
+        n = self.totals.tile // self.levels[level]
+        blocks = {}
+        for (tx, ty), arrays in self.totals.tiles.items():
+            a = arrays[level]
+            for i, j in zip(*numpy.nonzero(a.any(axis=0))):
+                blocks[tx * n + int(i), ty * n + int(j)] = a[:, i, j].tolist()
+        owners = {}
+        for owner, grid in self.owners.items():
+            total = sum(arrays[-1].sum(axis=(1, 2)) for arrays in grid.tiles.values())
+            if numpy.any(total):
+                owners[owner] = [int(v) for v in total]
+        return blocks, owners
+
+
+def main():
+    from .state import ServerState
+
+    parser = argparse.ArgumentParser(description='Overview of world from map summary')
+    parser.add_argument('foldername')
+    parser.add_argument('--level', type=int, default=-1, help='index of block size, default is the coarsest')
+    args = parser.parse_args()
+
+    state = ServerState.load(args.foldername)
+    pyramid = SummaryPyramid(state)
+    size = pyramid.levels[args.level]
+    blocks, owners = pyramid.overview(args.level)
+    print('{:>12}  {}'.format('block', '  '.join('{:>9}'.format(f) for f in FIELDS)))
+    for (bx, by), counts in sorted(blocks.items()):
+        print('{:>12}  {}'.format('{},{}'.format(bx * size, by * size), '  '.join('{:>9}'.format(v) for v in counts)))
+    print()
+    for owner, (bots, buildings) in sorted(owners.items()):
+        p = state.players.get(owner)
+        print('player {} {}: {} bots, {} buildings'.format(owner, p['nickname'] if p else '?', bots, buildings))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+'''
+Precomputed rays for line-of-fire and sight checks.
+
+Ray to relative (dx, dy) consists of cells strictly between origin and target.
+Rays depend only on (dx, dy), so one table covers every shooter and watcher,
+and rays of smaller radius are part of the bigger table.
+'''
+from functools import lru_cache
+import numpy
+
+from ..const import NaturalMap, Entities
+
+
+def bresenham(dx, dy):
+    '''
+    >>> bresenham(3, 1)
+    [(1, 0), (2, 1)]
+    >>> bresenham(0, -2)
+    [(0, -1)]
+    >>> bresenham(1, 1)
+    []
+    '''
+    cells = []
+    ax, ay = abs(dx), abs(dy)
+    sx, sy = (1 if dx > 0 else -1), (1 if dy > 0 else -1)
+    x, y = 0, 0
+    err = ax - ay
+    while (x, y) != (dx, dy):
+        e2 = 2 * err
+        if e2 > -ay:
+            err -= ay
+            x += sx
+        if e2 < ax:
+            err += ax
+            y += sy
+        cells.append((x, y))
+    return cells[:-1]
+
+
+class RayTable:
+    def __init__(self, radius):
+        self.radius = radius
+        size = 2 * radius + 1
+        rays = [bresenham(dx, dy) for dx in range(-radius, radius + 1) for dy in range(-radius, radius + 1)]
+        self.length = max(len(r) for r in rays) or 1
+        # padded with origin, which never blocks itself
+        self.offsets = numpy.zeros((len(rays), self.length, 2), dtype=numpy.int64)
+        for i, r in enumerate(rays):
+            if r:
+                self.offsets[i, :len(r)] = r
+        self.ids = numpy.arange(len(rays)).reshape(size, size)
+
+    def ray_ids(self, dxs, dys):
+        return self.ids[numpy.asarray(dxs) + self.radius, numpy.asarray(dys) + self.radius]
+
+
+@lru_cache(maxsize=None)
+def ray_table(radius=None):
+    '''
+    Shared table, large enough for both sight and ranged attacks by default.
+    '''
+    return RayTable(max(Entities.sight_range, Entities.ranged_range) if radius is None else radius)
+
+
+def rays_clear(state, xs, ys, dxs, dys, table=None):
+    '''
+    Checks many rays at once, all map values along all rays are gathered in single step.
+    Walls (natural and artificial) and map borders block rays.
+    Returns bool array.
+    '''
+    table = ray_table() if table is None else table
+    xs, ys = numpy.asarray(xs, dtype=numpy.int64), numpy.asarray(ys, dtype=numpy.int64)
+    offsets = table.offsets[table.ray_ids(dxs, dys)]
+    cx = xs[:, None] + offsets[:, :, 0]
+    cy = ys[:, None] + offsets[:, :, 1]
+    w, h = state.naturalmap.shape
+    inside = (cx >= 0) & (cy >= 0) & (cx < w) & (cy < h)
+    v = numpy.full(cx.shape, NaturalMap.natural_wall, dtype=numpy.uint8)
+    v[inside] = state.get_natural_many(cx[inside], cy[inside])
+    blocked = (v == NaturalMap.natural_wall) | (v == NaturalMap.artifical_wall)
+    return ~blocked.any(axis=1)
+
+
+def line_of_fire(state, xs, ys, dxs, dys):
+    '''
+    Shooters at (xs, ys), targets at relative (dxs, dys). Returns bool array.
+    '''
+    dxs, dys = numpy.asarray(dxs), numpy.asarray(dys)
+    ok = numpy.maximum(numpy.abs(dxs), numpy.abs(dys)) <= Entities.ranged_range
+    out = numpy.zeros(ok.shape, dtype=numpy.bool_)
+    if ok.any():
+        out[ok] = rays_clear(state, numpy.asarray(xs)[ok], numpy.asarray(ys)[ok], dxs[ok], dys[ok])
+    return out
+
+
+def visible_cells(state, x, y, radius=None):
+    '''
+    Field of view with wall occlusion. Walls themselves are visible.
+    Returns bool array (2 * radius + 1, 2 * radius + 1) centered at (x, y).
+    '''
+    radius = Entities.sight_range if radius is None else radius
+    table = ray_table() if radius <= ray_table().radius else ray_table(radius)
+    d = numpy.arange(-radius, radius + 1)
+    dxs, dys = numpy.repeat(d, len(d)), numpy.tile(d, len(d))
+    w, h = state.naturalmap.shape
+    tx, ty = x + dxs, y + dys
+    ok = (dxs * dxs + dys * dys <= radius * radius) & (tx >= 0) & (ty >= 0) & (tx < w) & (ty < h)
+    out = numpy.zeros(ok.shape, dtype=numpy.bool_)
+    out[ok] = rays_clear(state, numpy.full(ok.sum(), x), numpy.full(ok.sum(), y), dxs[ok], dys[ok], table)
+    return out.reshape(len(d), len(d))
@@ -0,0 +1,133 @@
+'''
+Deterministic recording and replay of command streams.
+
+Recording folder contains state snapshot it started from, random seed,
+commands executed and players registered at every tick and hash of final state.
+Registrations change state and consume random numbers outside of command stream,
+so they are recorded and replayed along with commands.
+Replay feeds commands through headless engine as fast as possible,
+so every build can be benchmarked against captured real traffic.
+'''
+from os import mkdir
+from os.path import join
+from shutil import copytree
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import argparse
+import json
+import pickle
+import random
+
+from .state import ServerState
+from .engine import Engine
+from .profiler import Profiler
+
+
+class Filenames:
+    snapshot = 'snapshot'
+    meta = 'meta.json'
+    commands = 'commands.pickle'
+    final = 'final.json'
+
+
+class Recorder:
+    '''
+    Attach to engine right before serving starts. Reseeds global random generator.
+    Server reports registrations of every tick through registered(), before engine runs the tick.
+    '''
+    def __init__(self, engine, foldername, seed=None):
+        mkdir(foldername)
+        self.engine = engine
+        self.foldername = foldername
+        seed = random.getrandbits(64) if seed is None else seed
+
+        engine.state.save()
+        copytree(engine.state.foldername, join(foldername, Filenames.snapshot))
+        with open(join(foldername, Filenames.meta), 'w') as f:
+            json.dump({'seed': seed, 'start_time': engine.state.time}, f)
+        random.seed(seed)
+
+        self._f = open(join(foldername, Filenames.commands), 'wb')
+        # (nickname, token) registered at current tick
+        self._registrations = []
+        engine.listeners.append(self._on_tick)
+
+    def registered(self, players):
+        self._registrations.extend(players)
+
+    def _on_tick(self, time, commands):
+        if commands or self._registrations:
+            pickle.dump((time, commands, self._registrations), self._f)
+            self._registrations = []
+
+    def close(self):
+        self.engine.listeners.remove(self._on_tick)
+        self._f.close()
+        with open(join(self.foldername, Filenames.final), 'w') as f:
+            json.dump({'time': self.engine.state.time, 'hash': self.engine.state.state_hash()}, f)
+
+
+def iter_commands(foldername):
+    '''
+    Yields (time, commands, registrations) of recorded ticks.
+    '''
+    with open(join(foldername, Filenames.commands), 'rb') as f:
+        while True:
+            try:
+                record = pickle.load(f)
+            except EOFError:
+                return
+            # recorded before registrations were
+            yield record if len(record) == 3 else record + ([], )
+
+
+def replay(foldername, slowest=0):
+    '''
+    Returns (hash matches, profiler, total seconds).
+    '''
+    with open(join(foldername, Filenames.meta)) as f:
+        meta = json.load(f)
+    with open(join(foldername, Filenames.final)) as f:
+        final = json.load(f)
+
+    with TemporaryDirectory() as tmp:
+        # recording must stay untouched
+        snapshot = join(tmp, Filenames.snapshot)
+        copytree(join(foldername, Filenames.snapshot), snapshot)
+        state = ServerState.load(snapshot)
+        assert state.time == meta['start_time']
+        random.seed(meta['seed'])
+
+        engine = Engine(state)
+        engine.profiler = Profiler(slowest=slowest)
+        t = perf_counter()
+        for time, commands, registrations in iter_commands(foldername):
+            engine.fast_forward(time)
+            if registrations:
+                state.place_new_player_bases(registrations)
+            for c in commands:
+                engine.queue_command(c, time)
+        engine.fast_forward(final['time'])
+        total = perf_counter() - t
+        return state.state_hash() == final['hash'], engine.profiler, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded command stream')
+    parser.add_argument('foldername')
+    parser.add_argument('--profile-slowest', type=int, default=0, metavar='N', help='dump cProfile of N slowest ticks')
+    parser.add_argument('--profile-dir', default='profiles')
+    args = parser.parse_args()
+
+    ok, profiler, total = replay(args.foldername, slowest=args.profile_slowest)
+    print(profiler.format_text(), end='')
+    if args.profile_slowest:
+        for fn in profiler.dump_slowest(args.profile_dir):
+            print('Profile written to', fn)
+    print('Total {:.3f}s, final state {}'.format(total, 'matches' if ok else 'DIFFERS'))
+    if not ok:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,486 @@
+'''
+Player scripts executed by pool of worker processes.
+
+Script defines tick(world) and commands bots through the client API (see client.apidoc).
+Scripts are untrusted code. Trimmed builtins only keep honest scripts tidy, they can be
+escaped from inside the interpreter, so every worker is isolated by the OS before it runs
+any script: it is chrooted into empty directory, switches to unprivileged user, sets
+no-new-privs and can't open files or sockets, fork or write files (rlimits). This needs
+server running as root, trusted=True skips isolation for running own scripts only.
+Every player has own worker, so escaped script only sees its own views and commands.
+Workers answer with JSON, main process never unpickles what they send, and their
+commands are checked like commands of clients.
+
+Budgets are enforced by main process too: script which runs longer than its wall time
+limit (several CPU budgets) gets its worker killed and replaced, scripts which used more
+CPU time than budget are skipped for the tick.
+
+Main process serializes Watcher views of every player into compact buffer:
+
+    header      time, bots count, enemies count, sight radius (uint32 each)
+    bots        VIEW_BOT records
+    windows     natural map around every bot, (2 * radius + 1) ** 2 uint8 per bot,
+                cells out of sight are NaturalMap.unknown
+    enemies     VIEW_ENEMY records, bots of other players seen by any own bot
+'''
+from multiprocessing import get_context
+from multiprocessing.connection import wait
+from time import perf_counter, process_time
+from tempfile import mkdtemp
+import argparse
+import builtins
+import ctypes
+import importlib
+import json
+import os
+import pwd
+import resource
+import struct
+import numpy
+
+from ..const import Actions, EntityTypes, Entities, NaturalMap, DTypes
+from ..protocol import parse_command
+from .rays import visible_cells
+
+
+VIEW_HEADER = struct.Struct('<4I')
+VIEW_BOT = numpy.dtype([
+    ('eid', '<u4'), ('x', '<i4'), ('y', '<i4'), ('hp', '<i4'),
+    ('energy', '<i4'), ('stamina', '<i4'), ('lifetime', '<i4'),
+])
+VIEW_ENEMY = numpy.dtype([('x', '<i4'), ('y', '<i4'), ('hp', '<i4'), ('owner', '<i4')])
+
+SAFE_BUILTINS = (
+    'abs', 'all', 'any', 'bool', 'dict', 'divmod', 'enumerate', 'filter', 'float', 'frozenset',
+    'int', 'isinstance', 'len', 'list', 'map', 'max', 'min', 'print', 'range', 'reversed', 'round',
+    'set', 'sorted', 'str', 'sum', 'tuple', 'zip', 'Exception', 'ValueError', 'KeyError', 'IndexError',
+)
+SAFE_MODULES = ('math', 'random', 'itertools', 'collections', 'heapq', 'functools')
+
+
+def build_view(state, player_idx, entities, radius=None):
+    '''
+    Serializes what player's bots see. entities are IDs owned by player.
+    '''
+    radius = Entities.sight_range if radius is None else radius
+    ents = state.entities
+    eids = [eid for eid in entities if ents[eid]['type'] == EntityTypes.bot]
+    bots = numpy.zeros((len(eids), ), dtype=VIEW_BOT)
+    size = 2 * radius + 1
+    windows = numpy.full((len(eids), size, size), NaturalMap.unknown, dtype=DTypes.naturalmap)
+    w, h = state.naturalmap.shape
+    d = numpy.arange(-radius, radius + 1)
+    for i, eid in enumerate(eids):
+        e = ents[eid]
+        x, y = e['x'], e['y']
+        bots[i] = (
+            eid, x, y, state.get_entity_prop(eid, 'hp', 0), e.get('energy', 0),
+            e.get('stamina', 0), state.get_entity_prop(eid, 'lifetime', 0),
+        )
+        seen = visible_cells(state, x, y, radius)
+        cx, cy = numpy.meshgrid(numpy.clip(x + d, 0, w - 1), numpy.clip(y + d, 0, h - 1), indexing='ij')
+        nat = state.get_natural_many(cx[seen], cy[seen])
+        windows[i][seen] = nat
+
+    enemies = []
+    if len(eids):
+        for eid, e in ents.items():
+            if e['type'] != EntityTypes.bot or e.get('owner') == player_idx:
+                continue
+            near = (numpy.abs(bots['x'] - e['x']) <= radius) & (numpy.abs(bots['y'] - e['y']) <= radius)
+            if near.any():
+                enemies.append((e['x'], e['y'], state.get_entity_prop(eid, 'hp', 0), e.get('owner', -1)))
+    enemies = numpy.array(enemies, dtype=VIEW_ENEMY)
+    header = VIEW_HEADER.pack(state.time, len(eids), len(enemies), radius)
+    return header + bots.tobytes() + windows.tobytes() + enemies.tobytes()
+
+
+def parse_view(buf):
+    '''
+    Returns (time, radius, bots, windows, enemies), arrays share memory with buffer.
+    '''
+    time, nbots, nenemies, radius = VIEW_HEADER.unpack_from(buf)
+    size = 2 * radius + 1
+    pos = VIEW_HEADER.size
+    bots = numpy.frombuffer(buf, dtype=VIEW_BOT, count=nbots, offset=pos)
+    pos += bots.nbytes
+    windows = numpy.frombuffer(buf, dtype=DTypes.naturalmap, count=nbots * size * size, offset=pos)
+    pos += windows.nbytes
+    enemies = numpy.frombuffer(buf, dtype=VIEW_ENEMY, count=nenemies, offset=pos)
+    return time, radius, bots, windows.reshape(nbots, size, size), enemies
+
+
+class EnemyBot:
+    def __init__(self, rec):
+        self.x, self.y, self.hp, self.owner = (int(v) for v in rec)
+
+
+class MyBot:
+    '''
+    Script side of client.apidoc.MyBot, actions are collected as commands.
+    '''
+    def __init__(self, rec, window, enemies, radius, out):
+        self.eid = int(rec['eid'])
+        self.x, self.y, self.hp = int(rec['x']), int(rec['y']), int(rec['hp'])
+        self.energy, self.stamina, self.lifetime = int(rec['energy']), int(rec['stamina']), int(rec['lifetime'])
+        self.natural_map = window
+        self._enemies = enemies
+        self._radius = radius
+        self._out = out
+
+    @property
+    def enemy_bots_around(self):
+        r = self._radius
+        return [EnemyBot(e) for e in self._enemies if abs(e['x'] - self.x) <= r and abs(e['y'] - self.y) <= r]
+
+    def _cmd(self, action, *args):
+        self._out.append((self.eid, int(action)) + tuple(int(a) for a in args))
+
+    def move(self, direction):
+        self._cmd(Actions.move, direction)
+
+    def suicide(self):
+        self._cmd(Actions.suicide)
+
+    def gather(self, direction):
+        self._cmd(Actions.gather, direction)
+
+    def put(self, direction):
+        self._cmd(Actions.put, direction)
+
+    def place_building(self, direction, building_type):
+        self._cmd(Actions.place_building, direction, building_type)
+
+    def build(self, direction):
+        self._cmd(Actions.build, direction)
+
+    def slay(self, direction):
+        self._cmd(Actions.slay, direction)
+
+    def shoot(self, dx, dy):
+        self._cmd(Actions.shoot, dx, dy)
+
+    def heal(self, direction):
+        self._cmd(Actions.heal, direction)
+
+
+class World:
+    def __init__(self, buf, out):
+        self.time, radius, bots, windows, enemies = parse_view(buf)
+        self.my_bots = [MyBot(b, w, enemies, radius, out) for b, w in zip(bots, windows)]
+
+
+def _safe_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level or name.split('.')[0] not in SAFE_MODULES:
+        raise ImportError('Module {} is not available to scripts'.format(name))
+    return __import__(name, globals, locals, fromlist, level)
+
+
+PR_SET_NO_NEW_PRIVS = 38
+
+# longest answer of worker, longer ones count as crash
+MAX_RESULT = 4 * 1024 * 1024
+# error messages of scripts are cut to this length
+MAX_ERROR = 200
+
+_budget = None
+# (player, source hash) -> tick function
+_compiled = {}
+
+
+def _isolate(jail, user):
+    if os.geteuid() != 0:
+        raise RuntimeError('Script workers need root to isolate untrusted scripts, use trusted=True for own scripts')
+    pw = pwd.getpwnam(user)
+    os.chroot(jail)
+    os.chdir('/')
+    os.setgroups([])
+    os.setgid(pw.pw_gid)
+    os.setuid(pw.pw_uid)
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.prctl(PR_SET_NO_NEW_PRIVS, 1, 0, 0, 0) != 0:
+        raise OSError(ctypes.get_errno(), 'prctl(PR_SET_NO_NEW_PRIVS) failed')
+    # pipe to main process stays open, nothing new can be opened
+    for limit in (resource.RLIMIT_NOFILE, resource.RLIMIT_NPROC, resource.RLIMIT_FSIZE):
+        resource.setrlimit(limit, (0, 0))
+
+
+def _worker(conn, budget, memory, jail, user):
+    global _budget
+    _budget = budget
+    # scripts can't import anything once jailed
+    for name in SAFE_MODULES:
+        importlib.import_module(name)
+    if memory:
+        resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    if jail is not None:
+        _isolate(jail, user)
+    conn.send_bytes(b'ready')
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        conn.send_bytes(encode_result(*run_script(job)))
+
+
+def _load(player, source):
+    key = (player, hash(source))
+    fn = _compiled.get(key)
+    if fn is None:
+        safe = {n: getattr(builtins, n) for n in SAFE_BUILTINS}
+        safe['__import__'] = _safe_import
+        ns = {'__builtins__': safe, '__name__': 'script{}'.format(player)}
+        exec(compile(source, '<script {}>'.format(player), 'exec'), ns)
+        fn = _compiled[key] = ns['tick']
+    return fn
+
+
+def run_script(job):
+    '''
+    job is (player, source, view). Returns (commands or None, error or None).
+    '''
+    player, source, view = job
+    out = []
+    start = process_time()
+    try:
+        _load(player, source)(World(view, out))
+    except MemoryError:
+        return None, 'memory'
+    except Exception as e:
+        return None, '{}: {}'.format(type(e).__name__, e)
+    if process_time() - start > _budget:
+        return None, 'budget'
+    return out, None
+
+
+def encode_result(commands, error):
+    return json.dumps({'commands': commands} if error is None else {'error': error}).encode()
+
+
+def decode_result(data):
+    '''
+    Checks answer of worker, escaped script can send anything.
+    Returns (commands or None, error or None), commands still need protocol.parse_command.
+
+    >>> decode_result(encode_result([(5, 1, 3)], None))
+    ([[5, 1, 3]], None)
+    >>> decode_result(encode_result(None, 'budget'))
+    (None, 'budget')
+    >>> decode_result(b'{"commands": 5}'), decode_result(b'[' * 100000)
+    ((None, 'malformed'), (None, 'malformed'))
+    '''
+    try:
+        msg = json.loads(data)
+    except (ValueError, RecursionError):
+        return None, 'malformed'
+    if isinstance(msg, dict) and len(msg) == 1:
+        if isinstance(msg.get('commands'), list):
+            return msg['commands'], None
+        if isinstance(msg.get('error'), str):
+            return None, msg['error'][:MAX_ERROR]
+    return None, 'malformed'
+
+
+class _Worker:
+    def __init__(self, ctx, args):
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=_worker, args=(child, ) + args, daemon=True)
+        self.process.start()
+        child.close()
+        self.ready = False
+        # wall time limit of running job
+        self.job = None
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class ScriptPool:
+    '''
+    Every player has own worker, script which escapes its interpreter can't see views
+    or commands of other players. At most processes scripts run at once.
+    budget is CPU seconds per script per tick, memory is address space limit of worker in bytes.
+    Workers are jailed and run as user, unless trusted.
+    '''
+    def __init__(self, processes=None, budget=0.02, memory=512 * 1024 * 1024, wall_factor=5,
+                 user='nobody', trusted=False):
+        self.processes = processes or os.cpu_count()
+        self.budget = budget
+        self.wall_factor = wall_factor
+        # empty root directory of jailed workers
+        self.jail = None if trusted else mkdtemp(prefix='tierbots-jail-')
+        self._ctx = get_context('spawn')
+        self._args = (budget, memory, self.jail, user)
+        # player index -> worker
+        self.workers = {}
+
+    def start(self, players):
+        '''
+        Starts workers of players which have none and waits for them,
+        so the first tick of their scripts doesn't miss its deadline.
+        '''
+        new = [player for player in players if player not in self.workers]
+        for player in new:
+            self.workers[player] = _Worker(self._ctx, self._args)
+        for player in new:
+            self._ready(self.workers[player])
+
+    def _ready(self, w):
+        try:
+            msg = w.conn.recv_bytes(MAX_RESULT)
+        except (EOFError, OSError):
+            msg = None
+        if msg != b'ready':
+            raise RuntimeError('Script worker failed to start: {!r}'.format(msg))
+        w.ready = True
+
+    def _replace(self, player):
+        self.workers[player].kill()
+        self.workers[player] = _Worker(self._ctx, self._args)
+
+    def run(self, jobs, timeout):
+        '''
+        Runs scripts in parallel. Returns {player: commands} of scripts finished in time
+        and {player: error} of skipped ones. Workers of scripts over wall time limit,
+        over tick deadline or with malformed answer are killed and replaced.
+        Workers of players without job are closed, missing ones are started.
+        '''
+        done, errors = {}, {}
+        deadline = perf_counter() + timeout
+        players = {job[0] for job in jobs}
+        for player in list(self.workers):
+            if player not in players:
+                self.workers.pop(player).kill()
+        for player in players:
+            if player not in self.workers:
+                self.workers[player] = _Worker(self._ctx, self._args)
+        pending = list(jobs)
+        while True:
+            now = perf_counter()
+            for player, w in list(self.workers.items()):
+                if w.job is not None and (now >= w.job or now >= deadline):
+                    errors[player] = 'budget' if now >= w.job else 'deadline'
+                    self._replace(player)
+            running = sum(w.job is not None for w in self.workers.values())
+            for job in list(pending):
+                w = self.workers[job[0]]
+                if running >= self.processes or now >= deadline:
+                    break
+                if w.ready:
+                    pending.remove(job)
+                    w.job = now + self.budget * self.wall_factor
+                    w.conn.send(job)
+                    running += 1
+            waiting = {job[0] for job in pending if now < deadline}
+            busy = [
+                (player, w) for player, w in self.workers.items()
+                if w.job is not None or (not w.ready and player in waiting)
+            ]
+            if not busy:
+                break
+            limit = min([deadline] + [w.job for player, w in busy if w.job is not None])
+            ready = wait([w.conn for player, w in busy], max(limit - perf_counter(), 0))
+            for player, w in busy:
+                if w.conn not in ready:
+                    continue
+                if not w.ready:
+                    self._ready(w)
+                    continue
+                try:
+                    commands, error = decode_result(w.conn.recv_bytes(MAX_RESULT))
+                except (EOFError, OSError):
+                    # worker died or answer is too long
+                    commands, error = None, 'crashed'
+                w.job = None
+                if error is None:
+                    done[player] = commands
+                else:
+                    errors[player] = error
+                    if error in ('crashed', 'malformed'):
+                        self._replace(player)
+        for player in players:
+            if player not in done and player not in errors:
+                errors[player] = 'deadline'
+        return done, errors
+
+    def close(self):
+        for w in self.workers.values():
+            w.kill()
+        self.workers = {}
+        if self.jail is not None:
+            os.rmdir(self.jail)
+
+
+class ScriptRunner:
+    '''
+    Feeds engine with commands of player scripts, call step() once per tick.
+    '''
+    def __init__(self, engine, pool):
+        self.engine = engine
+        self.pool = pool
+        # player index -> source
+        self.scripts = {}
+        self.skipped = {}
+
+    def step(self, timeout):
+        st = self.engine.state
+        jobs = []
+        for idx, source in self.scripts.items():
+            p = st.players.get(idx)
+            if p is None:
+                continue
+            jobs.append((idx, source, build_view(st, idx, p['entities'])))
+        done, errors = self.pool.run(jobs, timeout)
+        for idx, commands in done.items():
+            p = st.players.get(idx)
+            owned = p['entities'] if p is not None else ()
+            for cmd in commands:
+                # checked like commands of clients
+                cmd = parse_command(cmd)
+                if cmd is not None and cmd[0] in owned:
+                    self.engine.queue_command(cmd)
+        for idx in errors:
+            self.skipped[idx] = self.skipped.get(idx, 0) + 1
+        return done, errors
+
+
+def main():
+    from .state import ServerState
+    from .engine import Engine
+
+    parser = argparse.ArgumentParser(description='Run player script for every player headlessly')
+    parser.add_argument('foldername')
+    parser.add_argument('script', help='file defining tick(world)')
+    parser.add_argument('--ticks', type=int, default=10)
+    parser.add_argument('--budget', type=float, default=0.02, help='CPU seconds per script per tick')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--user', default='nobody', help='unprivileged user of script workers')
+    parser.add_argument('--trusted', action='store_true', help='own scripts, workers are not isolated')
+    args = parser.parse_args()
+
+    with open(args.script) as f:
+        source = f.read()
+    state = ServerState.load(args.foldername)
+    engine = Engine(state)
+    runner = ScriptRunner(engine, ScriptPool(args.workers, args.budget, user=args.user, trusted=args.trusted))
+    runner.scripts = {p['index']: source for p in state.players}
+    runner.pool.start(runner.scripts)
+    try:
+        for i in range(args.ticks):
+            t = perf_counter()
+            done, errors = runner.step(timeout=0.1)
+            commands = engine.tick()
+            print('Tick {}: {} scripts, {} skipped, {} commands, {:.1f}ms'.format(
+                state.time - 1, len(done), len(errors), len(commands), (perf_counter() - t) * 1e3
+            ))
+            for idx, error in sorted(errors.items()):
+                print('  player {}: {}'.format(idx, error))
+    finally:
+        runner.pool.close()
+
+
+if __name__ == '__main__':
+    main()
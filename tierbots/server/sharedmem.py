@@ -0,0 +1,231 @@
+'''
+Map arrays in shared memory, read by pool of worker processes.
+
+Main process stays the single writer: it rebinds ServerState arrays to shared segments,
+so every state mutation goes straight to shared memory. Workers attach the same segments
+zero-copy and compute field of view, paths and update frames during read-only phase of tick.
+read_phase() returns only when all workers are done, which is the tick barrier.
+GameServer started with --workers builds sight views of all clients this way after every tick.
+
+Dense worlds only, streaming worlds keep their arrays in growing chunk dicts.
+'''
+from collections import deque
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+from time import perf_counter
+import argparse
+import os
+import numpy
+
+from ..const import NaturalMap, DTypes, Entities, Direction
+from .state import ServerState
+from .chunks import SparseTimes
+from .rays import visible_cells
+
+
+# arrays of ServerState moved to shared memory, death times as dense (x, y) arrays
+SHARED = ('naturalmap', 'wall_road_ext_times', 'drop_ext_times')
+
+
+def _attach(name):
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        # before 3.13, workers share resource tracker of main process, which unlinks segments
+        return SharedMemory(name=name)
+
+
+class SharedView:
+    '''
+    Read-only state as seen by workers: map arrays, occupancy grid and time.
+    Occupancy holds EntityTypes code of entity in cell, zero if free.
+    '''
+    get_natural_many = ServerState.get_natural_many
+
+    def __init__(self, layout):
+        self._segments = []
+        for name, (shm_name, shape, dtype) in layout.items():
+            shm = _attach(shm_name)
+            self._segments.append(shm)
+            arr = numpy.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            arr.flags.writeable = False
+            setattr(self, name, arr)
+
+    @property
+    def time(self):
+        return int(self.clock[0])
+
+    def passable(self, x, y):
+        if self.occupancy[x, y]:
+            return False
+        v = self.naturalmap[x, y]
+        if v == NaturalMap.artifical_wall:
+            # expired wall is ground
+            return self.wall_road_ext_times[x, y] <= self.time
+        return v == NaturalMap.ground or v == NaturalMap.road
+
+
+class SharedState:
+    '''
+    Owns shared segments of one ServerState. Call close() before dropping state.
+    '''
+    def __init__(self, state):
+        assert isinstance(state.naturalmap, numpy.ndarray), 'Dense world is required'
+        self.state = state
+        self.segments = {}
+        self.layout = {}
+        state.naturalmap = self._share('naturalmap', state.naturalmap)
+        for name in ('wall_road_ext_times', 'drop_ext_times'):
+            setattr(state, name, self._share(name, getattr(state, name).dense(state.naturalmap.shape)))
+        self.occupancy = self._share('occupancy', numpy.zeros(state.naturalmap.shape, dtype=numpy.uint8))
+        self.clock = self._share('clock', numpy.zeros((1, ), dtype=numpy.uint64))
+
+    def _share(self, name, arr):
+        shm = SharedMemory(create=True, size=max(arr.nbytes, 1))
+        out = numpy.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+        out[...] = arr
+        self.segments[name] = shm
+        self.layout[name] = (shm.name, arr.shape, arr.dtype.str)
+        return out
+
+    def publish(self):
+        '''
+        Copies per-tick data (time, entity positions) to shared memory.
+        '''
+        st = self.state
+        self.clock[0] = st.time
+        self.occupancy.fill(0)
+        if st.entities:
+            ents = st.entities.values()
+            n = len(st.entities)
+            xs = numpy.fromiter((e['x'] for e in ents), dtype=numpy.int64, count=n)
+            ys = numpy.fromiter((e['y'] for e in ents), dtype=numpy.int64, count=n)
+            self.occupancy[xs, ys] = numpy.fromiter((e['type'] for e in ents), dtype=numpy.uint8, count=n)
+
+    def close(self):
+        # state keeps working on private copies
+        st = self.state
+        st.naturalmap = numpy.array(st.naturalmap)
+        for name in ('wall_road_ext_times', 'drop_ext_times'):
+            setattr(st, name, SparseTimes.from_dense(getattr(st, name), st.time))
+        self.occupancy = self.clock = None
+        for shm in self.segments.values():
+            shm.close()
+            shm.unlink()
+        self.segments = {}
+
+
+_view = None
+
+
+def _init_worker(layout):
+    global _view
+    _view = SharedView(layout)
+
+
+def task_fov(job):
+    '''
+    job is (x, y, radius), returns packed bits of visible_cells.
+    '''
+    x, y, radius = job
+    return numpy.packbits(visible_cells(_view, x, y, radius)).tobytes()
+
+
+def task_path(job):
+    '''
+    job is (x, y, tx, ty, max_nodes). Breadth-first search over free ground and roads,
+    target cell may be occupied. Returns list of Direction values, None if target isn't reached.
+    '''
+    x, y, tx, ty, max_nodes = job
+    v = _view
+    w, h = v.naturalmap.shape
+    prev = {(x, y): None}
+    queue = deque([(x, y)])
+    while queue and len(prev) < max_nodes:
+        cx, cy = queue.popleft()
+        if (cx, cy) == (tx, ty):
+            path = []
+            while prev[(cx, cy)] is not None:
+                d = prev[(cx, cy)]
+                path.append(d)
+                dx, dy = Direction.offset(d)
+                cx, cy = cx - dx, cy - dy
+            return path[::-1]
+        for d in range(1, 9):
+            dx, dy = Direction.offset(d)
+            nx, ny = cx + dx, cy + dy
+            if (nx, ny) in prev or nx < 0 or ny < 0 or nx >= w or ny >= h:
+                continue
+            if (nx, ny) == (tx, ty) or v.passable(nx, ny):
+                prev[(nx, ny)] = d
+                queue.append((nx, ny))
+    return None
+
+
+def task_frame(job):
+    '''
+    job is list of watcher positions of one client. Frame consists of map window
+    and occupancy window around every watcher, cells out of sight are NaturalMap.unknown.
+    Returns bytes.
+    '''
+    v = _view
+    r = Entities.sight_range
+    w, h = v.naturalmap.shape
+    parts = []
+    for x, y in job:
+        seen = visible_cells(v, x, y, r)
+        d = numpy.arange(-r, r + 1)
+        cx, cy = numpy.meshgrid(numpy.clip(x + d, 0, w - 1), numpy.clip(y + d, 0, h - 1), indexing='ij')
+        nat = v.get_natural_many(cx.ravel(), cy.ravel()).reshape(seen.shape)
+        parts.append(numpy.where(seen, nat, NaturalMap.unknown).astype(DTypes.naturalmap).tobytes())
+        parts.append(numpy.where(seen, v.occupancy[cx, cy], 0).astype(numpy.uint8).tobytes())
+    return b''.join(parts)
+
+
+class WorkerPool:
+    def __init__(self, shared, processes=None):
+        self.shared = shared
+        self.pool = Pool(processes, initializer=_init_worker, initargs=(shared.layout, ))
+
+    def read_phase(self, fov=(), paths=(), frames=()):
+        '''
+        Publishes tick data and runs all jobs in parallel. State must not change until it returns.
+        Returns (fov results, path results, frame results), in order of jobs.
+        '''
+        self.shared.publish()
+        pending = [self.pool.map_async(fn, jobs) for fn, jobs in ((task_fov, fov), (task_path, paths), (task_frame, frames))]
+        return tuple(p.get() for p in pending)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute views of all bots with shared-memory workers')
+    parser.add_argument('foldername')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--ticks', type=int, default=5)
+    args = parser.parse_args()
+
+    state = ServerState.load(args.foldername)
+    shared = SharedState(state)
+    pool = WorkerPool(shared, args.workers)
+    try:
+        owners = {}
+        for eid, e in state.entities.items():
+            if 'owner' in e:
+                owners.setdefault(e['owner'], []).append((e['x'], e['y']))
+        frames = list(owners.values())
+        for i in range(args.ticks):
+            t = perf_counter()
+            pool.read_phase(frames=frames)
+            print('Tick {}: {} frames in {:.1f}ms'.format(state.time, len(frames), (perf_counter() - t) * 1e3))
+            state.increment_time()
+    finally:
+        pool.close()
+        shared.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+'''
+Spawn point index for new player bases.
+
+Map is split into square blocks. Every block keeps count of free ground cells
+(ground without entity), energy sources and bases (spawners), counts follow
+state mutations through observer events. Blocks are ranked by score:
+
+- no other base within spacing blocks, so nobody is born inside neighbour's base
+- energy sources around
+- some base within meet blocks, so players find each other in reasonable time
+- free ground
+
+Best block is taken from heap in O(log n). Changed blocks are re-scored lazily
+and pushed again with new version, stale heap entries are skipped on pop.
+Streaming worlds index generated chunks only.
+'''
+from random import getrandbits
+import heapq
+import numpy
+
+from ..const import NaturalMap, EntityTypes, WorldSize
+from .chunks import LazyNaturalMap
+
+
+def _block_sums(mask, block):
+    '''
+    >>> _block_sums(numpy.ones((4, 6), dtype=bool), 2).tolist()
+    [[4, 4, 4], [4, 4, 4]]
+    '''
+    w, h = mask.shape
+    return mask.reshape(w // block, block, h // block, block).sum(axis=(1, 3))
+
+
+class SpawnIndex:
+    def __init__(self, state, block=16, spacing=2, meet=8, min_free=None):
+        self.state = state
+        self.block = block
+        self.spacing = spacing
+        self.meet = meet
+        self.min_free = block * block // 4 if min_free is None else min_free
+        w, h = state.naturalmap.shape
+        shape = (-(-w // block), -(-h // block))
+        self.free = numpy.zeros(shape, dtype=numpy.int32)
+        self.sources = numpy.zeros(shape, dtype=numpy.int32)
+        self.bases = numpy.zeros(shape, dtype=numpy.int32)
+        # streaming worlds: block lies in generated chunk
+        self.known = numpy.zeros(shape, dtype=bool)
+        self.version = numpy.zeros(shape, dtype=numpy.int64)
+        self.heap = []
+        self.dirty = set()
+        # blocks which ground has changed, free cells are counted again
+        self.recount = set()
+        self.chunks = set()
+        self._scan()
+        state.observers.append(self._on_event)
+
+    def close(self):
+        self.state.observers.remove(self._on_event)
+
+    def _scan(self):
+        st = self.state
+        for e in st.entities.values():
+            if e is not None:
+                self._count_entity(e, 1)
+        if isinstance(st.naturalmap, LazyNaturalMap):
+            self._scan_chunks()
+        else:
+            w, h = st.naturalmap.shape
+            bw, bh = self.free.shape
+            ground = numpy.zeros((bw * self.block, bh * self.block), dtype=bool)
+            ground[:w, :h] = st.naturalmap == NaturalMap.ground
+            self.free[...] = _block_sums(ground, self.block)
+            self.known[...] = True
+            for x, y in st._ent_map:
+                if ground[x, y]:
+                    self.free[x // self.block, y // self.block] -= 1
+            self.dirty.update(zip(*numpy.nonzero(self.known)))
+
+    def _scan_chunks(self):
+        # WorldSize.cell is multiple of block, chunk covers whole blocks
+        n = WorldSize.cell // self.block
+        for cx, cy in set(self.state.naturalmap.chunks) - self.chunks:
+            self.chunks.add((cx, cy))
+            for bx in range(cx * n, (cx + 1) * n):
+                for by in range(cy * n, (cy + 1) * n):
+                    self.known[bx, by] = True
+                    self.free[bx, by] = self._count_free(bx, by)
+                    self.dirty.add((bx, by))
+
+    def _window(self, x0, y0, x1, y1):
+        nm = self.state.naturalmap
+        w, h = nm.shape
+        x1, y1 = min(x1, w), min(y1, h)
+        if isinstance(nm, LazyNaturalMap):
+            return nm.window(x0, y0, x1, y1)
+        return nm[x0:x1, y0:y1]
+
+    def _count_free(self, bx, by):
+        b = self.block
+        ground = self._window(bx * b, by * b, (bx + 1) * b, (by + 1) * b) == NaturalMap.ground
+        ent_map = self.state._ent_map
+        taken = sum(1 for x, y in zip(*numpy.nonzero(ground)) if (bx * b + x, by * b + y) in ent_map)
+        return int(ground.sum()) - taken
+
+    def _area(self, bx, by, r):
+        return slice(max(bx - r, 0), bx + r + 1), slice(max(by - r, 0), by + r + 1)
+
+    def _touch(self, bx, by, r):
+        w, h = self.free.shape
+        for x in range(max(bx - r, 0), min(bx + r + 1, w)):
+            for y in range(max(by - r, 0), min(by + r + 1, h)):
+                self.dirty.add((x, y))
+
+    def _count_entity(self, e, sign):
+        bx, by = e['x'] // self.block, e['y'] // self.block
+        if e['type'] == EntityTypes.source:
+            self.sources[bx, by] += sign
+            self._touch(bx, by, 1)
+        elif e['type'] == EntityTypes.spawner:
+            self.bases[bx, by] += sign
+            self._touch(bx, by, self.meet)
+
+    def _occupy(self, x, y, sign):
+        b = self.block
+        if self.known[x // b, y // b] and self.state.naturalmap[x, y] == NaturalMap.ground:
+            self.free[x // b, y // b] -= sign
+            self.dirty.add((x // b, y // b))
+
+    def _on_event(self, kind, *args):
+        if kind == 'entity_added':
+            eid, x, y = args
+            self._count_entity(self.state.entities[eid], 1)
+            self._occupy(x, y, 1)
+        elif kind == 'entity_moved':
+            eid, ox, oy, x, y = args
+            self._occupy(ox, oy, -1)
+            self._occupy(x, y, 1)
+        elif kind == 'entity_removed':
+            eid, x, y, e = args
+            self._count_entity(e, -1)
+            self._occupy(x, y, -1)
+        elif kind == 'natural_changed':
+            x, y = args
+            self.recount.add((x // self.block, y // self.block))
+
+    def score(self, bx, by):
+        '''
+        None if block isn't suitable for new base.
+        '''
+        free = self.free[bx, by]
+        if not self.known[bx, by] or free < self.min_free:
+            return None
+        if self.bases[self._area(bx, by, self.spacing)].any():
+            return None
+        near = min(int(self.sources[self._area(bx, by, 1)].sum()), 4)
+        meet = 1 if self.bases[self._area(bx, by, self.meet)].any() else 0
+        return 2 * near + 3 * meet + float(free) / self.block ** 2
+
+    def refresh(self):
+        '''
+        Re-scores changed blocks.
+        '''
+        if isinstance(self.state.naturalmap, LazyNaturalMap):
+            self._scan_chunks()
+        for bx, by in self.recount:
+            if self.known[bx, by]:
+                self.free[bx, by] = self._count_free(bx, by)
+                self.dirty.add((bx, by))
+        self.recount.clear()
+        if len(self.heap) > 2 * self.free.size:
+            # too many stale entries
+            self.heap = []
+            self.dirty.update(zip(*numpy.nonzero(self.known)))
+        for bx, by in self.dirty:
+            # numpy indexes would leak into entity coordinates
+            bx, by = int(bx), int(by)
+            self.version[bx, by] += 1
+            s = self.score(bx, by)
+            if s is not None:
+                # random tie break, equal blocks are taken in random order
+                heapq.heappush(self.heap, (-s, getrandbits(32), int(self.version[bx, by]), bx, by))
+        self.dirty.clear()
+
+    def _pick_cell(self, bx, by):
+        # spawner at (x, y), starter bot at (x + 1, y)
+        b = self.block
+        x0, y0 = bx * b, by * b
+        blocked, cost = self.state.passability.window(x0, y0, x0 + b + 1, y0 + b)
+        # free ground, roads cost nothing
+        win = (blocked == 0) & (cost > 0)
+        pairs = numpy.nonzero(win[:-1] & win[1:])
+        n = len(pairs[0])
+        if not n:
+            return None
+        i = getrandbits(32) % n
+        return x0 + int(pairs[0][i]), y0 + int(pairs[1][i])
+
+    def allocate(self, n):
+        '''
+        Returns up to n spawn points, at most one per block and not closer than spacing to each other.
+        Blocks are re-scored when bases are actually placed there.
+        '''
+        self.refresh()
+        points, taken, skipped = [], [], []
+        while self.heap and len(points) < n:
+            entry = heapq.heappop(self.heap)
+            s, r, ver, bx, by = entry
+            if ver != self.version[bx, by]:
+                continue
+            if any(abs(bx - tx) <= self.spacing and abs(by - ty) <= self.spacing for tx, ty in taken):
+                skipped.append(entry)
+                continue
+            k = self._pick_cell(bx, by)
+            # taken block is re-scored on next refresh, whether base is placed or not
+            self.dirty.add((bx, by))
+            if k is not None:
+                taken.append((bx, by))
+                points.append(k)
+        for entry in skipped:
+            heapq.heappush(self.heap, entry)
+        return points
+
+    def best(self, count=10):
+        '''
+        [(score, x, y)] of best blocks, for inspection.
+        '''
+        self.refresh()
+        out = []
+        for s, r, ver, bx, by in sorted(self.heap):
+            if ver == self.version[bx, by]:
+                out.append((-s, bx * self.block, by * self.block))
+                if len(out) == count:
+                    break
+        return out
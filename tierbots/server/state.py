@@ -12,14 +12,20 @@ Full state data must be loaded by server into RAM, so we don't need any SQL solu
 Tick counter starts from 0 on each server restart. DON'T save any timestamps into files,
 instead calculate current values.
 '''
-from os.path import join, isdir
-from os import mkdir, listdir
+from os.path import join, isdir, isfile
+from os import mkdir, listdir, remove
 import numpy
 import pickle
+import hashlib
 from random import getrandbits
 
-from ..const import NaturalMap, Filenames, DTypes, Entities, EntityTypes, Direction
+from ..const import NaturalMap, Filenames, DTypes, Entities, EntityTypes, Direction, WorldSize
 from ..decay import param_by_zerotime, zerotime_by_param_change
+from .chunks import LazyNaturalMap, SparseTimes, live_times, save_packed, load_packed
+from .columns import LazyColumn
+from .players import PlayerRegistry
+from .spawn import SpawnIndex
+from .passability import PassabilityMap
 
 
 # TODO: limit checking for all uint32 values
@@ -29,8 +35,6 @@ from ..decay import param_by_zerotime, zerotime_by_param_change
 # TODO: create StateValidationError with descriptive messages instead simply returning False
 # TODO: try another design: return for every (x,y) list of object in this cell (walls, roads, bots, etc, all at once)
 # TODO: probably this state class could be reusable for client, so it needs facility to extend world
-# TODO: try reducing size of ground_index, use uint16 indexing and chunks
-#       probably best chunk size here is 256x256
 
 
 class ServerState:
@@ -38,24 +42,89 @@ class ServerState:
     def load(cls, foldername):
         assert isdir(foldername), 'Trying to load non-existent directory'
         o = cls(foldername)
-        for a in ('naturalmap', 'ground_index', 'wall_road_ext_times', 'drop_ext_times'):
-            setattr(o, a, numpy.load(o._get_filename(getattr(Filenames, a)), allow_pickle=False))
         with open(o._get_filename(Filenames.pickled), 'rb') as f:
             data = pickle.load(f)
             for k, v in data.items():
                 setattr(o, k, v)
+        width = None
+        if isfile(o._get_filename(Filenames.chunked_naturalmap)):
+            o.naturalmap = LazyNaturalMap.load(o._get_filename(Filenames.chunked_naturalmap))
+            o.naturalmap.on_new_chunk = o._add_sources
+            width = o.naturalmap.world.width
+        else:
+            if isfile(o._get_filename(Filenames.packed_naturalmap)):
+                o.naturalmap = load_packed(o._get_filename(Filenames.packed_naturalmap))
+            else:
+                o.naturalmap = numpy.load(o._get_filename(Filenames.naturalmap), allow_pickle=False)
+        for a in ('wall_road_ext_times', 'drop_ext_times'):
+            if isfile(o._get_filename(getattr(Filenames, 'chunked_' + a))):
+                times = SparseTimes.load(o._get_filename(getattr(Filenames, 'chunked_' + a)), o.time, width)
+            else:
+                # dense world saved before sparse format, array by ground index
+                arr = numpy.load(o._get_filename(getattr(Filenames, a)), allow_pickle=False)
+                ground_index = o._load_ground_index()
+                xs, ys = numpy.nonzero(ground_index)
+                times = SparseTimes.from_cells(xs, ys, arr[ground_index[xs, ys]], o.time)
+            setattr(o, a, times)
+        if isinstance(o.players, list):
+            o.players = PlayerRegistry.from_list(o.players)
+        if not hasattr(o, 'columns'):
+            o.columns = cls._make_columns()
+        o._build_caches()
         return o
 
     def save(self):
+        if isinstance(self.naturalmap, LazyNaturalMap):
+            self.naturalmap.save(self._get_filename(Filenames.chunked_naturalmap))
+        else:
+            save_packed(self._get_filename(Filenames.packed_naturalmap), self.naturalmap)
+        for a in ('wall_road_ext_times', 'drop_ext_times'):
+            times = getattr(self, a)
+            if isinstance(times, numpy.ndarray):
+                # rebound to shared memory, see sharedmem
+                times = SparseTimes.from_dense(times, self.time)
+            times.save(self._get_filename(getattr(Filenames, 'chunked_' + a)))
         for a in ('naturalmap', 'ground_index', 'wall_road_ext_times', 'drop_ext_times'):
-            numpy.save(self._get_filename(getattr(Filenames, a)), getattr(self, a), allow_pickle=False)
+            if isfile(self._get_filename(getattr(Filenames, a))):
+                # world saved before packed and sparse formats
+                remove(self._get_filename(getattr(Filenames, a)))
         with open(self._get_filename(Filenames.pickled), 'wb') as f:
             pickle.dump({k: getattr(self, k) for k in (
                 'players',
                 'time',
                 'entities',
+                'columns',
             )}, f)
 
+    def state_hash(self):
+        '''
+        Digest of everything that defines game state, for replay verification.
+        '''
+        h = hashlib.sha256()
+        h.update(repr(self.time).encode())
+        if isinstance(self.naturalmap, numpy.ndarray):
+            h.update(self.naturalmap.tobytes())
+        else:
+            for k in sorted(self.naturalmap.chunks):
+                h.update(repr(k).encode())
+                h.update(self.naturalmap.chunks[k].tobytes())
+        shape = self.naturalmap.shape
+        for a in ('wall_road_ext_times', 'drop_ext_times'):
+            # only live values, expired ones may or may not be freed yet
+            v = getattr(self, a)
+            if isinstance(v, numpy.ndarray):
+                v = SparseTimes.from_dense(v, self.time)
+            h.update(repr(sorted((x, y, int(t)) for x, y, t in v.live(0, 0, *shape))).encode())
+        for eid in sorted(self.entities):
+            h.update(repr((eid, sorted(self.get_entity_by_id(eid).items()))).encode())
+        return h.hexdigest()
+
+    def _load_ground_index(self):
+        # only worlds saved before sparse format need it, natural walls never change
+        if isfile(self._get_filename(Filenames.ground_index)):
+            return numpy.load(self._get_filename(Filenames.ground_index), allow_pickle=False)
+        return self._build_ground_index(self.naturalmap)[0]
+
     @staticmethod
     def _build_ground_index(naturalmap):
         # zero means invalid value, i.e. wall
@@ -69,38 +138,95 @@ class ServerState:
         return out, idx
 
     @classmethod
-    def create_new(cls, foldername, width, height):
+    def create_new(cls, foldername, width, height, streaming=False, seed=None):
+        '''
+        Streaming world costs nothing at start, its cells are generated on first touch.
+        Width of streaming world is fixed, height can grow later.
+        '''
         if isdir(foldername):
             assert not listdir(foldername), 'Directory must be empty to start new world'
         else:
             mkdir(foldername)
 
-        from ..worldgen import generate_world
-
         o = cls(foldername)
-        o.naturalmap, sources = generate_world(width, height)
-        o.ground_index, gidx_len = cls._build_ground_index(o.naturalmap)
-        o.wall_road_ext_times = numpy.zeros((gidx_len, ), dtype=DTypes.time)
-        o.drop_ext_times = numpy.zeros((gidx_len, ), dtype=DTypes.time)
-
-        maxplayers = len(sources) // 4
-        o.players = [None for i in range(maxplayers)]
         o.time = 0
         o.entities = {}
-        for source in sources:
-            o.entities[o._allocate_entity_id()] = {
-                'type': int(EntityTypes.source),
-                'x': source[0],
-                'y': source[1],
-                'energy': Entities.source_max_energy,
-            }
+        o.columns = cls._make_columns()
+        o.wall_road_ext_times = SparseTimes()
+        o.drop_ext_times = SparseTimes()
+        if streaming:
+            from ..worldgen.streaming import StreamingWorld
+
+            world = StreamingWorld(width, height, getrandbits(64) if seed is None else seed)
+            o.naturalmap = LazyNaturalMap(world, on_new_chunk=o._add_sources)
+            # number of sources is unknown, registry grows along with explored area
+            o.players = PlayerRegistry()
+        else:
+            from ..worldgen import generate_world
+
+            o.naturalmap, sources = generate_world(width, height)
+
+            maxplayers = len(sources) // 4
+            o.players = PlayerRegistry(maxplayers)
+            o._add_sources(sources)
 
         o._build_caches()
         o.save()
         return o
 
+    def _add_sources(self, sources):
+        for source in sources:
+            eid = self._allocate_entity_id()
+            x, y = int(source[0]), int(source[1])
+            self.entities[eid] = {
+                'type': int(EntityTypes.source),
+                'x': x,
+                'y': y,
+            }
+            self.columns['energy'].set(eid, self.time, Entities.source_max_energy)
+            if hasattr(self, '_ent_map'):
+                self._ent_map[(x, y)] = eid
+            if self._passability is not None:
+                self._passability.set_entity(x, y, True)
+            if self.observers:
+                self._notify('entity_added', eid, x, y)
+
+    @staticmethod
+    def _make_columns():
+        # lazy entity properties, entity has property either in its dict or in column
+        return {
+            # energy sources
+            'energy': LazyColumn(Entities.source_growth, Entities.source_max_energy),
+            # bots
+            'lifetime': LazyColumn(1),
+            # construction sites
+            'buildpoints': LazyColumn(Entities.buildpoints_decay),
+            # buildings of offline players, rate is set per building
+            'hp': LazyColumn(1),
+        }
+
     def __init__(self, foldername):
         self.foldername = foldername
+        # called with (event, *args) on every mutation, see _notify
+        self.observers = []
+        # built on first registration, see spawn module
+        self.spawn_index = None
+        # built on first use, kept up to date by mutations, see passability
+        self._passability = None
+
+    def _notify(self, *event):
+        '''
+        Events:
+            ('entity_added', eid, x, y)
+            ('entity_moved', eid, old x, old y, x, y)
+            ('entity_removed', eid, x, y, entity data)
+            ('entity_changed', eid, x, y, key)
+            ('natural_changed', x, y)
+            ('drop_changed', x, y)
+            ('player_removed', player index, player data)   last entity is gone, slot is free
+        '''
+        for fn in self.observers:
+            fn(*event)
 
     def _get_filename(self, en):
         return join(self.foldername, en)
@@ -129,8 +255,23 @@ class ServerState:
         eid = self._allocate_entity_id()
         self.entities[eid] = edata
         self._ent_map[k] = eid
+        if self._passability is not None:
+            self._passability.set_entity(x, y, True)
+        if 'owner' in edata:
+            self.players.own(edata['owner'], eid)
+        if self.observers:
+            self._notify('entity_added', eid, x, y)
         return eid
 
+    @property
+    def passability(self):
+        '''
+        Passability map kept up to date from now on.
+        '''
+        if self._passability is None:
+            self._passability = PassabilityMap(self)
+        return self._passability
+
     def get_entity(self, x, y):
         '''
         Returns entity ID if entity exists there. None otherwise.
@@ -140,9 +281,36 @@ class ServerState:
     def get_entity_by_id(self, eid):
         '''
         ID must be valid.
-        Returns copied dict instance.
+        Returns copied dict instance, lazy properties are evaluated.
+        '''
+        e = self.entities[eid].copy()
+        for k, col in self.columns.items():
+            if eid in col:
+                e[k] = col.get(eid, self.time)
+        return e
+
+    def get_entity_prop(self, eid, key, default=None):
+        '''
+        ID must be valid.
         '''
-        return self.entities[eid].copy()
+        col = self.columns.get(key)
+        if col is not None and eid in col:
+            return col.get(eid, self.time)
+        return self.entities[eid].get(key, default)
+
+    def get_entity_props(self, eids, key):
+        '''
+        IDs must be valid, all entities must have property.
+        Batched read, returns numpy array.
+        '''
+        out = numpy.empty((len(eids), ), dtype=numpy.int64)
+        col = self.columns.get(key, ())
+        lazy = numpy.fromiter((eid in col for eid in eids), dtype=numpy.bool_, count=len(eids))
+        if lazy.any():
+            out[lazy] = col.get_many([eid for eid, lz in zip(eids, lazy) if lz], self.time)
+        if not lazy.all():
+            out[~lazy] = [self.entities[eid][key] for eid, lz in zip(eids, lazy) if not lz]
+        return out
 
     def change_entity_prop(self, eid, key, value):
         '''
@@ -150,7 +318,46 @@ class ServerState:
         Don't attempt to change position.
         '''
         assert key != 'x' and key != 'y'
-        self.entities[eid][key] = value
+        col = self.columns.get(key)
+        if col is not None and eid in col:
+            col.set(eid, self.time, value)
+        else:
+            self.entities[eid][key] = value
+        if self.observers:
+            e = self.entities[eid]
+            self._notify('entity_changed', eid, e['x'], e['y'], key)
+
+    def set_lazy_prop(self, eid, key, value, rate=None):
+        '''
+        ID must be valid.
+        Property starts changing with time, rate defaults to column's one.
+        '''
+        self.entities[eid].pop(key, None)
+        self.columns[key].set(eid, self.time, value, rate=rate)
+        if self.observers:
+            e = self.entities[eid]
+            self._notify('entity_changed', eid, e['x'], e['y'], key)
+
+    def set_static_prop(self, eid, key):
+        '''
+        ID must be valid.
+        Freezes lazy property at its current value.
+        '''
+        col = self.columns[key]
+        if eid in col:
+            self.entities[eid][key] = col.get(eid, self.time)
+            col.remove(eid)
+
+    def expired_entities(self, key):
+        '''
+        IDs of entities which decaying property has reached zero.
+        '''
+        return self.columns[key].expired(self.time)
+
+    def _forget_lazy(self, eid):
+        for col in self.columns.values():
+            if eid in col:
+                col.remove(eid)
 
     def move_entity(self, eid, dirc):
         '''
@@ -158,15 +365,43 @@ class ServerState:
         Returns bool if success. Checks if there is other entity, but doesn't check walls.
         '''
         e = self.entities[eid]
-        dx, dy = Direction.offset(dirc)
-        k = e['x'] + dx, e['y'] + dy
+        offset = Direction.offset(dirc)
+        if offset is None:
+            return False
+        k = e['x'] + offset[0], e['y'] + offset[1]
         if not self._check_xy(*k) or k in self._ent_map:
             return False
         del self._ent_map[(e['x'], e['y'])]  # removing old link
+        ox, oy = e['x'], e['y']
         e['x'], e['y'] = k
         self._ent_map[k] = eid
+        if self._passability is not None:
+            self._passability.set_entity(ox, oy, False)
+            self._passability.set_entity(k[0], k[1], True)
+        if self.observers:
+            self._notify('entity_moved', eid, ox, oy, k[0], k[1])
         return True
 
+    def relocate_entities(self, eids, xs, ys):
+        '''
+        IDs must be valid.
+        Moves many entities at once, destinations must be free or left by other relocated entities.
+        '''
+        ents = [self.entities[eid] for eid in eids]
+        old = [(e['x'], e['y']) for e in ents]
+        for k in old:
+            del self._ent_map[k]
+        for eid, e, x, y in zip(eids, ents, xs, ys):
+            k = int(x), int(y)
+            e['x'], e['y'] = k
+            self._ent_map[k] = eid
+        if self._passability is not None:
+            self._passability.set_entities([k[0] for k in old], [k[1] for k in old], False)
+            self._passability.set_entities(xs, ys, True)
+        if self.observers:
+            for eid, e, (ox, oy) in zip(eids, ents, old):
+                self._notify('entity_moved', eid, ox, oy, e['x'], e['y'])
+
     def remove_entity(self, eid):
         '''
         ID must be valid.
@@ -174,6 +409,30 @@ class ServerState:
         e = self.entities[eid]
         del self._ent_map[(e['x'], e['y'])]
         del self.entities[eid]
+        self._forget_lazy(eid)
+        gone = self.players.disown(eid)
+        if self._passability is not None:
+            self._passability.set_entity(e['x'], e['y'], False)
+        if self.observers:
+            self._notify('entity_removed', eid, e['x'], e['y'], e)
+            if gone is not None:
+                self._notify('player_removed', gone['index'], gone)
+
+    def remove_entities(self, eids):
+        '''
+        IDs must be valid.
+        '''
+        for eid in eids:
+            e = self.entities.pop(eid)
+            del self._ent_map[(e['x'], e['y'])]
+            self._forget_lazy(eid)
+            gone = self.players.disown(eid)
+            if self._passability is not None:
+                self._passability.set_entity(e['x'], e['y'], False)
+            if self.observers:
+                self._notify('entity_removed', eid, e['x'], e['y'], e)
+                if gone is not None:
+                    self._notify('player_removed', gone['index'], gone)
 
     def get_natural(self, x, y):
         '''
@@ -183,10 +442,14 @@ class ServerState:
             return NaturalMap.natural_wall, None
         v, hp = self.naturalmap[x, y], None
         if v == NaturalMap.artifical_wall or v == NaturalMap.road:
-            death_time = self.wall_road_ext_times[self.ground_index[x, y]]
+            death_time = self.wall_road_ext_times[x, y]
             if self.time >= death_time:
                 v = NaturalMap.ground
                 self.naturalmap[x, y] = NaturalMap.ground
+                if self._passability is not None:
+                    self._passability.natural_changed(x, y)
+                if self.observers:
+                    self._notify('natural_changed', x, y)
             else:
                 hp = param_by_zerotime(
                     self.time, death_time,
@@ -194,6 +457,22 @@ class ServerState:
                 )
         return v, hp
 
+    def get_natural_many(self, xs, ys):
+        '''
+        Vectorized get_natural without HP, expired walls and roads are reported as ground.
+        Coordinates must be valid.
+        '''
+        if isinstance(self.naturalmap, numpy.ndarray):
+            v = self.naturalmap[xs, ys]
+        else:
+            v = self.naturalmap.take(xs, ys)
+        artificial = (v == NaturalMap.artifical_wall) | (v == NaturalMap.road)
+        if artificial.any():
+            ai = numpy.nonzero(artificial)[0]
+            death_times = self.wall_road_ext_times[xs[ai], ys[ai]]
+            v[ai[death_times <= self.time]] = NaturalMap.ground
+        return v
+
     def change_natural_hp(self, x, y, delta_hp):
         '''
         Applies HP delta to NaturalMap object.
@@ -206,14 +485,18 @@ class ServerState:
         v = self.naturalmap[x, y]
         if v != NaturalMap.artifical_wall and v != NaturalMap.road:
             return False
-        gi = self.ground_index[x, y]
         new_death_time = zerotime_by_param_change(
-            self.time, self.wall_road_ext_times[gi],
+            self.time, self.wall_road_ext_times[x, y],
             Entities.wall_decay if v == NaturalMap.artifical_wall else Entities.road_decay,
             delta_hp
         )
+        self.wall_road_ext_times[x, y] = new_death_time
         if new_death_time <= self.time:
             self.naturalmap[x, y] = NaturalMap.ground
+        if self._passability is not None:
+            self._passability.natural_changed(x, y)
+        if self.observers:
+            self._notify('natural_changed', x, y)
         return True
 
     def set_natural_type(self, x, y, otype, hp):
@@ -230,11 +513,15 @@ class ServerState:
         if v == NaturalMap.natural_wall:
             return False
         self.naturalmap[x, y] = otype
-        self.wall_road_ext_times[self.ground_index[x, y]] = zerotime_by_param_change(
+        self.wall_road_ext_times[x, y] = zerotime_by_param_change(
             self.time, self.time,
             Entities.wall_decay if otype == NaturalMap.artifical_wall else Entities.road_decay,
             hp
         )
+        if self._passability is not None:
+            self._passability.natural_changed(x, y)
+        if self.observers:
+            self._notify('natural_changed', x, y)
         return True
 
     def get_energy_drop(self, x, y):
@@ -243,24 +530,80 @@ class ServerState:
         '''
         if not self._check_xy(x, y):
             return None
-        death_time = self.drop_ext_times[self.ground_index[x, y]]
+        death_time = self.drop_ext_times[x, y]
         val = param_by_zerotime(self.time, death_time, Entities.drop_decay)
         return val if val > 0 else None
 
+    def energy_drops_around(self, x, y, radius):
+        '''
+        Returns list of (x, y, energy) of drops in square around point.
+        Only chunks holding live drops are visited.
+        '''
+        out = []
+        found = live_times(self.drop_ext_times, self.time, x - radius, y - radius, x + radius + 1, y + radius + 1)
+        for dx, dy, death_time in found:
+            val = param_by_zerotime(self.time, death_time, Entities.drop_decay)
+            if val > 0:
+                out.append((dx, dy, val))
+        return out
+
     def change_energy_drop(self, x, y, delta_energy):
         '''
         Changes energy drop by amount of energy. Can also create or remove drop.
         '''
         if not self._check_xy(x, y):
             return
-        gi = self.ground_index[x, y]
-        self.drop_ext_times[gi] = zerotime_by_param_change(
-            self.time, self.drop_ext_times[gi], Entities.drop_decay, delta_energy
+        self.drop_ext_times[x, y] = zerotime_by_param_change(
+            self.time, self.drop_ext_times[x, y], Entities.drop_decay, delta_energy
         )
+        if self.observers:
+            self._notify('drop_changed', x, y)
 
     def increment_time(self):
         self.time += 1
+        for times in (self.wall_road_ext_times, self.drop_ext_times):
+            if isinstance(times, SparseTimes):
+                times.expire(self.time)
+
+    def place_new_player_base(self, nickname, token, config=b'\x01\x02\x03\x04\x06'):
+        '''
+        Takes free player slot and puts spawner with starter bot onto free ground chosen by spawn index.
+        Must be invoked on first player's connection, not registration.
+        Returns player index, None if there is no room or nickname is taken.
+        '''
+        return self.place_new_player_bases([(nickname, token)], config)[0]
 
-    def place_new_player_base(self, nickname, token):
-        # must be invoked on first player's connection, not registration
-        pass
+    def place_new_player_bases(self, players, config=b'\x01\x02\x03\x04\x06', tries=10):
+        '''
+        Batch of registrations, players is list of (nickname, token).
+        Returns list of player indexes, None for those who didn't get slot or spawn point.
+        '''
+        from ..const import BotParts
+
+        lazy = isinstance(self.naturalmap, LazyNaturalMap)
+        if self.spawn_index is None:
+            self.spawn_index = SpawnIndex(self)
+        out = [self.players.add(nickname, token, grow=lazy) for nickname, token in players]
+        waiting = [idx for idx in out if idx is not None]
+        for i in range(tries):
+            for (x, y), idx in zip(self.spawn_index.allocate(len(waiting)), list(waiting)):
+                waiting.remove(idx)
+                self.place_new_entity({'type': int(EntityTypes.spawner), 'owner': idx}, x, y)
+                hp = BotParts.max_hp(config)
+                bot = self.place_new_entity({
+                    'type': int(EntityTypes.bot),
+                    'owner': idx,
+                    'config': config,
+                    'hp': hp,
+                    'stamina': BotParts.max_stamina(config, hp),
+                    'energy': 0,
+                }, x + 1, y)
+                self.set_lazy_prop(bot, 'lifetime', Entities.bot_lifetime)
+            if not waiting or not lazy:
+                break
+            # explore one more cell of streaming world
+            w, h = self.naturalmap.shape
+            self.naturalmap.chunk(getrandbits(32) % (w // WorldSize.cell), getrandbits(32) % (h // WorldSize.cell))
+        for idx in waiting:
+            self.players.remove(idx)
+        return [None if idx in waiting else idx for idx in out]
@@ -1,6 +1,10 @@
 from .cellgen import make_cell
 from .maze import genmaze_eller
 from .fullworld import generate_world, render_generated_world
+from .png import export_png, import_png, render_tiles
 
 
-__all__ = ('make_cell', 'genmaze_eller', 'generate_world', 'render_generated_world')
+__all__ = (
+    'make_cell', 'genmaze_eller', 'generate_world', 'render_generated_world',
+    'export_png', 'import_png', 'render_tiles',
+)
@@ -0,0 +1,155 @@
+'''
+Disk-backed library of generated cells.
+
+Cell depends only on its border, so cells are indexed by border signature.
+Exits are quantized to make signatures repeat. Signature is taken in canonical
+orientation (minimal among all rotations and mirrorings), so one stored cell serves
+all 8 orientations of its border.
+
+Layout: foldername/seed/signature/variant.npy
+'''
+from os import makedirs
+from os.path import join, isfile
+from zlib import crc32
+import argparse
+import numpy
+
+from .cellgen import make_cell, make_random_exits, build_wall, apply_exits, range_intersect
+from ..const import WorldSize, NaturalMap, DTypes
+
+
+def quantize_exits(exits, step=None):
+    '''
+    >>> quantize_exits([(1, 5, 14), (3, 3, 60)], 8)
+    [(1, 3, 16), (3, 3, 61)]
+    '''
+    step = WorldSize.exit_quantum if step is None else step
+    r = []
+    for side, a, b in exits:
+        a = a - a % step
+        b = b + (-b) % step
+        r.append((side, ) + range_intersect(a, b, WorldSize.corner_wall, WorldSize.cell - WorldSize.corner_wall))
+    return r
+
+
+# all 8 orientations: (transpose, flip x, flip y)
+TRANSFORMS = [(t, fx, fy) for t in (False, True) for fx in (False, True) for fy in (False, True)]
+
+
+def transform(cell, tr):
+    t, fx, fy = tr
+    if t:
+        cell = cell.T
+    if fx:
+        cell = cell[::-1, :]
+    if fy:
+        cell = cell[:, ::-1]
+    return cell
+
+
+def untransform(cell, tr):
+    t, fx, fy = tr
+    if fy:
+        cell = cell[:, ::-1]
+    if fx:
+        cell = cell[::-1, :]
+    if t:
+        cell = cell.T
+    return cell
+
+
+def border_signature(cell):
+    border = numpy.concatenate((cell[:, 0], cell[-1, :], cell[:, -1], cell[0, :])) == NaturalMap.ground
+    return numpy.packbits(border).tobytes().hex()
+
+
+def canonical_signature(exits):
+    '''
+    Returns transform to canonical orientation along with signature.
+    '''
+    cell = numpy.full((WorldSize.cell, WorldSize.cell), NaturalMap.natural_wall, dtype=DTypes.naturalmap)
+    build_wall(cell)
+    apply_exits(cell, exits)
+    return min(((tr, border_signature(transform(cell, tr))) for tr in TRANSFORMS), key=lambda x: x[1])
+
+
+class CellLibrary:
+    def __init__(self, foldername, seed=0, variants=4, symmetric=True):
+        self.foldername = join(foldername, str(seed))
+        self.seed = seed
+        self.variants = variants
+        # allow rotated/mirrored cells, otherwise every orientation is stored separately
+        self.symmetric = symmetric
+        self._cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _filename(self, sig, variant):
+        return join(self.foldername, sig, '{}.npy'.format(variant))
+
+    def _load(self, sig, variant):
+        k = (sig, variant)
+        if k not in self._cache:
+            fn = self._filename(sig, variant)
+            self._cache[k] = numpy.load(fn, allow_pickle=False) if isfile(fn) else None
+        return self._cache[k]
+
+    def _store(self, sig, variant, cell):
+        makedirs(join(self.foldername, sig), exist_ok=True)
+        cell = numpy.ascontiguousarray(cell)
+        numpy.save(self._filename(sig, variant), cell, allow_pickle=False)
+        self._cache[(sig, variant)] = cell
+
+    def _lookup_key(self, exits):
+        if self.symmetric:
+            return canonical_signature(exits)
+        cell = numpy.full((WorldSize.cell, WorldSize.cell), NaturalMap.natural_wall, dtype=DTypes.naturalmap)
+        build_wall(cell)
+        apply_exits(cell, exits)
+        return TRANSFORMS[0], border_signature(cell)
+
+    def get(self, exits, key=None):
+        '''
+        Exits must be quantized. Key (e.g. cell position) chooses one of variants.
+        Generates and inserts new cell on miss.
+        '''
+        tr, sig = self._lookup_key(exits)
+        variant = crc32('{}:{}'.format(self.seed, key).encode()) % self.variants
+        cell = self._load(sig, variant)
+        if cell is None:
+            self.misses += 1
+            cell = make_cell(exits=exits)
+            self._store(sig, variant, transform(cell, tr))
+            return cell
+        self.hits += 1
+        return untransform(cell, tr).copy()
+
+    def prewarm(self, count):
+        '''
+        Fills all variants of count random exit layouts. Returns number of generated cells.
+        '''
+        generated = 0
+        for i in range(count):
+            exits = quantize_exits(make_random_exits())
+            tr, sig = self._lookup_key(exits)
+            for variant in range(self.variants):
+                if self._load(sig, variant) is None:
+                    self._store(sig, variant, transform(make_cell(exits=exits), tr))
+                    generated += 1
+        return generated
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pre-warm cell library')
+    parser.add_argument('foldername')
+    parser.add_argument('-n', '--count', type=int, default=100, help='number of random exit layouts')
+    parser.add_argument('--variants', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    lib = CellLibrary(args.foldername, seed=args.seed, variants=args.variants)
+    print('Generated {} cells'.format(lib.prewarm(args.count)))
+
+
+if __name__ == '__main__':
+    main()
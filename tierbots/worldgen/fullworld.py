@@ -1,8 +1,9 @@
-from random import random, sample, randrange
+from random import random, getrandbits
 import numpy
 
 from .maze import genmaze_eller
 from .cellgen import make_cell, make_random_exits
+from .png import export_png
 from ..const import Direction, WorldSize, NaturalMap, DTypes
 
 
@@ -17,7 +18,13 @@ def raze_maze_walls(maze, prob=0.5):
                 maze['bwalls'][x, y] = False
 
 
-def make_full_world(width, height):
+def make_full_world(width, height, library=None):
+    '''
+    With CellLibrary given, exits are quantized and cells are taken from library when possible.
+    '''
+    if library is not None:
+        from .celllib import quantize_exits
+
     maze = genmaze_eller(width, height)
     raze_maze_walls(maze, 0.4)
 
@@ -39,48 +46,56 @@ def make_full_world(width, height):
             if not bottom:
                 sds.append(Direction.south)
 
-            exits.extend(make_random_exits(only_sides=tuple(sds)))
+            own_exits = make_random_exits(only_sides=tuple(sds))
+            if library is not None:
+                own_exits = quantize_exits(own_exits)
+            exits.extend(own_exits)
 
             right_exit = [(Direction.west, a, b) for side, a, b in exits if side == Direction.east]
             bottom_exits[x] = [(Direction.north, a, b) for side, a, b in exits if side == Direction.south]
 
-            cells[(x, y)] = make_cell(exits=exits)
+            cells[(x, y)] = make_cell(exits=exits) if library is None else library.get(exits, key=(x, y))
         print('{}%'.format(y * 100 // height))
     return cells
 
 
-def setup_sources(cells):
-    result = []
+def setup_sources(mp, origin=(0, 0)):
+    '''
+    Places energy sources on natural walls next to ground, random count per cell.
+    Map (or its chunk) must consist of whole cells, origin is absolute position of map corner.
+    Returns (N, 2) array of absolute coordinates.
+    '''
     ofs = WorldSize.source_min_border_offset
-    for xy, cell in cells.items():
-        cg = cell == NaturalMap.ground
-        cg_comb = cg.copy()
-
-        cg_comb[:-1, :] |= cg[1:, :]
-        cg_comb[1:, :] |= cg[:-1, :]
-        cg_comb[:, :-1] |= cg[:, 1:]
-        cg_comb[:, 1:] |= cg[:, :-1]
-
-        cg_comb[:-1, :-1] |= cg[1:, 1:]
-        cg_comb[:-1, 1:] |= cg[1:, :-1]
-        cg_comb[1:, :-1] |= cg[:-1, 1:]
-        cg_comb[1:, 1:] |= cg[:-1, :-1]
-
-        possible_places = (cell == NaturalMap.natural_wall) & cg_comb
-        if ofs > 0:
-            possible_places = possible_places[ofs:-ofs, ofs:-ofs]
-        indices_x, indices_y = numpy.where(possible_places)
-
-        scount = min(randrange(*WorldSize.sources_per_cell), len(indices_x))
-        if scount <= 0:
-            continue
-        result.extend(map(
-            lambda idx: (
-                xy[0] * WorldSize.cell + indices_x[idx] + ofs,
-                xy[1] * WorldSize.cell + indices_y[idx] + ofs,
-            ),
-            sample(range(len(indices_x)), scount)
-        ))
+    w, h = mp.shape
+
+    # 3x3 dilation of ground mask, done separably
+    cg = numpy.pad(mp == NaturalMap.ground, 1)
+    cg = cg[:-2, :] | cg[1:-1, :] | cg[2:, :]
+    cg = cg[:, :-2] | cg[:, 1:-1] | cg[:, 2:]
+    possible_places = (mp == NaturalMap.natural_wall) & cg
+    if ofs > 0:
+        inner_x = numpy.arange(w) % WorldSize.cell
+        inner_x = (inner_x >= ofs) & (inner_x < WorldSize.cell - ofs)
+        inner_y = numpy.arange(h) % WorldSize.cell
+        inner_y = (inner_y >= ofs) & (inner_y < WorldSize.cell - ofs)
+        possible_places &= inner_x[:, None] & inner_y[None, :]
+    indices_x, indices_y = numpy.nonzero(possible_places)
+
+    # random sample of each cell's places: shuffle within cells, take first scount of each
+    rng = numpy.random.default_rng(getrandbits(64))
+    cell_h = h // WorldSize.cell
+    cell_count = (w // WorldSize.cell) * cell_h
+    cell_ids = (indices_x // WorldSize.cell) * cell_h + indices_y // WorldSize.cell
+    scount = rng.integers(*WorldSize.sources_per_cell, size=cell_count)
+    order = numpy.lexsort((rng.random(len(cell_ids)), cell_ids))
+    cell_ids = cell_ids[order]
+    counts = numpy.bincount(cell_ids, minlength=cell_count)
+    starts = numpy.cumsum(counts) - counts
+    chosen = order[numpy.arange(len(cell_ids)) - starts[cell_ids] < scount[cell_ids]]
+
+    result = numpy.empty((len(chosen), 2), dtype=numpy.uint32)
+    result[:, 0] = indices_x[chosen] + origin[0]
+    result[:, 1] = indices_y[chosen] + origin[1]
     return result
 
 
@@ -92,7 +107,7 @@ def glue_parts_together(cells, cell_width, cell_height):
     return output
 
 
-def render_generated_world(cells, sources=[]):
+def render_generated_world(cells, sources=()):
     from PIL import Image, ImageDraw
 
     GROUND_COLOR = (80, 80, 80)
@@ -100,21 +115,13 @@ def render_generated_world(cells, sources=[]):
     WALL_COLOR = (0, 0, 0)
     SOURCE_COLOR = (255, 255, 0)
 
-    out = Image.new('RGBA', (cells.shape[0], cells.shape[1]))
-    draw = ImageDraw.Draw(out)
-    draw.rectangle((
-        0, 0,
-        cells.shape[0], cells.shape[1],
-    ), fill=GROUND_COLOR)
-
-    for y in range(cells.shape[1]):
-        for x in range(cells.shape[0]):
-            if cells[x, y] != NaturalMap.natural_wall:
-                continue
-            out.putpixel((x, y), WALL_COLOR)
-
-    for x, y in sources:
-        out.putpixel((x, y), SOURCE_COLOR)
+    colors = numpy.empty((256, 4), dtype=numpy.uint8)
+    colors[:] = GROUND_COLOR + (255, )
+    colors[NaturalMap.natural_wall] = WALL_COLOR + (255, )
+    pixels = colors[cells.T]
+    sources = numpy.asarray(sources, dtype=numpy.intp).reshape(-1, 2)
+    pixels[sources[:, 1], sources[:, 0]] = SOURCE_COLOR + (255, )
+    out = Image.fromarray(pixels, 'RGBA')
 
     grid_layer = Image.new('RGBA', (cells.shape[0], cells.shape[1]))
     grid_draw = ImageDraw.Draw(grid_layer)
@@ -126,10 +133,10 @@ def render_generated_world(cells, sources=[]):
     return Image.alpha_composite(out, grid_layer)
 
 
-def generate_world(cell_width, cell_height):
-    cells = make_full_world(cell_width, cell_height)
-    sources = setup_sources(cells)
+def generate_world(cell_width, cell_height, library=None):
+    cells = make_full_world(cell_width, cell_height, library=library)
     mp = glue_parts_together(cells, cell_width, cell_height)
+    sources = setup_sources(mp)
     return mp, sources
 
 
@@ -138,3 +145,4 @@ if __name__ == '__main__':
     im = render_generated_world(wmap, sources=sources)
     # im.show()
     im.save('map.png')
+    export_png(wmap, 'map8.png')
@@ -44,24 +44,17 @@ def make_bottom_walls(row):
     return bwalls
 
 
-def genmaze_eller(cellcount, heightcount):
-    #     0   1
-    # +xxx+xxx+xxx+
-    # x   |   |   x
-    # +---+---+---+  0
-    # x   |   |   x
-    # +xxx+xxx+xxx+
-
-    all_right_walls = numpy.zeros((cellcount - 1, heightcount), dtype=numpy.bool_)
-    all_bottom_walls = numpy.zeros((cellcount, heightcount - 1), dtype=numpy.bool_)
-
+def iter_eller_rows(cellcount, heightcount=None):
+    '''
+    Yields (right walls, bottom walls) for each maze row, top to bottom.
+    Bottom walls of the last row are None. Without heightcount the maze never ends.
+    '''
     row = numpy.arange(1, cellcount + 1, dtype=numpy.int16)
-    rwalls = numpy.zeros((cellcount - 1,), dtype=numpy.bool_)
-    rwalls_req = numpy.zeros(rwalls.shape, dtype=numpy.bool_)
-    for y in range(heightcount):
+    y = 0
+    while True:
         fill_unassigned(row)
-        rwalls[:] = False
-        rwalls_req[:] = False
+        rwalls = numpy.zeros((cellcount - 1,), dtype=numpy.bool_)
+        rwalls_req = numpy.zeros(rwalls.shape, dtype=numpy.bool_)
         for x in range(cellcount - 1):
             if row[x] == row[x + 1]:
                 rwalls_req[x] = True
@@ -71,20 +64,35 @@ def genmaze_eller(cellcount, heightcount):
             else:
                 join_sets(row, row[x], row[x + 1])
 
-        if y == heightcount - 1:  # last row condition
-            break
-        all_right_walls[:, y] = rwalls_req | rwalls
+        if heightcount is not None and y == heightcount - 1:  # last row condition
+            for x in range(cellcount - 1):
+                if row[x + 1] != row[x]:
+                    rwalls[x] = False
+                    join_sets(row, row[x], row[x + 1])
+            yield rwalls | rwalls_req, None
+            return
 
         bwalls = make_bottom_walls(row)
-        all_bottom_walls[:, y] = bwalls
+        yield rwalls_req | rwalls, bwalls
         row[bwalls] = 0
+        y += 1
+
+
+def genmaze_eller(cellcount, heightcount):
+    #     0   1
+    # +xxx+xxx+xxx+
+    # x   |   |   x
+    # +---+---+---+  0
+    # x   |   |   x
+    # +xxx+xxx+xxx+
+
+    all_right_walls = numpy.zeros((cellcount - 1, heightcount), dtype=numpy.bool_)
+    all_bottom_walls = numpy.zeros((cellcount, heightcount - 1), dtype=numpy.bool_)
 
-    # walls in last row
-    for x in range(cellcount - 1):
-        if row[x + 1] != row[x]:
-            rwalls[x] = False
-            join_sets(row, row[x], row[x + 1])
-    all_right_walls[:, heightcount - 1] = rwalls | rwalls_req
+    for y, (rwalls, bwalls) in enumerate(iter_eller_rows(cellcount, heightcount)):
+        all_right_walls[:, y] = rwalls
+        if bwalls is not None:
+            all_bottom_walls[:, y] = bwalls
 
     return {
         'width': cellcount,
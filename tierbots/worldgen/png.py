@@ -0,0 +1,89 @@
+'''
+World map storage in paletted PNG-8, palette index is NaturalMap value itself.
+
+Map arrays are indexed as [x, y], images as [y][x].
+'''
+from os import makedirs
+from os.path import join
+import numpy
+
+from ..const import NaturalMap, DTypes
+
+
+PALETTE = {
+    NaturalMap.unknown: (128, 128, 128),
+    NaturalMap.ground: (255, 255, 255),
+    NaturalMap.natural_wall: (0, 0, 0),
+    NaturalMap.artifical_wall: (96, 64, 32),
+    NaturalMap.road: (192, 192, 160),
+}
+
+
+def _flat_palette():
+    out = []
+    for v in range(max(PALETTE) + 1):
+        out.extend(PALETTE.get(v, (0, 0, 0)))
+    return out
+
+
+def to_image(naturalmap):
+    from PIL import Image
+
+    data = numpy.ascontiguousarray(naturalmap.T, dtype=DTypes.naturalmap)
+    im = Image.frombuffer('P', (naturalmap.shape[0], naturalmap.shape[1]), data, 'raw', 'P', 0, 1)
+    im.putpalette(_flat_palette())
+    return im
+
+
+def export_png(naturalmap, filename):
+    to_image(naturalmap).save(filename, optimize=False)
+
+
+def _palette_lut(im):
+    # maps palette index of (possibly foreign) image to NaturalMap value by color
+    lut = numpy.full((256, ), NaturalMap.unknown, dtype=DTypes.naturalmap)
+    pal = im.getpalette() or []
+    by_color = {c: v for v, c in PALETTE.items()}
+    for i in range(len(pal) // 3):
+        lut[i] = by_color.get(tuple(pal[i * 3:i * 3 + 3]), NaturalMap.unknown)
+    return lut
+
+
+def import_png(filename, out=None, strip=256):
+    '''
+    Reads map back row strip by row strip, so no full-size temporary arrays are created.
+    Pass out to fill existing naturalmap in place.
+    '''
+    from PIL import Image
+
+    im = Image.open(filename)
+    assert im.mode == 'P', 'Map image must be paletted'
+    w, h = im.size
+    if out is None:
+        out = numpy.empty((w, h), dtype=DTypes.naturalmap)
+    assert out.shape == (w, h), 'Map size mismatch'
+    lut = _palette_lut(im)
+    for y in range(0, h, strip):
+        rows = numpy.asarray(im.crop((0, y, w, min(h, y + strip))))
+        out[:, y:y + rows.shape[0]] = lut[rows].T
+    return out
+
+
+def render_tiles(naturalmap, foldername, tile=256):
+    '''
+    Writes zoomable tile pyramid as foldername/zoom/tx/ty.png.
+    Zoom 0 fits whole map into single tile, every next zoom doubles resolution.
+    Returns maximal zoom.
+    '''
+    max_zoom = 0
+    while max(naturalmap.shape) > tile << max_zoom:
+        max_zoom += 1
+    level = naturalmap
+    for zoom in range(max_zoom, -1, -1):
+        for tx in range(0, level.shape[0], tile):
+            dirname = join(foldername, str(zoom), str(tx // tile))
+            makedirs(dirname, exist_ok=True)
+            for ty in range(0, level.shape[1], tile):
+                export_png(level[tx:tx + tile, ty:ty + tile], join(dirname, '{}.png'.format(ty // tile)))
+        level = level[::2, ::2]
+    return max_zoom
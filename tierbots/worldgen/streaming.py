@@ -0,0 +1,164 @@
+'''
+On-demand world generation. Cells are generated on first touch, in any order.
+
+Each cell is generated from its own seeded random stream, so the same seed always
+gives the same world. Exits of a cell are its own east/south exits joined with
+east exits of the left neighbour and south exits of the top neighbour.
+
+Maze rows never end, so the last row is closed like the last row of Eller's algorithm:
+right walls between parts not connected through rows above are opened, and the whole
+world is connected. South exits of the last row open onto map border, rows added by
+grow() join the world through them.
+'''
+import random
+from contextlib import contextmanager
+import numpy
+
+from .maze import iter_eller_rows
+from .cellgen import make_cell, make_random_exits
+from .fullworld import setup_sources
+from ..const import Direction, WorldSize
+
+
+def row_labels(above, bwalls, rwalls):
+    '''
+    Labels cells of maze row by connected part of rows generated so far, label is index
+    of the first cell of the part. above are labels of the row above and bwalls its bottom
+    walls, both None for the first row.
+
+    >>> row_labels(None, None, [False, True, False]).tolist()
+    [0, 0, 2, 2]
+    >>> row_labels(numpy.array([0, 0, 2, 2]), [True, False, True, False], [True, True, True]).tolist()
+    [0, 1, 2, 3]
+    >>> row_labels(numpy.array([0, 0, 2, 2]), [False, True, True, False], [True, True, False]).tolist()
+    [0, 1, 2, 2]
+    '''
+    n = len(rwalls) + 1
+    # fresh labels of cells closed from above are distinct from labels of the row above
+    labels = numpy.arange(n, 2 * n)
+    if above is not None:
+        opened = ~numpy.asarray(bwalls, dtype=bool)
+        labels[opened] = above[opened]
+    for x in range(n - 1):
+        if not rwalls[x] and labels[x] != labels[x + 1]:
+            labels[labels == labels[x + 1]] = labels[x]
+    first = {}
+    return numpy.array([first.setdefault(v, i) for i, v in enumerate(labels.tolist())])
+
+
+def close_row(labels, rwalls):
+    '''
+    Opens right walls between cells of different parts, joining the row and everything above.
+
+    >>> rwalls = numpy.array([True, True, True])
+    >>> close_row(numpy.array([0, 0, 2, 0]), rwalls)
+    >>> rwalls.tolist()
+    [True, False, True]
+    '''
+    labels = labels.copy()
+    for x in range(len(rwalls)):
+        if labels[x] != labels[x + 1]:
+            rwalls[x] = False
+            labels[labels == labels[x + 1]] = labels[x]
+
+
+@contextmanager
+def seeded_random(*key):
+    # doesn't disturb global random state used by the rest of the server
+    st = random.getstate()
+    random.seed(':'.join(str(k) for k in key))
+    try:
+        yield
+    finally:
+        random.setstate(st)
+
+
+class StreamingWorld:
+    '''
+    World with fixed width (in cells) and growing height.
+    Maze rows are generated sequentially, but only up to the lowest touched row.
+
+    >>> w = StreamingWorld(8, 6, seed=3)
+    >>> rwalls, bwalls = w.maze_row(5)
+    >>> w._labels.tolist()
+    [0, 0, 0, 0, 0, 0, 0, 0]
+    '''
+    raze_prob = 0.4
+
+    def __init__(self, cell_width, cell_height, seed):
+        self.width = cell_width
+        self.height = cell_height
+        self.seed = seed
+        # rows which were last before world grew, they stay closed
+        self.closed = set()
+        self._reset()
+
+    def _reset(self):
+        self._maze = iter_eller_rows(self.width)
+        self._rows = []
+        # parts of the lowest generated row, see row_labels
+        self._labels = None
+        self._exits = {}
+
+    def __getstate__(self):
+        # everything else is reproducible from seed
+        return {'width': self.width, 'height': self.height, 'seed': self.seed, 'closed': sorted(self.closed)}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.closed = set(state.get('closed', ()))
+        self._reset()
+
+    def grow(self, cell_rows):
+        self.closed.add(self.height - 1)
+        self.height += cell_rows
+
+    def maze_row(self, cy):
+        while len(self._rows) <= cy:
+            y = len(self._rows)
+            with seeded_random(self.seed, 'maze', y):
+                rwalls, bwalls = next(self._maze)
+                rwalls = rwalls.copy()
+                bwalls = bwalls.copy()
+                for walls in (rwalls, bwalls):
+                    for i in range(len(walls)):
+                        if walls[i] and random.random() < self.raze_prob:
+                            walls[i] = False
+            above = self._rows[-1][1] if self._rows else None
+            self._labels = row_labels(self._labels, above, rwalls)
+            if y == self.height - 1 or y in self.closed:
+                close_row(self._labels, rwalls)
+                self._labels = numpy.zeros(self.width, dtype=self._labels.dtype)
+            self._rows.append((rwalls, bwalls))
+        return self._rows[cy]
+
+    def own_exits(self, cx, cy):
+        k = (cx, cy)
+        if k not in self._exits:
+            rwalls, bwalls = self.maze_row(cy)
+            sds = []
+            if cx < self.width - 1 and not rwalls[cx]:
+                sds.append(Direction.east)
+            if not bwalls[cx]:
+                sds.append(Direction.south)
+            with seeded_random(self.seed, 'exits', cx, cy):
+                self._exits[k] = make_random_exits(only_sides=tuple(sds))
+        return self._exits[k]
+
+    def cell_exits(self, cx, cy):
+        exits = list(self.own_exits(cx, cy))
+        if cx > 0:
+            exits.extend((Direction.west, a, b) for side, a, b in self.own_exits(cx - 1, cy) if side == Direction.east)
+        if cy > 0:
+            exits.extend((Direction.north, a, b) for side, a, b in self.own_exits(cx, cy - 1) if side == Direction.south)
+        return exits
+
+    def make_cell(self, cx, cy):
+        '''
+        Returns generated cell along with absolute coordinates of its energy sources.
+        '''
+        exits = self.cell_exits(cx, cy)
+        with seeded_random(self.seed, 'cell', cx, cy):
+            cell = make_cell(exits=exits)
+            sources = setup_sources(cell, origin=(cx * WorldSize.cell, cy * WorldSize.cell))
+        return cell, sources